@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""Comparators of more Android file types, registered on import:
+
+    check_files.py --plugin android_comparators ...
+
+Kernel modules, ART oat and odex files and build.prop are not compared
+by default; with this plugin they are walked like shared objects and
+archives, and reported when missing or different."""
+
+import hashlib, json, struct
+from comparators import Comparator, ElfSectionsComparator, register
+from elf_reader import ElfError, hash_elf_file
+from ext4_image import Ext4Error
+from image_index import to_bytes
+
+@register
+class KernelModuleComparator(ElfSectionsComparator):
+    """ Kernel modules: code and data, not .modinfo, build id or the appended signature """
+    name = 'ko'
+    patterns = ('*.ko',)
+    sections = ('.text', '.init.text', '.exit.text', '.rodata', '.data')
+
+ODEX_MAGIC = 'dey\n'
+ODEX_HEADER = '<4s4sII'
+
+@register
+class OatComparator(ElfSectionsComparator):
+    """ ART oat files (also named .odex) are ELF: oat data lives in .rodata, code in .text.
+    Dalvik odex files are compared by their embedded dex. """
+    name = 'oat'
+    patterns = ('*.oat', '*.odex')
+    sections = ('.rodata', '.text')
+    bytesPerSecond = 1e9
+
+    def digest(self, tester, path):
+        return tester.cachedValue(path, 'oat', lambda: self.oatDigest(tester, path))
+
+    def oatDigest(self, tester, path):
+        try:
+            with tester.openFile(path) as oat:
+                try:
+                    return hash_elf_file(oat, self.sections, hashlib.sha1())
+                except ElfError:
+                    pass
+                oat.seek(0)
+                header = oat.read(struct.calcsize(ODEX_HEADER))
+                if len(header) < struct.calcsize(ODEX_HEADER) or not header.startswith(ODEX_MAGIC):
+                    return None
+                magic, version, dexOffset, dexLength = struct.unpack(ODEX_HEADER, header)
+                oat.seek(dexOffset)
+                hashfunc = hashlib.sha1()
+                while dexLength > 0:
+                    buf = oat.read(min(dexLength, 1024 * 1024))
+                    if not buf:
+                        return None
+                    hashfunc.update(buf)
+                    dexLength -= len(buf)
+                return hashfunc.hexdigest()
+        except (Ext4Error, IOError, OSError):
+            return None
+
+    def fingerprint(self, tester, path):
+        return { 'oat': self.digest(tester, path) }
+
+# set at build time, differ between any two builds of the same source
+VOLATILE_PROPERTIES = frozenset([
+    'ro.build.display.id', 'ro.build.version.incremental', 'ro.build.date', 'ro.build.date.utc',
+    'ro.build.user', 'ro.build.host', 'ro.build.description', 'ro.build.fingerprint',
+    'ro.bootimage.build.fingerprint'])
+
+def parse_properties(data):
+    """ {key: value} of a build.prop file, later assignments win """
+    properties = {}
+    for line in data.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#') or '=' not in line:
+            continue
+        key, value = line.split('=', 1)
+        properties[key.strip()] = value.strip()
+    return properties
+
+@register
+class BuildPropComparator(Comparator):
+    """ build.prop without build-time properties such as date, host and fingerprint """
+    name = 'prop'
+    patterns = ('build.prop',)
+    startupCost = 0.0002
+    bytesPerSecond = 50e6
+
+    def properties(self, tester, path):
+        def read():
+            try:
+                with tester.openFile(path) as prop:
+                    return parse_properties(prop.read())
+            except (Ext4Error, IOError, OSError):
+                return None
+        return tester.cachedValue(path, 'props', read, json.dumps, lambda text: to_bytes(json.loads(text)))
+
+    def compare(self, tester, path1, path2):
+        props1 = self.properties(tester, path1)
+        props2 = self.properties(tester, path2)
+        if props1 is None or props2 is None:
+            return False
+        same = True
+        for key in sorted(set(props1) | set(props2)):
+            if key not in VOLATILE_PROPERTIES and props1.get(key) != props2.get(key):
+                print '\ndifference in: ' + key
+                same = False
+        return same
+
+    def fingerprint(self, tester, path):
+        return { 'props': self.properties(tester, path) }
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+"""Section hashing time of the in-process ELF reader against the
+readelf -x hex dump path used before."""
+
+import os, sys, time, glob, hashlib, argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from check_files import AFSImageComparator, readelfCmd, ELF_SECTIONS
+from elf_reader import hash_elf_sections
+
+DEFAULT_FILES = 'unit_test_files/so_.text_same/*.so'
+
+def timed(func, files, repeat):
+    start = time.time()
+    for _ in xrange(repeat):
+        for path in files:
+            func(path)
+    return time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs='*', help="ELF files to hash (default: unit test fixtures)")
+    parser.add_argument("--repeat", type=int, default=20, help="passes over the file list")
+    args = parser.parse_args()
+
+    files = args.files or glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', DEFAULT_FILES))
+    if not files:
+        print 'no input files'
+        sys.exit(1)
+    tester = AFSImageComparator("", "", "")
+    readelf_time = timed(lambda path: tester.hashOfCmd(readelfCmd(path)), files, args.repeat)
+    native_time = timed(lambda path: hash_elf_sections(path, ELF_SECTIONS, hashlib.sha1()), files, args.repeat)
+    total = len(files) * args.repeat
+    print '%d files x %d passes' % (len(files), args.repeat)
+    print 'readelf -x + sha1:  %8.3f s (%6.2f ms/file)' % (readelf_time, readelf_time * 1000 / total)
+    print 'in-process mmap:    %8.3f s (%6.2f ms/file)' % (native_time, native_time * 1000 / total)
+    print 'speedup:            %8.1fx' % (readelf_time / max(native_time, 1e-9))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""system.img extraction time of the streaming single-pass path against the
+getnames() + extract() path used before, plus the image checksum the hash
+cache needs afterwards."""
+
+import os, sys, re, time, shutil, tarfile, tempfile, argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from compare_packages import extractSystemImage
+from hash_cache import file_digest
+
+def legacy_extract(archive, folder):
+    """Old behaviour: one pass to list members, another to extract, and
+    another read of the image to checksum it"""
+    package = tarfile.open(archive, 'r')
+    systemRegexp = re.compile(".*system.img$")
+    names = [name for name in package.getnames() if systemRegexp.match(name)]
+    extractTo = folder + 'legacy/'
+    package.extract(names[0], extractTo)
+    package.close()
+    file_digest(extractTo + names[0])
+    return [extractTo + names[0]]
+
+def make_package(path, image_mb, padding_mb):
+    """tar.gz with a partly compressible system.img followed by a trailing image"""
+    workdir = tempfile.mkdtemp()
+    try:
+        image = os.path.join(workdir, 'system.img')
+        with open(image, 'wb') as out:
+            for i in xrange(image_mb):
+                out.write(os.urandom(256 * 1024) + chr(i % 256) * (768 * 1024))
+        trailer = os.path.join(workdir, 'userdata.img')
+        with open(trailer, 'wb') as out:
+            out.write('\0' * padding_mb * 1024 * 1024)
+        with tarfile.open(path, 'w:gz') as package:
+            package.add(image, 'system.img')
+            package.add(trailer, 'userdata.img')
+    finally:
+        shutil.rmtree(workdir)
+
+def timed(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image-mb", type=int, default=256, help="size of the synthetic system.img")
+    parser.add_argument("--trailer-mb", type=int, default=256, help="size of an image stored after system.img")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp() + '/'
+    try:
+        archive = workdir + 'fastboot-bench.tar.gz'
+        make_package(archive, args.image_mb, args.trailer_mb)
+        print '%d MB system.img, %d MB trailer, %d MB compressed' % (
+            args.image_mb, args.trailer_mb, os.path.getsize(archive) / (1024 * 1024))
+
+        legacy_time = timed(lambda: legacy_extract(archive, workdir))
+        shutil.rmtree(workdir + 'legacy')
+        stream_time = timed(lambda: extractSystemImage(archive, workdir, {}, usePigz=False))
+        shutil.rmtree(workdir + 'bench')
+        pigz_time = timed(lambda: extractSystemImage(archive, workdir, {}, usePigz=True))
+
+        print 'getnames + extract + sha1: %8.3f s' % legacy_time
+        print 'streaming (tarfile):       %8.3f s (%.1fx)' % (stream_time, legacy_time / max(stream_time, 1e-9))
+        print 'streaming (pigz if found): %8.3f s (%.1fx)' % (pigz_time, legacy_time / max(pigz_time, 1e-9))
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""MANIFEST.MF parse and diff time on a synthetic manifest, against the
+line-by-line parser and first-difference comparison used before."""
+
+import os, sys, time, base64, hashlib, argparse, StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from jar_manifest import parse_manifest, diff_manifests
+
+def legacy_parse(dataMF):
+    """Old behaviour: Name line immediately followed by SHA1-Digest, no continuation lines"""
+    manifestMF = {}
+    fileMF = StringIO.StringIO(dataMF)
+    lineMF = str(fileMF.readline())
+    while (lineMF):
+        lineMF = str(fileMF.readline())
+        if (lineMF.startswith('Name')):
+            if (lineMF.endswith('AndroidManifest.xml\r\n')):
+                continue
+            lineMF_sha = str(fileMF.readline())
+            if (lineMF_sha.startswith('SHA1-Digest')):
+                manifestMF[lineMF[6:]] = lineMF_sha[13:]
+    return manifestMF
+
+def legacy_diff(manifest_loc, manifest_ext):
+    for path in manifest_ext.keys():
+        if not path in manifest_loc or manifest_ext[path] != manifest_loc[path]:
+            return False
+    return True
+
+def wrap(line):
+    """72 byte lines, continuation lines starting with a space"""
+    lines = [line[:70]]
+    line = line[70:]
+    while line:
+        lines.append(' ' + line[:69])
+        line = line[69:]
+    return '\r\n'.join(lines) + '\r\n'
+
+def make_manifest(entries, changed=0, sha256=True):
+    sections = ['Manifest-Version: 1.0\r\nCreated-By: 1.0 (Android)\r\n\r\n']
+    for i in xrange(entries):
+        content = str(i + 1 if i < changed else i)
+        section = wrap('Name: res/drawable-xxhdpi-v4/generated_resource_%06d.png' % i)
+        section += 'SHA1-Digest: ' + base64.b64encode(hashlib.sha1(content).digest()) + '\r\n'
+        if sha256:
+            section += wrap('SHA-256-Digest: ' + base64.b64encode(hashlib.sha256(content).digest()))
+        sections.append(section + '\r\n')
+    return ''.join(sections)
+
+def timed(func, repeat):
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=50000, help="entries in the synthetic manifest")
+    parser.add_argument("--changed", type=int, default=100, help="entries with other digests in the second manifest")
+    parser.add_argument("--repeat", type=int, default=5, help="best of this many runs")
+    args = parser.parse_args()
+
+    # legacy parsing needs unwrapped lines and SHA1 only to give a meaningful result
+    plain1 = make_manifest(args.entries, sha256=False)
+    plain2 = make_manifest(args.entries, args.changed, sha256=False)
+    data1 = make_manifest(args.entries)
+    data2 = make_manifest(args.entries, args.changed)
+    print '%d entries, %d changed, %.1f MB manifest' % (args.entries, args.changed, len(data1) / 1e6)
+
+    legacy_parse_time = timed(lambda: legacy_parse(plain1), args.repeat)
+    plain_parse_time = timed(lambda: parse_manifest(plain1), args.repeat)
+    parse_time = timed(lambda: parse_manifest(data1), args.repeat)
+    old1, old2 = legacy_parse(plain1), legacy_parse(plain2)
+    new1, new2 = parse_manifest(data1), parse_manifest(data2)
+    legacy_diff_time = timed(lambda: legacy_diff(old2, old1), args.repeat)
+    diff_time = timed(lambda: diff_manifests(new1, new2), args.repeat)
+    copy1 = parse_manifest(data1)
+    same_time = timed(lambda: diff_manifests(new1, copy1), args.repeat)
+    added, removed, changed = diff_manifests(new1, new2)
+    assert len(new1) == args.entries and len(changed) == args.changed and not added and not removed
+
+    print 'legacy parse (SHA1 only):    %8.3f s' % legacy_parse_time
+    print 'parse (SHA1 only):           %8.3f s (%.1fx)' % (plain_parse_time, legacy_parse_time / max(plain_parse_time, 1e-9))
+    print 'parse (SHA1 + SHA-256):      %8.3f s' % parse_time
+    print 'legacy diff (first change):  %8.3f s' % legacy_diff_time
+    print 'diff (every change):         %8.3f s' % diff_time
+    print 'diff of equal manifests:     %8.3f s' % same_time
+
+if __name__ == '__main__':
+    main()
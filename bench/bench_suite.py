@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+"""Throughput of the walk, tier 0 hashing, ELF and archive comparison and
+end-to-end AFSImageComparator.run() on trees (and ext4 images, with mke2fs)
+from synthetic.py, for regression tracking.
+
+Each benchmark runs --repeat times and keeps its best time. --output writes
+the results as JSON; with --baseline a previous output is compared against
+and the exit code is 1 when a throughput fell by more than --tolerance.
+Results of other generator parameters are not compared. The verdicts
+of run() are checked against what the generator made, a benchmark of wrong
+results is no benchmark. Needs neither root nor network."""
+
+import os, sys, time, json, shutil, tempfile, platform, argparse, StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from check_files import AFSImageComparator, MountedTree, scan_fs_tree
+from path_rules import RuleSet
+from result_sinks import MismatchSink, FILE_DIFF, FILE_MISS, FILE_EXTRA
+import comparators
+import synthetic
+
+RESULTS_FORMAT = 'imgcmp-bench'
+RESULTS_VERSION = 1
+
+# verdict of run() for each kind of synthetic.make_trees() file, FILE_SAME when not listed
+EXPECTED_VERDICTS = { 'diff': FILE_DIFF, 'missing': FILE_MISS, 'extra': FILE_EXTRA }
+
+def best_time(func, repeat):
+    """ (best seconds, result of the last call) of repeat calls of func """
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        result = func()
+        seconds = time.time() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best, result
+
+def quiet(func):
+    """ func() with stdout swallowed: run() prints its statistics """
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        return func()
+    finally:
+        sys.stdout = stdout
+
+class Suite(object):
+
+    def __init__(self, root, files, jobs, repeat):
+        self.root = root
+        self.files = files
+        self.jobs = jobs
+        self.repeat = repeat
+        self.results = {}
+        self.errors = []
+        self.ext = os.path.join(root, 'ext')
+        self.local = os.path.join(root, 'local')
+        self.shared = sorted(path for path, kind in files.items()
+                             if kind not in ('missing', 'extra') and path.endswith('.so'))
+        self.archives = sorted(path for path, kind in files.items()
+                               if kind not in ('missing', 'extra') and not path.endswith('.so'))
+
+    def record(self, name, seconds, items, size=None):
+        result = { 'seconds': seconds, 'items': items, 'items_per_second': items / max(seconds, 1e-9) }
+        if size is not None:
+            result['bytes'] = size
+            result['mb_per_second'] = size / 1e6 / max(seconds, 1e-9)
+        self.results[name] = result
+
+    def comparator(self, localImg='', extImg='', readImages=False):
+        """ AFSImageComparator in a work dir of its own, work dirs are named after the second """
+        workRoot = tempfile.mkdtemp(prefix='work_', dir=self.root)
+        return AFSImageComparator(localImg, extImg, workRoot, jobs=self.jobs, readImages=readImages, rules=RuleSet())
+
+    def bench_walk(self):
+        tree = MountedTree(self.ext)
+        patterns = comparators.pattern_dict()
+        seconds, found = best_time(lambda: list(scan_fs_tree(tree, patterns)), self.repeat)
+        self.record('walk', seconds, len(found))
+
+    def bench_hash(self):
+        tester = self.comparator()
+        paths = [self.ext + path for path in sorted(self.files) if self.files[path] != 'extra']
+        size = sum(os.path.getsize(path) for path in paths)
+        seconds, hashes = best_time(lambda: [tester.hashOfFile(path) for path in paths], self.repeat)
+        self.record('hash', seconds, len(paths), size)
+
+    def bench_pairs(self, name, paths, compare):
+        """ compare(local path, ext path) over paths found in both trees, checked against the generator """
+        size = sum(os.path.getsize(self.ext + path) + os.path.getsize(self.local + path) for path in paths)
+        seconds, same = best_time(lambda: quiet(lambda: [compare(self.local + path, self.ext + path) for path in paths]),
+                                  self.repeat)
+        wrong = [path for path, result in zip(paths, same) if result != (self.files[path] != 'diff')]
+        if wrong:
+            self.errors.append('%s: wrong result for %d files, e.g. %s' % (name, len(wrong), wrong[0]))
+        self.record(name, seconds, len(paths), size)
+
+    def bench_elf(self):
+        tester = self.comparator()
+        self.bench_pairs('elf', self.shared, tester.compare_shared_object)
+
+    def bench_archive(self):
+        tester = self.comparator()
+        self.bench_pairs('archive', self.archives, lambda local, ext: tester.are_apk_same(ext, local))
+
+    def check_run(self, name, mismatches):
+        expected = dict((path, EXPECTED_VERDICTS[kind]) for path, kind in self.files.items() if kind in EXPECTED_VERDICTS)
+        if mismatches.mismatches != expected or mismatches.checked != len(self.files):
+            wrong = sorted(set(mismatches.mismatches.items()) ^ set(expected.items()))
+            self.errors.append('%s: %d files checked, %d wrong verdicts%s' % (name, mismatches.checked, len(wrong),
+                                                                              ', e.g. %s' % (wrong[0],) if wrong else ''))
+
+    def bench_run(self, name, make_tester):
+        """ End-to-end run() with a new comparator per pass, so nothing is cached between passes """
+        def one_run():
+            tester = make_tester()
+            mismatches = MismatchSink()
+            quiet(lambda: tester.run([mismatches]))
+            return mismatches
+        seconds, mismatches = best_time(one_run, self.repeat)
+        self.check_run(name, mismatches)
+        self.record(name, seconds, len(self.files))
+
+    def dir_tester(self):
+        """ Comparator of the two directories, as if they were mounted images """
+        tester = self.comparator()
+        trees = [(path + '/', MountedTree(path)) for path in (self.local, self.ext)]
+        (tester.localMountpointPath, tester.localTree), (tester.extMountpointPath, tester.extTree) = trees
+        tester.trees = trees
+        return tester
+
+    def image_tester(self):
+        return self.comparator(os.path.join(self.root, 'local.img'), os.path.join(self.root, 'ext.img'), True)
+
+def compare_results(current, baseline, tolerance):
+    """ Lines of throughput changes against baseline, and whether any fell by more than tolerance """
+    lines = []
+    regressed = False
+    if current['params'] != baseline.get('params'):
+        return ['baseline was made with other generator parameters, not compared'], False
+    for name in sorted(current['results']):
+        if name not in baseline.get('results', {}):
+            continue
+        now = current['results'][name]['items_per_second']
+        before = baseline['results'][name]['items_per_second']
+        change = now / max(before, 1e-9) - 1
+        slower = change < -tolerance
+        regressed = regressed or slower
+        lines.append('%-10s %+7.1f%%%s' % (name, change * 100, '  REGRESSION' if slower else ''))
+    return lines, regressed
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark suite on synthetic trees, see synthetic.py")
+    parser.add_argument("--tmp-dir", help="where to generate the trees")
+    parser.add_argument("--repeat", type=int, default=3, help="passes per benchmark, the best one counts")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="threads of run()")
+    parser.add_argument("--no-images", action="store_true", help="skip run() on ext4 images")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="throughput loss counted as a regression (default: 0.25, best of --repeat passes is still noisy)")
+    synthetic.add_generator_arguments(parser)
+    args = parser.parse_args()
+
+    params = synthetic.generator_params(args)
+    root = tempfile.mkdtemp(prefix='bench_suite_', dir=args.tmp_dir)
+    try:
+        start = time.time()
+        files = synthetic.make_trees(root, **params)
+        suite = Suite(root, files, args.jobs, args.repeat)
+        images = not args.no_images and synthetic.have_mke2fs()
+        if images:
+            for side in ('ext', 'local'):
+                synthetic.make_image(os.path.join(root, side), os.path.join(root, side + '.img'))
+        print 'generated %d files in %.1f s' % (len(files), time.time() - start)
+
+        suite.bench_walk()
+        suite.bench_hash()
+        suite.bench_elf()
+        suite.bench_archive()
+        suite.bench_run('run', suite.dir_tester)
+        if images:
+            suite.bench_run('run-image', suite.image_tester)
+    finally:
+        shutil.rmtree(root)
+
+    for name in sorted(suite.results):
+        result = suite.results[name]
+        line = '%-10s %8.3f s %10.1f items/s' % (name, result['seconds'], result['items_per_second'])
+        if 'mb_per_second' in result:
+            line += ' %8.1f MB/s' % result['mb_per_second']
+        print line
+    for error in suite.errors:
+        print 'ERROR ' + error
+
+    current = { 'format': RESULTS_FORMAT, 'version': RESULTS_VERSION, 'params': params,
+                'jobs': args.jobs, 'repeat': args.repeat, 'python': platform.python_version(),
+                'machine': platform.machine(), 'results': suite.results }
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(current, out, indent=1, sort_keys=True)
+    regressed = False
+    if args.baseline:
+        with open(args.baseline) as inp:
+            baseline = json.load(inp)
+        lines, regressed = compare_results(current, baseline, args.tolerance)
+        for line in lines:
+            print line
+    if suite.errors or regressed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""Walk time of the single-pass scan_tree() against the legacy per-pattern
+DFS + glob traversal on a synthetic tree (100k entries by default)."""
+
+import os, sys, glob, time, shutil, tempfile, argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from check_files import scan_tree
+
+PATTERNS = ['*.so', '*.jar', '*.apk']
+SUFFIXES = ['.so', '.jar', '.apk', '.xml', '.png', '.odex', '.txt', '.prop']
+
+def legacy_subdirs(root):
+    try:
+        dirs = [os.path.join(root, x) for x in os.listdir(root)]
+        dirs = filter(os.path.isdir, dirs)
+        return filter(lambda x: not os.path.islink(x), dirs)
+    except OSError: return []
+
+def legacy_find(root, pattern):
+    """linux_like_find() as it was: DFS over subdirs() with a glob and a sort per directory"""
+    files = []
+    stack = [root]
+    visited = {}
+    while stack:
+        d = stack.pop()
+        if d not in visited:
+            visited[d] = 1
+            files += glob.glob(os.path.join(d, pattern))
+            files.sort()
+        stack.extend(legacy_subdirs(d))
+    return files
+
+def make_tree(root, entries, fanout):
+    """Create about `entries` files and directories below root."""
+    created = 0
+    dirs = [root]
+    while created < entries:
+        parent = dirs[created // fanout % len(dirs)]
+        if created % fanout == 0:
+            path = os.path.join(parent, 'd%06d' % created)
+            os.mkdir(path)
+            dirs.append(path)
+        else:
+            path = os.path.join(parent, 'f%06d%s' % (created, SUFFIXES[created % len(SUFFIXES)]))
+            open(path, 'w').close()
+        created += 1
+
+def timed(func):
+    start = time.time()
+    result = func()
+    return time.time() - start, result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=100000, help="number of files and directories to generate")
+    parser.add_argument("--fanout", type=int, default=40, help="entries per directory")
+    parser.add_argument("--tmp-dir", help="where to build the tree")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='bench_walk_', dir=args.tmp_dir)
+    try:
+        make_tree(root, args.entries, args.fanout)
+        legacy_time, legacy = timed(lambda: [legacy_find(root, p) for p in PATTERNS])
+        single_time, single = timed(lambda: list(scan_tree(root, dict((p, p) for p in PATTERNS))))
+        legacy_count = sum(len(found) for found in legacy)
+        if legacy_count != len(single):
+            print 'MISMATCH: legacy found %d files, scan_tree %d' % (legacy_count, len(single))
+            sys.exit(1)
+        print '%d entries, %d matched files' % (args.entries, len(single))
+        print 'legacy linux_like_find x%d: %8.3f s' % (len(PATTERNS), legacy_time)
+        print 'scan_tree single pass:   %8.3f s' % single_time
+        print 'speedup:                 %8.1fx' % (legacy_time / max(single_time, 1e-9))
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
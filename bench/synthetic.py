@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+"""Synthetic local/ext trees and images for the benchmarks.
+
+make_trees() writes root/ext and root/local: shared objects (minimal ELF
+files with a .text of a given size), APKs and JARs (classes.dex, resources
+and a META-INF/MANIFEST.MF with their SHA1-Digest), each file of ext being
+copied to local as
+
+    same     identical bytes
+    rebuilt  other bytes, same content: .comment of a .so, signature of an archive
+    diff     other .text or classes.dex
+    missing  not in local
+
+plus 'extra' files only in local. Everything is drawn from a seeded
+random.Random, so a seed and parameters always give the same bytes.
+make_image() packs a tree into an ext4 image with mke2fs -d, which needs
+neither root nor loop devices; check_files --no-mount reads it."""
+
+import os, sys, struct, random, zipfile, hashlib, base64, binascii, subprocess, argparse, json, StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from elf_reader import ELFCLASS32, ELFDATA2LSB, EHDR_FORMAT, SHDR_FORMAT, ENDIAN
+
+KINDS = ('same', 'rebuilt', 'diff', 'missing', 'extra')
+
+# zip entries get this time, zipfile.writestr() would use the current time
+ZIP_DATE_TIME = (2016, 1, 1, 0, 0, 0)
+
+DEFAULTS = {
+    'seed': 1,
+    'so_count': 400,
+    'so_size': 64 * 1024,
+    'apk_count': 100,
+    'jar_count': 50,
+    'entries': 20,
+    'entry_size': 8 * 1024,
+    'dex_size': 256 * 1024,
+    'diff_ratio': 0.05,
+    'rebuilt_ratio': 0.2,
+    'missing': 5,
+    'extra': 5,
+}
+
+def random_bytes(rng, size):
+    if size <= 0:
+        return ''
+    return binascii.unhexlify('%0*x' % (2 * size, rng.getrandbits(8 * size)))
+
+def elf_object(text, comment=''):
+    """ Minimal 32-bit little endian ELF with null, .text, .comment and .shstrtab sections """
+    endian = ENDIAN[ELFDATA2LSB]
+    ehdr_format = endian + EHDR_FORMAT[ELFCLASS32]
+    shdr_format = endian + SHDR_FORMAT[ELFCLASS32]
+    ehdr_size = 16 + struct.calcsize(ehdr_format)
+    shstrtab = '\0.text\0.comment\0.shstrtab\0'
+    text_offset = ehdr_size
+    comment_offset = text_offset + len(text)
+    strtab_offset = comment_offset + len(comment)
+    shoff = strtab_offset + len(shstrtab)
+    ident = '\x7fELF' + chr(ELFCLASS32) + chr(ELFDATA2LSB) + '\x01' + '\0' * 9
+    ehdr = ident + struct.pack(ehdr_format, 3, 40, 1, 0, 0, shoff, 0, ehdr_size, 0, 0,
+                               struct.calcsize(shdr_format), 4, 3)
+    shdrs = struct.pack(shdr_format, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+    shdrs += struct.pack(shdr_format, 1, 1, 6, 0, text_offset, len(text), 0, 0, 4, 0)
+    shdrs += struct.pack(shdr_format, 7, 1, 0x30, 0, comment_offset, len(comment), 0, 0, 1, 1)
+    shdrs += struct.pack(shdr_format, 16, 3, 0, 0, strtab_offset, len(shstrtab), 0, 0, 1, 0)
+    return ehdr + text + comment + shstrtab + shdrs
+
+def archive_data(members, signature):
+    """ Zip of {name: data} members with their digests in META-INF/MANIFEST.MF,
+    signed by signature (META-INF/CERT.RSA, not covered by the manifest) """
+    names = sorted(members)
+    manifest = ['Manifest-Version: 1.0\r\nCreated-By: 1.0 (Android)\r\n\r\n']
+    for name in names:
+        manifest.append('Name: %s\r\nSHA1-Digest: %s\r\n\r\n' % (name, base64.b64encode(hashlib.sha1(members[name]).digest())))
+    entries = [('META-INF/MANIFEST.MF', ''.join(manifest)), ('META-INF/CERT.RSA', signature)]
+    entries += [(name, members[name]) for name in names]
+    out = StringIO.StringIO()
+    archive = zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED)
+    for name, data in entries:
+        archive.writestr(zipfile.ZipInfo(name, ZIP_DATE_TIME), data)
+    archive.close()
+    return out.getvalue()
+
+def pick_kinds(rng, count, params):
+    """ A kind of KINDS per ext file, 'missing' for params['missing'] of them """
+    kinds = []
+    for i in xrange(count):
+        draw = rng.random()
+        if draw < params['diff_ratio']:
+            kinds.append('diff')
+        elif draw < params['diff_ratio'] + params['rebuilt_ratio']:
+            kinds.append('rebuilt')
+        else:
+            kinds.append('same')
+    for i in rng.sample(xrange(count), min(params['missing'], count)):
+        kinds[i] = 'missing'
+    return kinds
+
+def write_file(root, rel_path, data):
+    path = root + rel_path
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    with open(path, 'wb') as out:
+        out.write(data)
+
+def shared_object_pair(rng, size, kind):
+    text = random_bytes(rng, size)
+    ext = elf_object(text, 'GCC: (GNU) 4.9 20150123 (prerelease)\0')
+    if kind == 'rebuilt':
+        return ext, elf_object(text, 'GCC: (GNU) 4.9 20160229 (prerelease)\0')
+    if kind == 'diff':
+        offset = rng.randrange(max(size, 1))
+        return ext, elf_object(text[:offset] + random_bytes(rng, 4) + text[offset + 4:size], 'GCC: (GNU) 4.9 20150123 (prerelease)\0')
+    return ext, ext
+
+def archive_pair(rng, params, kind):
+    members = { 'classes.dex': 'dex\n035\0' + random_bytes(rng, params['dex_size']) }
+    for i in xrange(params['entries']):
+        members['res/raw/r%03d.bin' % i] = random_bytes(rng, params['entry_size'])
+    ext = archive_data(members, random_bytes(rng, 1024))
+    if kind == 'rebuilt':
+        return ext, archive_data(members, random_bytes(rng, 1024))
+    if kind == 'diff':
+        members['classes.dex'] += random_bytes(rng, 16)
+        return ext, archive_data(members, random_bytes(rng, 1024))
+    return ext, ext
+
+def file_paths(params):
+    """ rel_paths of ext files in generation order, with the pair maker of each """
+    paths = []
+    for i in xrange(params['so_count']):
+        paths.append(('/lib/lib%05d.so' % i, 'so'))
+    for i in xrange(params['apk_count']):
+        paths.append(('/app/App%05d/App%05d.apk' % (i, i), 'archive'))
+    for i in xrange(params['jar_count']):
+        paths.append(('/framework/fw%05d.jar' % i, 'archive'))
+    return paths
+
+def make_trees(root, **overrides):
+    """ Write root/ext and root/local, returns {rel_path: kind} """
+    params = dict(DEFAULTS)
+    params.update(overrides)
+    rng = random.Random(params['seed'])
+    ext_root = os.path.join(root, 'ext')
+    local_root = os.path.join(root, 'local')
+    paths = file_paths(params)
+    kinds = pick_kinds(rng, len(paths), params)
+    files = {}
+    for (rel_path, maker), kind in zip(paths, kinds):
+        if maker == 'so':
+            ext, local = shared_object_pair(rng, params['so_size'], kind)
+        else:
+            ext, local = archive_pair(rng, params, kind)
+        write_file(ext_root, rel_path, ext)
+        if kind != 'missing':
+            write_file(local_root, rel_path, local)
+        files[rel_path] = kind
+    for i in xrange(params['extra']):
+        rel_path = '/lib/extra%05d.so' % i
+        write_file(local_root, rel_path, elf_object(random_bytes(rng, params['so_size'])))
+        files[rel_path] = 'extra'
+    return files
+
+def tree_size(root):
+    """ (bytes, files and directories) below root """
+    size = entries = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        entries += len(dirnames) + len(filenames)
+        size += sum(os.path.getsize(os.path.join(dirpath, name)) for name in filenames)
+    return size, entries
+
+def make_image(src, image):
+    """ ext4 image of the tree src, sized to fit """
+    size, entries = tree_size(src)
+    blocks = (size * 5 // 4 + entries * 8192) // 4096 + 4096
+    with open(os.devnull, 'w') as dev_null:
+        subprocess.check_call(['mke2fs', '-q', '-F', '-t', 'ext4', '-b', '4096', '-N', str(entries + 1024),
+                               '-d', src, image, str(blocks)], stdout=dev_null, stderr=dev_null)
+    return image
+
+def have_mke2fs():
+    try:
+        with open(os.devnull, 'w') as dev_null:
+            subprocess.call(['mke2fs', '-V'], stdout=dev_null, stderr=dev_null)
+        return True
+    except OSError:
+        return False
+
+def add_generator_arguments(parser):
+    parser.add_argument("--seed", type=int, default=DEFAULTS['seed'], help="random seed")
+    parser.add_argument("--so-count", type=int, default=DEFAULTS['so_count'], help="shared objects")
+    parser.add_argument("--so-size", type=int, default=DEFAULTS['so_size'], help=".text bytes per shared object")
+    parser.add_argument("--apk-count", type=int, default=DEFAULTS['apk_count'], help="APKs")
+    parser.add_argument("--jar-count", type=int, default=DEFAULTS['jar_count'], help="JARs")
+    parser.add_argument("--entries", type=int, default=DEFAULTS['entries'], help="resource entries per archive")
+    parser.add_argument("--entry-size", type=int, default=DEFAULTS['entry_size'], help="bytes per resource entry")
+    parser.add_argument("--dex-size", type=int, default=DEFAULTS['dex_size'], help="classes.dex bytes per archive")
+    parser.add_argument("--diff-ratio", type=float, default=DEFAULTS['diff_ratio'], help="share of files that differ")
+    parser.add_argument("--rebuilt-ratio", type=float, default=DEFAULTS['rebuilt_ratio'],
+                        help="share of files with other bytes but the same content")
+    parser.add_argument("--missing", type=int, default=DEFAULTS['missing'], help="files only in ext")
+    parser.add_argument("--extra", type=int, default=DEFAULTS['extra'], help="files only in local")
+
+def generator_params(args):
+    return dict((name, getattr(args, name)) for name in DEFAULTS)
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic ext/local trees, and ext4 images of them with --images")
+    parser.add_argument("root", help="output directory")
+    parser.add_argument("--images", action="store_true", help="also write ext.img and local.img")
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+
+    files = make_trees(args.root, **generator_params(args))
+    if args.images:
+        for side in ('ext', 'local'):
+            make_image(os.path.join(args.root, side), os.path.join(args.root, side + '.img'))
+    with open(os.path.join(args.root, 'files.json'), 'w') as out:
+        json.dump({ 'params': generator_params(args), 'files': files }, out, indent=1, sort_keys=True)
+    for kind in KINDS:
+        print '%-8s %6d files' % (kind, sum(1 for k in files.values() if k == kind))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""Newest build package in a tree of daily builds.
+
+Directories are expanded newest (mtime) first and only the best count
+packages are kept, in a heap. Packages are ranked by the version order of
+their names (fastboot-x-1.9 < fastboot-x-1.10), or by ctime/mtime.
+
+Pruning (off by default, --order mtime only) stops the scan at the first
+directory older than every package kept. Adding a build only updates the
+mtime of its own directory, never of its parents, so this is right only
+for trees filled in time order, such as YYYY/MM/DD/<builds>: builds are
+added to the newest directory only, and a directory created later holds
+only later builds. A build added to an older directory can be missed.
+
+A BuildsIndex caches the matching packages and subdirectories of each
+directory with its mtime, so a directory that did not change is not listed
+again; on a network share listing is what takes the time."""
+
+import os, re, json, heapq, fnmatch, time
+from check_files import _dir_entries
+
+ORDERS = ('version', 'ctime', 'mtime')
+
+# listings of directories changed this recently may miss an entry added in the same mtime tick
+RACY_SECONDS = 2.0
+
+INDEX_FORMAT = 'imgcmp-builds'
+INDEX_VERSION = 1
+
+def version_key(name):
+    """ Sort key comparing digit runs as numbers: build-9 < build-10 """
+    parts = re.split(r'(\d+)', name)
+    return tuple(int(part) if i % 2 else part for i, part in enumerate(parts))
+
+class BuildsIndex(object):
+    """ {directory: (mtime, [subdirectory names], [(package name, mtime, ctime)])} of
+    packages matching pattern; kept in the JSON file at path when path is given """
+
+    def __init__(self, pattern, path=None):
+        self.pattern = pattern
+        self.path = path
+        self.dirs = {}
+        self.listed = 0
+        self.reused = 0
+        if path and os.path.isfile(path):
+            try:
+                with open(path) as inp:
+                    data = json.load(inp)
+                if (data.get('format'), data.get('version'), data.get('pattern')) == (INDEX_FORMAT, INDEX_VERSION, pattern):
+                    self.dirs = dict((dirpath.encode('utf-8'), (mtime, [name.encode('utf-8') for name in subdirs],
+                                                              [(name.encode('utf-8'), m, c) for name, m, c in files]))
+                                     for dirpath, (mtime, subdirs, files) in data['dirs'].iteritems())
+            except (IOError, ValueError, KeyError, TypeError):
+                self.dirs = {}
+
+    def entries(self, dirpath, mtime):
+        """ (subdirectory names, [(package name, mtime, ctime)]) of dirpath, whose mtime is mtime """
+        cached = self.dirs.get(dirpath)
+        if cached is not None and cached[0] == mtime:
+            self.reused += 1
+            return cached[1], cached[2]
+        self.listed += 1
+        subdirs = []
+        files = []
+        for name, is_dir, is_file in _dir_entries(dirpath):
+            if is_dir:
+                subdirs.append(name)
+            elif is_file and fnmatch.fnmatch(name, self.pattern):
+                try:
+                    st = os.stat(os.path.join(dirpath, name))
+                except OSError:
+                    continue
+                files.append((name, st.st_mtime, st.st_ctime))
+        self.dirs[dirpath] = (mtime, subdirs, files)
+        return subdirs, files
+
+    def save(self):
+        if not self.path:
+            return
+        now = time.time()
+        dirs = dict((dirpath, (mtime if now - mtime > RACY_SECONDS else None, subdirs, files))
+                    for dirpath, (mtime, subdirs, files) in self.dirs.iteritems())
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as out:
+            json.dump({'format': INDEX_FORMAT, 'version': INDEX_VERSION, 'pattern': self.pattern, 'dirs': dirs}, out)
+        os.rename(tmp, self.path)
+
+def find_newest_builds(root, pattern, order='version', count=1, prune=False, index=None):
+    """ Paths of the count best packages matching pattern below root, best first """
+    if order not in ORDERS:
+        raise ValueError('unknown build order: ' + order)
+    if prune and order != 'mtime':
+        # a higher version or an older ctime says nothing about directory mtimes
+        raise ValueError('pruning needs the mtime build order')
+    if index is None:
+        index = BuildsIndex(pattern)
+    root = root.rstrip('/') or '/'
+    try:
+        dirs = [(-os.stat(root).st_mtime, root)]
+    except OSError:
+        return []
+    best = []     # heap of (rank, age, path), worst kept package first
+    while dirs:
+        negMtime, dirpath = heapq.heappop(dirs)
+        mtime = -negMtime
+        if prune and len(best) == count and mtime < min(age for rank, age, path in best):
+            break
+        subdirs, files = index.entries(dirpath, mtime)
+        for name in subdirs:
+            subdir = os.path.join(dirpath, name)
+            try:
+                heapq.heappush(dirs, (-os.stat(subdir).st_mtime, subdir))
+            except OSError:
+                pass
+        for name, fileMtime, fileCtime in files:
+            age = fileCtime if order == 'ctime' else fileMtime
+            if order == 'version':
+                rank = (version_key(name), fileMtime)
+            else:
+                rank = age
+            item = (rank, age, os.path.join(dirpath, name))
+            if len(best) < count:
+                heapq.heappush(best, item)
+            elif item > best[0]:
+                heapq.heapreplace(best, item)
+    return [path for rank, age, path in sorted(best, reverse=True)]
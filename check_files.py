@@ -1,18 +1,28 @@
 #!/usr/bin/env python
 
-import os, glob, sys, re, datetime, subprocess, argparse, hashlib, signal, getpass
+import os, sys, re, datetime, subprocess, argparse, hashlib, signal, getpass, fnmatch, stat, threading, multiprocessing, json, zipfile, StringIO, cProfile, tempfile, traceback, time, heapq, Queue
+from multiprocessing.pool import ThreadPool
+from elf_reader import ElfError, ElfFile, hash_elf_file, diff_elf, short_list
+from ext4_image import Ext4Image, Ext4Error, MAX_SYMLINK_HOPS
+from hash_cache import HashCache, DEFAULT_CACHE_NAME, DEFAULT_MAX_ENTRIES, file_digest
+from image_index import ImageIndex, ImageIndexError, to_bytes
+from path_rules import RuleSet, RuleError
+from tool_runner import ToolRunner, ToolTimeout
+from jar_manifest import parse_manifest, diff_manifests
+import result_sinks
+from result_sinks import FileResult, ResultSink, MismatchSink, JsonLinesSink, JUnitSink, numbered_path
+import chunking
+import comparators
+import profiler
+from profiler import profiled
 
-def DFS(root, skip_symlinks = 1):
-    """Depth first search traversal of directory structure."""
-    stack = [root]
-    visited = {}
-    while stack:
-        d = stack.pop()
-        if d not in visited:  ## just to prevent any possible recursive
-                              ## loops
-            visited[d] = 1
-            yield d
-        stack.extend(subdirs(d, skip_symlinks))
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 def realpath(fname):
 #if realpath utility is available, use it, instead of abspath
@@ -26,37 +36,235 @@ def realpath(fname):
         print 'realpath OSError:', e
     return result
 
-def subdirs(root, skip_symlinks = 1):
-    """Given a root directory, returns the first-level subdirectories."""
+def _dir_entries(path, links=None):
+    """Return (name, is_dir, is_file) for every entry of path.
+
+    Symlinked directories are reported as plain entries so the walk does not
+    follow them. Entries are sorted so that joined paths come out in string
+    order (directories sort as 'name/'). Names of symlinks are appended to
+    the list links when given."""
+    entries = []
     try:
-        dirs = [os.path.join(root, x)
-                for x in os.listdir(root)]
-        dirs = filter(os.path.isdir, dirs)
-        if skip_symlinks:
-            dirs = filter(lambda x: not os.path.islink(x), dirs)
-#        dirs.sort()
-        return dirs
+        if scandir is not None:
+            for entry in scandir(path):
+                is_dir = entry.is_dir(follow_symlinks=False)
+                entries.append((entry.name, is_dir, (not is_dir) and entry.is_file()))
+                if links is not None and entry.is_symlink():
+                    links.append(entry.name)
+        else:
+            for name in os.listdir(path):
+                full = os.path.join(path, name)
+                mode = os.lstat(full).st_mode
+                is_dir = stat.S_ISDIR(mode)
+                if stat.S_ISLNK(mode):
+                    is_file = os.path.isfile(full)
+                    if links is not None:
+                        links.append(name)
+                else:
+                    is_file = stat.S_ISREG(mode)
+                entries.append((name, is_dir, is_file))
     except OSError: return []
     except IOError: return []
+    entries.sort(key=lambda e: e[0] + '/' if e[1] else e[0])
+    return entries
+
+def compile_patterns(pattern_dict):
+    """Turn {glob_pattern: value} into a list of (compiled_regex, hidden_ok, value)."""
+    compiled = []
+    for pattern in sorted(pattern_dict.keys()):
+        compiled.append((re.compile(fnmatch.translate(pattern)), pattern.startswith('.'), pattern_dict[pattern]))
+    return compiled
+
+def match_patterns(name, compiled):
+    """Return value of the first compiled pattern matching name, or None.
+    Like glob, wildcards do not match names starting with a dot."""
+    hidden = name.startswith('.')
+    for regex, hidden_ok, value in compiled:
+        if hidden and not hidden_ok:
+            continue
+        if regex.match(name):
+            return value
+    return None
+
+def scan_tree(root, pattern_dict, list_entries=_dir_entries):
+    """Single-pass walk of root, classifying each file against all patterns.
+
+    Yields (rel_path, value) for every file whose basename matches one of the
+    glob patterns of pattern_dict, value being pattern_dict[pattern]. rel_path
+    starts with '/' and items are yielded in sorted rel_path order.
+    list_entries(path) lists a directory the way _dir_entries() does."""
+    compiled = compile_patterns(pattern_dict)
+    root = root.rstrip('/') or '/'
+    stack = [(root, '/', iter(list_entries(root)))]
+    while stack:
+        dirpath, rel_dir, entries = stack[-1]
+        for name, is_dir, is_file in entries:
+            if is_dir:
+                # descend right away: subdirectory content sorts at this position
+                subdir = os.path.join(dirpath, name)
+                stack.append((subdir, rel_dir + name + '/', iter(list_entries(subdir))))
+                break
+            if is_file:
+                value = match_patterns(name, compiled)
+                if value is not None:
+                    yield rel_dir + name, value
+        else:
+            stack.pop()
+
+class MountedTree(object):
+    """ Files below a directory, with the same interface as ext4_image.Ext4Image.
+    Symlinks resolve within the tree as they do in an Ext4Image: an absolute
+    target starts from the root of the tree, not from the host's. """
+
+    def __init__(self, root):
+        self.root = root.rstrip('/')
+        # {directory path: host path}, symlinks resolved
+        self.dirs = {}
+        # {directory path: names of its symlinks} of directories list_entries() listed,
+        # files found by the walk need no lstat to tell whether they are links
+        self.links = {}
+
+    def resolve(self, path):
+        """ Host path of path with every symlink resolved within the tree, None for a symlink loop """
+        parts = path.split('/')
+        parts.reverse()
+        done = []
+        hops = 0
+        while parts:
+            part = parts.pop()
+            if part in ('', '.'):
+                continue
+            if part == '..':
+                if done:
+                    done.pop()
+                continue
+            current = self.root + '/'.join([''] + done + [part])
+            if os.path.islink(current):
+                hops += 1
+                if hops > MAX_SYMLINK_HOPS:
+                    return None
+                target = os.readlink(current)
+                if target.startswith('/'):
+                    done = []
+                target = target.split('/')
+                target.reverse()
+                parts.extend(target)
+                continue
+            done.append(part)
+        return self.root + '/'.join([''] + done)
+
+    def dirPath(self, path):
+        """ resolve() of a directory, looked up once """
+        hostDir = self.dirs.get(path)
+        if hostDir is None:
+            hostDir = self.dirs[path] = self.resolve(path)
+        return hostDir
+
+    def hostPath(self, path):
+        """ resolve() with the directories of path looked up once """
+        if '/' not in path:
+            return self.resolve(path)
+        head, name = path.rsplit('/', 1)
+        hostDir = self.dirPath(head)
+        if hostDir is None:
+            return None
+        full = hostDir + '/' + name
+        links = self.links.get(head)
+        if name and (name in links if links is not None else os.path.islink(full)):
+            return self.resolve(path)
+        return full
+
+    def list_entries(self, path):
+        links = []
+        path = path.rstrip('/')
+        hostDir = self.dirPath(path)
+        if hostDir is None:
+            return []
+        entries = _dir_entries(hostDir, links)
+        self.links[path] = links = frozenset(links)
+        if links:
+            # the host resolved absolute targets outside the tree
+            prefix = path + '/'
+            entries = [(name, is_dir, self.isfile(prefix + name) if name in links else is_file)
+                       for name, is_dir, is_file in entries]
+        return entries
+
+    def isfile(self, path):
+        full = self.hostPath(path)
+        return full is not None and os.path.isfile(full)
+
+    def getsize(self, path):
+        full = self.hostPath(path)
+        if full is None:
+            raise OSError('too many levels of symbolic links: ' + path)
+        return os.path.getsize(full)
+
+    def open(self, path):
+        full = self.hostPath(path)
+        if full is None:
+            raise IOError('too many levels of symbolic links: ' + path)
+        return open(full, 'rb')
+
+    def realpath(self, path):
+        return self.hostPath(path)
+
+    def close(self):
+        pass
+
+def scan_fs_tree(tree, pattern_dict):
+    """ scan_tree() over a MountedTree or Ext4Image """
+    return scan_tree('/', pattern_dict, tree.list_entries)
+
+# where merge_trees() found a rel_path
+IN_BOTH = 'both'
+EXT_ONLY = 'ext'
+LOCAL_ONLY = 'local'
+
+def merge_trees(ext_items, local_items):
+    """ Merge two streams of (rel_path, value) sorted by rel_path, such as
+    scan_tree() output, into (rel_path, value, where) in one sweep.
+    The ext value is kept for paths found in both. """
+    ext_items = iter(ext_items)
+    local_items = iter(local_items)
+    ext = next(ext_items, None)
+    local = next(local_items, None)
+    while ext is not None or local is not None:
+        if local is None or (ext is not None and ext[0] < local[0]):
+            yield ext[0], ext[1], EXT_ONLY
+            ext = next(ext_items, None)
+        elif ext is None or local[0] < ext[0]:
+            yield local[0], local[1], LOCAL_ONLY
+            local = next(local_items, None)
+        else:
+            yield ext[0], ext[1], IN_BOTH
+            ext = next(ext_items, None)
+            local = next(local_items, None)
 
+@profiled('walk')
 def linux_like_find(root, pattern):
-    files = []
-    for subdir in DFS(root):
-        files += glob.glob(os.path.join (subdir, pattern))
-        files.sort()
-    return files
-
-def file_in_list (rel_path, local_list):
-    """finding file in list"""
-    for local_file in local_list :
-        if local_file.endswith(rel_path):
-            return True
-    return False
+    """Return sorted list of paths under root whose basename matches pattern."""
+    root = root.rstrip('/')
+    return [root + rel_path for rel_path, _ in scan_tree(root, {pattern: True})]
 
-def readelfCmd(path):
+ALLOWED_MISSING_FILE = 'allowed-missing-files'
+
+def load_rules(path):
+    """ RuleSet from the rules file at path, no rules if it cannot be read.
+    Raises RuleError for malformed rules. """
+    try:
+        return RuleSet.load(path)
+    except IOError:
+        print WARNING_COLOR + "Something went wrong when tried to read shared object files list difference" + END_COLOR
+        return RuleSet()
+
+# sections compared for shared objects unless --elf-sections says otherwise
+ELF_SECTIONS = ['.text']
+
+def readelfCmd(path, sections=None):
     """ Generate command list from file path """
     #sections = ['.nonexisting']
-    sections = ['.text']
+    if sections is None:
+        sections = ELF_SECTIONS
 
     command = [('-x' + i) for i in sections] # add -x to each section for hex-dump
     command.insert(0, 'readelf')             # add 'readelf' command
@@ -67,19 +275,19 @@ def readelfCmd(path):
 def hashFromFileOrProc(inpobj, hashfunc, blocksize=65356):
     typename = type(inpobj).__name__
 
-    if typename == 'file': buf = inpobj.read(blocksize)
-    elif typename == 'Popen': buf = inpobj.stdout.read(blocksize)
+    if typename == 'Popen': stream = inpobj.stdout
+    elif hasattr(inpobj, 'read'): stream = inpobj # file or zip member
     else:
         print FAIL_COLOR + 'hashFromFile(): Wrong input object! need file or Popen' + END_COLOR
         return
+    buf = stream.read(blocksize)
 
     if len(buf) == 0:
         print WARNING_COLOR + 'hashFromFile(): empty input!' + END_COLOR
 
     while len(buf) > 0:
         hashfunc.update(buf)
-        if typename == 'file': buf = inpobj.read(blocksize)
-        else: buf = inpobj.stdout.read(blocksize)
+        buf = stream.read(blocksize)
     return hashfunc.hexdigest()
 
 #def md5_hashlib_v1(cmd):
@@ -109,22 +317,178 @@ def hashFromFileOrProc(inpobj, hashfunc, blocksize=65356):
 
 """Check files existance at both mountpoints and than call to compare function"""
 
+# every external tool is started through this runner, see add_tool_arguments()
+TOOLS = ToolRunner()
+
+@profiled('mount')
 def mount_loop(AbsImgPath, MountPoint):
-    cmd = ['sudo','mount', '-o', 'loop', AbsImgPath, MountPoint]
+    cmd = ['sudo','mount', '-o', 'loop,ro', AbsImgPath, MountPoint]
     print ' '.join(cmd)
-    return subprocess.check_call(cmd, shell=False)
+    # sudo may ask for a password
+    return TOOLS.check_call(cmd, timeout=None)
 
 def signal_handler(signum, frame):
-    global tester
-    try:
-        if tester:
-            del tester
-#Print termination message instead off falling to NameError exception for non-existing object in corner case of early script termination.
-    except NameError:
-        pass
+    # stop and reap external tools right away, mountpoints are released when
+    # SystemExit unwinds run() and main() drops the comparator
+    TOOLS.stop()
     exitstr = 'Exiting on signal: ' + str(signum)
     sys.exit(exitstr)
 
+MANIFEST_NAME = 'META-INF/MANIFEST.MF'
+# hash cache and index kind of parse_manifest() output, see jar_manifest.py
+MANIFEST_KIND = 'manifest-digests'
+DEX_NAME_RE = re.compile(r'^classes(\d*)\.dex$')
+
+def dex_members(archive):
+    """ classes.dex, classes2.dex, ... of a ZipFile in multidex order """
+    numbered = []
+    for name in archive.NameToInfo:
+        match = DEX_NAME_RE.match(name)
+        if match:
+            numbered.append((int(match.group(1) or 1), name))
+    return [name for _, name in sorted(numbered)]
+
+def archive_crcs(archive):
+    """ {name: CRC32} of every file entry in a ZipFile's central directory """
+    return dict((info.filename, info.CRC) for info in archive.infolist() if not info.filename.endswith('/'))
+
+def decode_manifest(text):
+    """ Inverse of json.dumps() for parse_manifest() output, keeping byte strings """
+    return to_bytes(json.loads(text))
+
+# tier 0 sha1 throughput assumed by AFSImageComparator.estimatedCost()
+SHA1_BYTES_PER_SECOND = 400e6
+
+# items lpt_imap() picks the longest from; bounds memory, whatever the number of items
+LPT_WINDOW = 1024
+
+class ThreadOutput(object):
+    """ sys.stdout replacement: what a thread prints inside capture() goes to
+    a buffer of its own, everything else to stream """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, data):
+        buf = getattr(self.local, 'buffer', None)
+        (buf if buf is not None else self.stream).write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    # print keeps its pending space in softspace, which must not leak between threads
+    @property
+    def softspace(self):
+        return getattr(self.local, 'softspace', 0)
+
+    @softspace.setter
+    def softspace(self, value):
+        self.local.softspace = value
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def capture(self, func):
+        """ (func(), what it printed) """
+        self.local.buffer = StringIO.StringIO()
+        try:
+            result = func()
+        finally:
+            text = self.local.buffer.getvalue()
+            self.local.buffer = None
+        return result, text
+
+def lpt_imap(pool, func, items, cost, workers, window=LPT_WINDOW, poll_interval=0.5):
+    """ pool.imap(func, items) scheduled longest estimated cost(item) first among the
+    next window items, so that a large file does not start last and leave one worker
+    busy at the end. Results are still yielded in items order, as soon as all earlier
+    ones are done. At most window items are held, and 2 * workers are in the pool. """
+    done_queue = Queue.Queue()
+    def call(index, item):
+        try:
+            done_queue.put((index, True, func(item)))
+        except BaseException:
+            done_queue.put((index, False, sys.exc_info()))
+    source = iter(items)
+    exhausted = False
+    waiting = []    # heap of (-cost, index, item) not submitted yet
+    done = {}
+    admitted = 0
+    next_index = 0
+    running = 0
+    while True:
+        while not exhausted and admitted - next_index < window:
+            try:
+                item = source.next()
+            except StopIteration:
+                exhausted = True
+                break
+            heapq.heappush(waiting, (-cost(item), admitted, item))
+            admitted += 1
+        while waiting and running < 2 * workers:
+            negCost, index, item = heapq.heappop(waiting)
+            pool.apply_async(call, (index, item))
+            running += 1
+        if exhausted and next_index == admitted:
+            return
+        # with a timeout, so that signal handlers still run in the main thread
+        try:
+            index, ok, result = done_queue.get(True, poll_interval)
+        except Queue.Empty:
+            continue
+        running -= 1
+        if not ok:
+            raise result[0], result[1], result[2]
+        done[index] = result
+        while next_index in done:
+            yield done.pop(next_index)
+            next_index += 1
+
+class ArchiveMembersReader(object):
+    """ Read-only file over members of a zip archive, one after the other """
+
+    def __init__(self, fileobj, names):
+        self.fileobj = fileobj
+        self.archive = zipfile.ZipFile(fileobj)
+        self.names = list(names)
+        self.member = None
+
+    def read(self, size):
+        while True:
+            if self.member is None:
+                if not self.names:
+                    return ''
+                self.member = self.archive.open(self.names.pop(0))
+            data = self.member.read(size)
+            if data:
+                return data
+            self.member.close()
+            self.member = None
+
+    def close(self):
+        if self.member is not None:
+            self.member.close()
+        self.archive.close()
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def ordered_results(iterator, poll_interval=0.5):
+    """Yield results of ThreadPool.imap() in submission order.
+    Waits with a timeout so that signal handlers still run in the main thread."""
+    while True:
+        try:
+            yield iterator.next(poll_interval)
+        except multiprocessing.TimeoutError:
+            continue
+        except StopIteration:
+            return
+
 if sys.stdout.isatty():
     # output to console
     WARNING_COLOR = '\033[93m'
@@ -140,35 +504,105 @@ else:
 
 class AFSImageComparator:
 
-    # file_check() result codes
-    FILE_SAME = 0
-    FILE_DIFF = 1
-    FILE_MISS = 2
-    FILE_MISS_ALLOWED = 3
+    # file_check() result codes, see result_sinks.py
+    FILE_SAME = result_sinks.FILE_SAME
+    FILE_DIFF = result_sinks.FILE_DIFF
+    FILE_MISS = result_sinks.FILE_MISS
+    FILE_MISS_ALLOWED = result_sinks.FILE_MISS_ALLOWED
+    FILE_EXTRA = result_sinks.FILE_EXTRA
+
+    # comparison tiers counted in tierStats, FileResult.tier is the index in TIERS
+    TIER_IDENTICAL = 'tier 0 (size + sha1, identical)'
+    TIER_SEMANTIC = 'tier 1 (semantic comparator)'
+    TIERS = (TIER_IDENTICAL, TIER_SEMANTIC)
 
     #compare_manifests() result codes
     MF_SAME = 1
     MF_DIFF = 0
     MF_NULL = -1
 
-    def file_check(self, rel_path, local_mountpoint, ext_mountpoint, check_function, allowed_missings_list):
-        local_filepath = re.sub('//', '/',local_mountpoint + rel_path)
-        ext_filepath = re.sub('//', '/',ext_mountpoint + rel_path)
-        if not os.path.isfile(local_filepath):
+    @profiled('file', 1)
+    def file_check(self, rel_path, local_mountpoint, ext_mountpoint, check_function, allowed_missings_list, result=None,
+                   local_exists=None):
+        """ Result code of rel_path; sizes, hashes and tier go to the FileResult result when given.
+        The local file is looked up unless local_exists tells whether it is there. """
+        local_filepath = local_mountpoint.rstrip('/') + rel_path
+        ext_filepath = ext_mountpoint.rstrip('/') + rel_path
+        if local_exists is None:
+            local_exists = self.isFile(local_filepath)
+        if not local_exists:
             if (rel_path in allowed_missings_list):
                 return AFSImageComparator.FILE_MISS_ALLOWED
             else:
                 return AFSImageComparator.FILE_MISS
+        if self.identicalFiles(local_filepath, ext_filepath, result):
+            self.countTier(AFSImageComparator.TIER_IDENTICAL, result)
+            return AFSImageComparator.FILE_SAME
+        self.countTier(AFSImageComparator.TIER_SEMANTIC, result)
         if check_function(self, local_filepath, ext_filepath) is True:
             return AFSImageComparator.FILE_SAME
         else:
+            if self.chunkDiff:
+                self.print_chunk_diff(local_filepath, ext_filepath, check_function)
             return AFSImageComparator.FILE_DIFF
 
+    def countTier(self, tier, result=None):
+        with self.statsLock:
+            self.tierStats[tier] = self.tierStats.get(tier, 0) + 1
+        if result is not None:
+            result.tier = AFSImageComparator.TIERS.index(tier)
+
+    def treePath(self, path):
+        """ (tree, path within tree) for paths below a mounted or image-backed root """
+        for prefix, tree in self.trees:
+            if path.startswith(prefix):
+                return tree, path[len(prefix) - 1:]
+        return None, path
+
+    def openFile(self, path):
+        tree, tree_path = self.treePath(path)
+        if tree is None:
+            return open(path, 'rb')
+        return tree.open(tree_path)
+
+    def isFile(self, path):
+        tree, tree_path = self.treePath(path)
+        if tree is None:
+            return os.path.isfile(path)
+        return tree.isfile(tree_path)
+
+    def realPath(self, path):
+        """ Host filesystem path for external tools, None for files inside an unmounted image """
+        tree, tree_path = self.treePath(path)
+        if tree is None:
+            return path
+        return tree.realpath(tree_path)
+
+    def fileSize(self, path):
+        if self.isIndexed(path):
+            return self.extIndex.get(path[len(self.extMountpointPath) - 1:])[1]
+        tree, tree_path = self.treePath(path)
+        if tree is None:
+            return os.path.getsize(path)
+        return tree.getsize(tree_path)
+
+    @profiled('tier0', 1)
+    def identicalFiles(self, path1, path2, result=None):
+        """ Cheap tier 0 check: same size and same sha1 of the whole file """
+        if result is None:
+            result = FileResult(None)
+        result.local_size = self.fileSize(path1)
+        result.ext_size = self.fileSize(path2)
+        if result.local_size != result.ext_size:
+            return False
+        result.local_sha1 = sum1 = self.cachedValue(path1, 'sha1', lambda: self.hashOfFile(path1))
+        result.ext_sha1 = sum2 = self.cachedValue(path2, 'sha1', lambda: self.hashOfFile(path2))
+        return (sum1 is not None) and (sum1 == sum2)
+
     # Deprecated method
     def md5_hashlib(self, cmd):
-        """ Execute cmd and return MD5 of it's output using hashlib.md5 for communicate() result """
-        self.gReadelfProc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        pout, perr = self.gReadelfProc.communicate()
+        """ Execute cmd and return MD5 of it's output using hashlib.md5 for the whole output """
+        pout, perr, code = TOOLS.run(cmd, lambda out: out.read())
         ret = hashlib.md5(pout).hexdigest()
         if (pout == ''):
             print WARNING_COLOR + '\"' + ' '.join(cmd) + '\" empty stdout' + END_COLOR
@@ -178,138 +612,383 @@ class AFSImageComparator:
         return ret
 
     def hashOfCmd(self, cmd):
-        """ Execute cmd and return hash of it's output using one of hashlib functions """
-        self.gReadelfProc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        ret = hashFromFileOrProc(self.gReadelfProc, hashlib.sha1()) # we can define here which of hashlib.algorithms to use
-        err = self.gReadelfProc.stderr.read()
-
-        self.gReadelfProc.stdout.close()
-        self.gReadelfProc.stderr.close()
+        """ Execute cmd and return hash of it's output using one of hashlib functions, None on timeout """
+        with profiler.phase(os.path.basename(cmd[0]), profiler.file_type(cmd[-1])):
+            try:
+                # we can define here which of hashlib.algorithms to use
+                ret, err, code = TOOLS.run(cmd, lambda out: hashFromFileOrProc(out, hashlib.sha1()))
+            except ToolTimeout, e:
+                print WARNING_COLOR + str(e) + END_COLOR
+                return None
 
         if len(err) > 0:
             print WARNING_COLOR + ' '.join(cmd) + ' : ' + err + END_COLOR
 
         return ret
 
+    def terminate_children(self):
+        """ Terminate and reap every external tool that is still running """
+        TOOLS.terminate_all()
+
+    @profiled('umount')
     def umount_loop(self, MountPoint):
         try:
-            if self.gReadelfProc:
-                if (self.gReadelfProc.poll() is None):
-                    self.gReadelfProc.terminate()
-            subprocess.check_call(['sudo','umount', MountPoint])
+            self.terminate_children()
+            TOOLS.check_call(['sudo','umount', MountPoint], timeout=None)
         except subprocess.CalledProcessError, e:
             print 'umount exited with code:', e.returncode, 'see lsof output:'
-            subprocess.call(['lsof', MountPoint])
+            TOOLS.run(['lsof', MountPoint])
+
+    def cachedValue(self, path, kind, compute, encode=str, decode=str):
+        """ Return compute() for the file at path, going through the hash cache
+        when the file lives on the reference (ext) image """
+        if (self.extMountpointPath is None) or (not path.startswith(self.extMountpointPath)):
+            return compute()
+        rel_path = path[len(self.extMountpointPath) - 1:]
+        if self.extIndex is not None:
+            # there is no ext mountpoint to compute anything from
+            return self.extIndex.value(rel_path, kind)
+        if (self.hashCache is None) or (self.extImageKey is None):
+            return compute()
+        value = self.hashCache.get(self.extImageKey, rel_path, kind)
+        if value is not None:
+            return decode(value)
+        value = compute()
+        if value is not None:
+            self.hashCache.put(self.extImageKey, rel_path, kind, encode(value))
+        return value
+
+    @profiled('elf', 1, size=lambda self, path: self.fileSize(path))
+    def hashOfElfSections(self, path, sections=None):
+        """ Hash raw bytes of sections (default: self.elfSections), None if path is not a readable ELF file """
+        try:
+            with self.openFile(path) as elf_file:
+                return hash_elf_file(elf_file, sections or self.elfSections, hashlib.sha1())
+        except (ElfError, Ext4Error, IOError, OSError):
+            return None
 
     def compare_shared_object(self, file1, file2):
         """ Compare hash for shared object files """
-        cmd1 = readelfCmd(file1)
-        cmd2 = readelfCmd(file2)
+        kind = 'elf:' + ','.join(self.elfSections)
+        sum1 = self.cachedValue(file1, kind, lambda: self.hashOfElfSections(file1))
+        sum2 = self.cachedValue(file2, kind, lambda: self.hashOfElfSections(file2))
 
-        sum1 = self.hashOfCmd(cmd1)
-        sum2 = self.hashOfCmd(cmd2)
+        if (sum1 is None) or (sum2 is None):
+            # not parsable in-process, let readelf have a say
+            real1, real2 = self.realPath(file1), self.realPath(file2)
+            if (real1 is None) or (real2 is None):
+                # no readelf for files inside an unmounted image, they already differ as a whole
+                return False
+            sum1 = self.hashOfCmd(readelfCmd(real1, self.elfSections))
+            sum2 = self.hashOfCmd(readelfCmd(real2, self.elfSections))
+            if (sum1 is None) or (sum2 is None):
+                return False
 
         if (sum1 == sum2):
             #print 'hash OK: ' + sum1
             return True
         else:
             #print FAIL_COLOR + file1 + ' ' + sum1 + '\n' + file2 + ' ' + sum2 + END_COLOR
+            if self.elfDiff:
+                self.print_elf_diff(file1, file2)
             return False
 
-    def del_tmp_dir(self, path):
-        if os.path.isdir(path):
-            subprocess.call(['rm','-rf',str(path)], shell=False)
+    def print_elf_diff(self, file1, file2):
+        """ Which blocks and symbols of self.elfSections differ, for triage """
+        if self.isIndexed(file1) or self.isIndexed(file2):
+            print '\nno ELF diff against an image index'
+            return
+        try:
+            with self.openFile(file1) as inp1:
+                with self.openFile(file2) as inp2:
+                    with ElfFile(inp1) as elf1:
+                        with ElfFile(inp2) as elf2:
+                            lines = diff_elf(elf1, elf2, self.elfSections)
+        except (ElfError, Ext4Error, IOError, OSError), e:
+            print '\nno ELF diff: ' + str(e)
+            return
+        if lines:
+            print '\n' + '\n'.join(lines)
+
+    def isIndexed(self, path):
+        """ True for ext paths that only exist in self.extIndex """
+        return (self.extIndex is not None) and path.startswith(self.extMountpointPath)
 
-    def unzip (self,src,dst):
-        if not os.path.isfile(src):
-            print 'no such file: '+src
+    def archiveManifest(self, archive):
+        """ Parsed META-INF/MANIFEST.MF of an open ZipFile """
+        if MANIFEST_NAME not in archive.NameToInfo:
+            return {}
+        return self.parse_manifest_data(archive.read(MANIFEST_NAME))
+
+    @profiled('dex')
+    def archiveDexHash(self, archive):
+        """ sha1 over classes.dex, classes2.dex, ... streamed from an open ZipFile, None without dex """
+        names = dex_members(archive)
+        if not names:
+            return None
+        hashfunc = hashlib.sha1()
+        for name in names:
+            member = archive.open(name)
+            try:
+                hashFromFileOrProc(member, hashfunc)
+            finally:
+                member.close()
+        return hashfunc.hexdigest()
+
+    def archiveDexHashOf(self, path):
+        try:
+            with self.openDexStream(path) as dex:
+                if not dex.names:
+                    return None
+                return hashFromFileOrProc(dex, hashlib.sha1())
+        except (zipfile.BadZipfile, zipfile.LargeZipFile, Ext4Error, IOError):
+            return None
+
+    def openDexStream(self, path):
+        """ classes.dex, classes2.dex, ... of the archive at path as one stream """
+        fileobj = self.openFile(path)
+        try:
+            archive = zipfile.ZipFile(fileobj)
+            names = dex_members(archive)
+            archive.close()
+            return ArchiveMembersReader(fileobj, names)
+        except:
+            fileobj.close()
+            raise
+
+    def chunksKind(self, comparator):
+        """ Image index key of chunk lists made for comparator """
+        return 'chunks:%s:%s' % (comparator.chunkKind, chunking.CHUNK_KIND)
+
+    def fileChunks(self, path, comparator):
+        """ Content-defined chunks of what comparator.open_chunked() reads from path, None if unknown.
+        Chunk lists are kept in the hash cache by content digest, so content seen in
+        any file of any image is chunked only once. """
+        kind = self.chunksKind(comparator)
+        if self.isIndexed(path):
+            value = self.extIndex.value(path[len(self.extMountpointPath) - 1:], kind)
+            return None if value is None else chunking.decode_chunks(value)
+        key = comparator.content_key(self, path)
+        if key is None:
+            return None
+        if self.hashCache is not None:
+            value = self.hashCache.get(chunking.CHUNK_STORE, key, chunking.CHUNK_KIND)
+            if value is not None:
+                return chunking.decode_chunks(value)
+        try:
+            with comparator.open_chunked(self, path) as content:
+                chunks = list(chunking.chunk_stream(content))
+        except (zipfile.BadZipfile, zipfile.LargeZipFile, Ext4Error, IOError, OSError):
+            return None
+        if self.hashCache is not None:
+            self.hashCache.put(chunking.CHUNK_STORE, key, chunking.CHUNK_KIND, chunking.encode_chunks(chunks))
+        return chunks
+
+    def print_chunk_diff(self, local_filepath, ext_filepath, comparator):
+        """ Byte ranges of the local file whose content is not found in the ext file,
+        nothing when both are smaller than chunking.MIN_FILE_SIZE """
+        if max(self.fileSize(local_filepath), self.fileSize(ext_filepath)) < chunking.MIN_FILE_SIZE:
             return
-        os.mkdir(dst)
-        with open(os.devnull, 'w') as dev_null:
-            subprocess.call(["unzip", src, "-d", dst], stdout = dev_null)
+        local_chunks = self.fileChunks(local_filepath, comparator)
+        ext_chunks = self.fileChunks(ext_filepath, comparator)
+        if local_chunks is None or ext_chunks is None:
+            print '\nno chunk diff for ' + comparator.chunkKind + ' content'
+            return
+        ranges = chunking.changed_ranges(local_chunks, ext_chunks)
+        changed = sum(length for offset, length in ranges)
+        total = sum(length for length, digest in local_chunks)
+        what = 'dex' if comparator.chunkKind == 'dex' else 'file'
+        print '\nchanged %s bytes: %d of %d in %d ranges%s' % (what, changed, total, len(ranges),
+            (': ' + short_list('0x%x-0x%x' % (offset, offset + length - 1) for offset, length in ranges)) if ranges else '')
 
+    @profiled('unzip', 1, size=lambda self, refer_ext, refer_loc: self.fileSize(refer_ext) + self.fileSize(refer_loc))
     def are_apk_same(self, refer_ext, refer_loc):
-        """directly parser for *.apk and *.jar files (unpack to dex)"""
-        root_dir = os.path.dirname(refer_loc)
-        apk_dir=str(self.tmpDirComparison)+str(re.sub('\..*^','',os.path.basename(refer_loc)))+'/'
-        self.del_tmp_dir(apk_dir)
-        os.mkdir(apk_dir)
-        locDir = apk_dir+'/loc/'
-        extDir = apk_dir+'/ext/'
-        self.unzip(refer_loc,locDir)
-        self.unzip(refer_ext,extDir)
-        cmp_result = self.compare_manifests(locDir + '/META-INF/MANIFEST.MF', extDir + '/META-INF/MANIFEST.MF')
-        if cmp_result == AFSImageComparator.MF_DIFF :
+        """directly parser for *.apk and *.jar files, entries are read in-process"""
+        archives = {}
+        def archive(path):
+            """ ZipFile for path, opened on first use only """
+            if path not in archives:
+                fileobj = self.openFile(path)
+                archives[path] = (zipfile.ZipFile(fileobj), fileobj)
+            return archives[path][0]
+        try:
+            if not (self.isIndexed(refer_loc) or self.isIndexed(refer_ext)):
+                # equal central directories (names and CRC32s) mean equal content
+                if archive_crcs(archive(refer_loc)) == archive_crcs(archive(refer_ext)):
+                    return True
+            manifest_loc = self.cachedValue(refer_loc, MANIFEST_KIND, lambda: self.archiveManifest(archive(refer_loc)),
+                                            json.dumps, decode_manifest)
+            manifest_ext = self.cachedValue(refer_ext, MANIFEST_KIND, lambda: self.archiveManifest(archive(refer_ext)),
+                                            json.dumps, decode_manifest)
+            cmp_result = self.compare_manifest_dicts(manifest_loc, manifest_ext)
+            if cmp_result == AFSImageComparator.MF_DIFF :
+                return False
+            elif cmp_result == AFSImageComparator.MF_NULL:
+                #maybe manifests are NULL,thus try to take md5 directly
+                hash_loc = self.cachedValue(refer_loc, 'dex', lambda: self.archiveDexHash(archive(refer_loc)))
+                if hash_loc is None:
+                    return False #workaround. We have to discuss how to parse if no classes.dex and manifest.ml is empty
+                hash_ext = self.cachedValue(refer_ext, 'dex', lambda: self.archiveDexHash(archive(refer_ext)))
+                return self.compare_class_hashes(hash_loc, hash_ext)
+            else:
+                return True
+        except (zipfile.BadZipfile, zipfile.LargeZipFile, Ext4Error, IOError), e:
+            print WARNING_COLOR + 'cannot read archive: ' + str(e) + END_COLOR
             return False
-        elif cmp_result == AFSImageComparator.MF_NULL:
-            #maybe manifests are NULL,thus try to take md5 directly
-            return self.compare_classes(locDir + '/classes.dex', extDir + '/classes.dex')
-        else:
-            self.del_tmp_dir(apk_dir)
-            return True
+        finally:
+            for opened, fileobj in archives.values():
+                opened.close()
+                fileobj.close()
+
+    @profiled('sha1', 1, size=lambda self, path: self.fileSize(path))
+    def hashOfFile(self, path):
+        """ sha1 of file contents, None if there is no such file """
+        try:
+            # no isFile() first: file_check() already knows the file is there
+            inp = self.openFile(path)
+        except (IOError, OSError):
+            return None
+        with inp:
+            return hashFromFileOrProc(inp, hashlib.sha1())
 
     def compare_classes(self,locPath,extPath):
-        if not os.path.isfile(str(locPath)):
+        hash_loc = self.hashOfFile(locPath)
+        if hash_loc is None:
             return False #workaround. We have to discuss how to parse if no classes.dex and manifest.ml is empty
+        return self.compare_class_hashes(hash_loc, self.hashOfFile(extPath))
+
+    def compare_class_hashes(self, class_hash_loc, class_hash_ext):
+        if (class_hash_loc==class_hash_ext):
+            return True
         else:
-            with open (locPath) as class_loc:
-                class_hash_loc = hashFromFileOrProc(class_loc,hashlib.sha1())
-            with open (extPath) as class_ext:
-                class_hash_ext = hashFromFileOrProc(class_ext,hashlib.sha1())
-            if (class_hash_loc==class_hash_ext):
-                return True
-            else:
-                print '\nManifest is null. classes.dex hashsums are different.'
-                return False
+            print '\nManifest is null. classes.dex hashsums are different.'
+            return False
 
     def parse_manifest(self,pathMF):
-        manifestMF={}
+        if not os.path.isfile(pathMF):
+            return {}
         with open(pathMF,'r') as fileMF:
-            lineMF = str(fileMF.readline())
-            while (lineMF):
-                lineMF = str(fileMF.readline())
-                if (lineMF.startswith('Name')):
-                    # skipping binary manifests.xml workaround
-                    if (lineMF.endswith('AndroidManifest.xml\r\n')):
-                        continue
-                    lineMF_sha = str(fileMF.readline())
-                    if (lineMF_sha.startswith('SHA1-Digest')):
-                        manifestMF[lineMF[6:]] = lineMF_sha[13:]
-        return manifestMF
+            return self.parse_manifest_data(fileMF.read())
+
+    @profiled('manifest', size=lambda self, dataMF: len(dataMF))
+    def parse_manifest_data(self, dataMF):
+        return parse_manifest(dataMF)
 
     def compare_manifests(self,locPath,extPath):
-        manifest_loc = self.parse_manifest(locPath)
-        manifest_ext = self.parse_manifest(extPath)
+        return self.compare_manifest_dicts(self.parse_manifest(locPath), self.parse_manifest(extPath))
+
+    def compare_manifest_dicts(self, manifest_loc, manifest_ext):
+        """ MF_SAME, MF_DIFF, or MF_NULL when neither archive has manifest digests.
+        Every entry only in one of them or with other digests is printed. """
         #maybe manifests are NULL,thus try to take md5 directly
         if not manifest_loc and not manifest_ext:
             return AFSImageComparator.MF_NULL
-        for cheking_path in manifest_ext.keys():
-            if not cheking_path in manifest_loc:
-                print ('\nno such path: ' + cheking_path).rstrip()
-                #print 'No such Attribute: '+ FAIL_COLOR +'Different sources, at least '+ END_COLOR, locDir+cheking_path
-                return AFSImageComparator.MF_DIFF
-            if (manifest_ext[cheking_path] == manifest_loc[cheking_path]):
-                pass
-            else:
-                print ('\ndifference in: ' + cheking_path).rstrip()
-                #print FAIL_COLOR +'Different sources hash '+ END_COLOR, locDir+cheking_path
-                return AFSImageComparator.MF_DIFF
-        #print locDir, 'Sources hash ore OK'
-
-    def cmp_and_process_java(self, ext_shared_objects,loc_shared_objects):
-        p_ext = subprocess.Popen(['md5sum',ext_shared_objects], stdout=subprocess.PIPE)
-        out_ext=p_ext.communicate()[0]
-        p_loc = subprocess.Popen(['md5sum',loc_shared_objects], stdout=subprocess.PIPE)
-        out_loc=p_loc.communicate()[0]
-        if (out_ext[:33]==out_loc[:33]):
-            #print "archives are OK"
-            return True
+        only_loc, only_ext, changed = diff_manifests(manifest_ext, manifest_loc)
+        if only_ext:
+            print '\nno such path: ' + short_list(only_ext)
+        if only_loc:
+            print '\nnot in ext: ' + short_list(only_loc)
+        if changed:
+            print '\ndifference in: ' + short_list(changed)
+        if only_ext or only_loc or changed:
+            return AFSImageComparator.MF_DIFF
+        return AFSImageComparator.MF_SAME
+
+    def fingerprint_shared_object(self, path):
+        kind = 'elf:' + ','.join(self.elfSections)
+        return { kind: self.cachedValue(path, kind, lambda: self.hashOfElfSections(path)) }
+
+    def fingerprint_java(self, path):
+        values = {}
+        fileobj = self.openFile(path)
+        archive = zipfile.ZipFile(fileobj)
+        try:
+            values[MANIFEST_KIND] = self.cachedValue(path, MANIFEST_KIND, lambda: self.archiveManifest(archive),
+                                                  json.dumps, decode_manifest)
+            values['dex'] = self.cachedValue(path, 'dex', lambda: self.archiveDexHash(archive))
+        finally:
+            archive.close()
+            fileobj.close()
+        return values
+
+    def build_index(self, chunks=False):
+        """ Fingerprint every file of the ext image matched by a registered comparator.
+        With chunks, content-defined chunk lists for --chunk-diff are added to files
+        of at least chunking.MIN_FILE_SIZE bytes. """
+        if self.extMountpointPath is None or self.extIndex is not None:
+            print FAIL_COLOR + "No mounted ext image to index!" + END_COLOR
+            return None
+        index = ImageIndex(self.extImageKey or file_digest(self.extImgPath), self.elfSections)
+        def fingerprint_item(item):
+            rel_path, pattern = item
+            path = self.extMountpointPath + rel_path[1:]
+            comparator = self.comparatorPatterns()[pattern]
+            values = comparator.fingerprint(self, path)
+            values['sha1'] = self.cachedValue(path, 'sha1', lambda: self.hashOfFile(path))
+            size = self.fileSize(path)
+            if chunks and size >= chunking.MIN_FILE_SIZE:
+                fileChunks = self.fileChunks(path, comparator)
+                if fileChunks is not None:
+                    values[self.chunksKind(comparator)] = chunking.encode_chunks(fileChunks)
+            return rel_path, pattern, size, values
+        patterns = dict((pattern, pattern) for pattern in self.comparatorPatterns())
+        work_items = profiler.profiled_iter('walk', scan_fs_tree(self.extTree, patterns))
+        pool = None
+        if self.jobs > 1:
+            pool = ThreadPool(self.jobs)
+            results = lpt_imap(pool, fingerprint_item, work_items,
+                               lambda (rel_path, pattern): self.estimatedCost(rel_path, self.comparatorPatterns()[pattern]),
+                               self.jobs)
+        else:
+            results = (fingerprint_item(item) for item in work_items)
+        try:
+            for rel_path, pattern, size, values in results:
+                index.add(rel_path, pattern, size, values)
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+            self.terminate_children()
+        return index
+
+    def attach(self, img, name, readImages):
+        """ Make img available below a new root in the work dir: loop-mounted,
+        or read in-process by Ext4Image when readImages is set """
+        if readImages:
+            # never created, only used as prefix of paths looked up in the image
+            root = self.workDirPath + name + '_img/'
+            tree = Ext4Image(img)
         else:
-            return self.are_apk_same(ext_shared_objects,loc_shared_objects)
+            root = self.workDirPath + name + '_root/'
+            os.mkdir(root)
+            mount_loop(img, root)
+            self.mounts.append(root)
+            tree = MountedTree(root)
+        self.trees.append((root, tree))
+        return root, tree
 
-    def __init__(self, localImg, extImg, rootDirPath):
-        self.gReadelfProc = None
+    def __init__(self, localImg, extImg, rootDirPath, jobs=1, hashCache=None, extIndex=None, readImages=False, rules=None,
+                 elfSections=None, elfDiff=False, chunkDiff=False):
+        self.jobs = max(1, jobs or 1)
+        self.elfSections = list(elfSections or ELF_SECTIONS)
+        # print changed blocks and symbols of shared objects that differ
+        self.elfDiff = elfDiff
+        # print changed byte ranges of files that differ, see chunking.py
+        self.chunkDiff = chunkDiff
+        self.hashCache = hashCache
+        self.extImageKey = None
+        self.extIndex = extIndex
+        self.tierStats = {}
+        self.statsLock = threading.Lock()
+        # RuleSet, loaded from ALLOWED_MISSING_FILE by run() when not given
+        self.rules = rules
+        self.ignoredFiles = 0
+        self.extImgPath = None
+        self.mounts = []
+        self.trees = []
+        self.extTree = None
         self.localMountpointPath = None
+        self.localTree = None
         self.extMountpointPath = None
 
         if (rootDirPath is None) or (not rootDirPath):
@@ -324,88 +1003,552 @@ class AFSImageComparator:
                 print badWorkDirMsg
                 return ()
             os.mkdir(self.workDirPath)
-            self.tmpDirComparison = self.workDirPath + 'jar_apk_cmp/'
-            os.mkdir(self.tmpDirComparison)
 
-            if (not localImg) or (not extImg) or (localImg is None) or (extImg is None):
-                self.localMountpointPath = None
-                self.extMountpointPath = None
-            else:
-                self.localMountpointPath = self.workDirPath + 'local_root/'
-                self.extMountpointPath = self.workDirPath + 'ext_root/'
-                os.mkdir(self.localMountpointPath)
-                os.mkdir(self.extMountpointPath)
-                mount_loop(localImg, self.localMountpointPath)
-                mount_loop(extImg, self.extMountpointPath)
+            if localImg:
+                self.localMountpointPath, self.localTree = self.attach(localImg, 'local', readImages)
+            if extIndex is not None:
+                # never created, only used as prefix of ext paths looked up in extIndex
+                self.extMountpointPath = self.workDirPath + 'ext_index/'
+                if elfSections and list(elfSections) != list(extIndex.sections):
+                    print WARNING_COLOR + "ELF sections of the ext index are used: " + ','.join(extIndex.sections) + END_COLOR
+                self.elfSections = list(extIndex.sections)
+            elif extImg:
+                self.extMountpointPath, self.extTree = self.attach(extImg, 'ext', readImages)
+                self.extImgPath = extImg
+                if self.hashCache is not None:
+                    self.extImageKey = self.hashCache.image_digest(extImg)
         except OSError:
             print badWorkDirMsg
 
-    cmpMetodDict = { "*.so": compare_shared_object, "*.jar": cmp_and_process_java, "*.apk": cmp_and_process_java }
+    def comparatorPatterns(self):
+        """ {basename glob: comparator} of registered comparators, see comparators.py.
+        file_check() runs the tier 0 identity check before any of them """
+        return comparators.pattern_dict()
+
+    def estimatedCost(self, rel_path, comparator):
+        """ Estimated seconds to check rel_path: tier 0 hashing plus the comparator """
+        try:
+            size = self.fileSize(self.extMountpointPath + rel_path[1:])
+        except (OSError, IOError, Ext4Error, TypeError):
+            size = 0
+        return 2.0 * size / SHA1_BYTES_PER_SECOND + comparator.cost(size)
     
     def __del__(self):
-        if self.localMountpointPath:
-            self.umount_loop(self.localMountpointPath)
-        if self.extMountpointPath:
-            self.umount_loop(self.extMountpointPath)
+        for mountpoint in getattr(self, 'mounts', []):
+            self.umount_loop(mountpoint)
+        for root, tree in getattr(self, 'trees', []):
+            tree.close()
 
-    def run(self):
+    def run(self, sinks=None):
+        """ Compare the images, streaming a FileResult per file to each ResultSink of
+        sinks (default: ConsoleSink). True when no file differs or is missing. """
         if (self.localMountpointPath is None) or (self.extMountpointPath is None):
             print FAIL_COLOR + "Cannot run dummy AFSImageComparator!" + END_COLOR + "\nInstances without .img files are for unit tests only."
             return False
-        areImagesSame=True
-        try:
-            with open('allowed-missing-files') as missings_file:
-                missings_list = missings_file.read().splitlines()
-        #        print missings_list
-        except IOError:
-                print WARNING_COLOR + "Something went wrong when tried to read shared object files list difference" + END_COLOR
-                missings_list = []
-
-        for extension_pattern in self.cmpMetodDict.keys():
-            ext_files_list = linux_like_find (self.extMountpointPath, extension_pattern)
-
-            for file_wholename in ext_files_list:
-                basename = re.sub(self.extMountpointPath, '/', file_wholename)
-                checkret = self.file_check(basename, self.localMountpointPath, self.extMountpointPath, self.cmpMetodDict[extension_pattern] , missings_list)
-                if checkret is AFSImageComparator.FILE_SAME:
-                    pass
-                elif checkret is AFSImageComparator.FILE_MISS_ALLOWED:
-                    pass
-                elif checkret is AFSImageComparator.FILE_DIFF:
-                    areImagesSame = False
-                    print basename + FAIL_COLOR + " doesn't match!" + END_COLOR
-                elif checkret is AFSImageComparator.FILE_MISS:
-                    areImagesSame = False
-                    print basename + FAIL_COLOR + " missing!" + END_COLOR
+        if self.rules is None:
+            try:
+                self.rules = load_rules(ALLOWED_MISSING_FILE)
+            except RuleError, e:
+                print FAIL_COLOR + "Bad rules: " + str(e) + END_COLOR
+                return False
+        unknownMethods = set(name for name in self.rules.compare_methods() if comparators.by_name(name) is None)
+        if unknownMethods:
+            print FAIL_COLOR + "Unknown compare methods in rules: " + ', '.join(sorted(unknownMethods)) + END_COLOR
+            return False
+        if sinks is None:
+            sinks = [ConsoleSink()]
+        areImagesSame = True
+        for result in self.results():
+            if result.output:
+                sys.stdout.write(result.output)
+            for sink in sinks:
+                sink.record(result)
+            if result.failed():
+                areImagesSame = False
+        for tier in sorted(self.tierStats):
+            print '%s: %d files' % (tier, self.tierStats[tier])
+        if self.ignoredFiles:
+            print 'ignored by rules: %d files' % self.ignoredFiles
+        if len(self.rules):
+            print self.rules.stats()
+        if self.hashCache is not None:
+            print self.hashCache.stats()
+        for sink in sinks:
+            sink.finish(areImagesSame)
         return areImagesSame
 
+    def results(self):
+        """ Generator of a FileResult per file of either image, in rel_path order.
+        Both trees are walked and merged in one sweep, only files found in both
+        are compared. Nothing is kept per file, see lpt_imap() for the look-ahead of -j. """
+        missings_list = self.rules.allowedMissing
+        # comparator diagnostics go with their FileResult, not to the console
+        # in whatever order worker threads happen to print them
+        output = ThreadOutput(sys.stdout)
+
+        def check_item(item):
+            rel_path, check_function, where = item
+            result = FileResult(rel_path, check_function.name)
+            start = time.time()
+            if where == LOCAL_ONLY:
+                result.verdict = AFSImageComparator.FILE_EXTRA
+            else:
+                result.verdict, result.output = output.capture(lambda: self.file_check(
+                    rel_path, self.localMountpointPath, self.extMountpointPath, check_function,
+                    missings_list, result, where == IN_BOTH))
+            result.seconds = time.time() - start
+            return result
+
+        def cost(item):
+            rel_path, check_function, where = item
+            return self.estimatedCost(rel_path, check_function) if where == IN_BOTH else 0
+
+        patterns = self.comparatorPatterns()
+        if self.extIndex is not None:
+            ext_items = ((rel_path, patterns[pattern]) for rel_path, pattern in self.extIndex.items()
+                         if pattern in patterns)
+            local_items = scan_fs_tree(self.localTree, patterns)
+        else:
+            # files matched only by compare rules come with True instead of a comparator
+            walk_patterns = dict((pattern, True) for pattern in self.rules.walk_patterns())
+            walk_patterns.update(patterns)
+            ext_items = scan_fs_tree(self.extTree, walk_patterns)
+            local_items = scan_fs_tree(self.localTree, walk_patterns)
+        work_items = self.applyRules(profiler.profiled_iter('walk', merge_trees(ext_items, local_items)))
+        pool = None
+        stdout = sys.stdout
+        sys.stdout = output
+        if self.jobs > 1:
+            pool = ThreadPool(self.jobs)
+            results = lpt_imap(pool, check_item, work_items, cost, self.jobs)
+        else:
+            results = (check_item(item) for item in work_items)
+        try:
+            for result in results:
+                yield result
+        finally:
+            sys.stdout = stdout
+            if pool:
+                pool.terminate()
+                pool.join()
+            self.terminate_children()
+
+    def applyRules(self, work_items):
+        """ Drop ignored files from (rel_path, check_function, where) items and apply compare rules """
+        defaults = compile_patterns(self.comparatorPatterns())
+        for rel_path, check_function, where in work_items:
+            if self.rules.ignored(rel_path):
+                self.ignoredFiles += 1
+                continue
+            method = self.rules.compare_method(rel_path)
+            if method is not None:
+                check_function = comparators.by_name(method)
+            elif check_function is True:
+                # picked up for a compare rule that does not match the full path
+                check_function = match_patterns(os.path.basename(rel_path), defaults)
+                if check_function is None:
+                    continue
+            yield rel_path, check_function, where
+
+class ConsoleSink(ResultSink):
+    """ What run() always printed: files that differ or are missing """
+
+    def record(self, result):
+        if result.verdict is AFSImageComparator.FILE_DIFF:
+            print result.rel_path + FAIL_COLOR + " doesn't match!" + END_COLOR
+        elif result.verdict is AFSImageComparator.FILE_MISS:
+            print result.rel_path + FAIL_COLOR + " missing!" + END_COLOR
+        elif result.verdict is AFSImageComparator.FILE_EXTRA:
+            print result.rel_path + FAIL_COLOR + " only in local image!" + END_COLOR
+
+def add_hash_cache_arguments(parser):
+    parser.add_argument("--hash-cache", help="path to persistent hash cache (default: " + DEFAULT_CACHE_NAME + " in tmp-dir)")
+    parser.add_argument("--hash-cache-size", type=int, default=DEFAULT_MAX_ENTRIES, help="max number of cached hashes")
+    parser.add_argument("--no-hash-cache", action="store_true", help="do not use persistent hash cache")
+
+def open_hash_cache(args, tmp_root):
+    """ HashCache configured by add_hash_cache_arguments() options, or None """
+    if args.no_hash_cache:
+        return None
+    path = args.hash_cache
+    if not path:
+        path = os.path.join(tmp_root or '/tmp/', DEFAULT_CACHE_NAME)
+    return HashCache(path, args.hash_cache_size)
+
+def add_rules_arguments(parser):
+    parser.add_argument("--rules", default=ALLOWED_MISSING_FILE,
+                        help="allow-missing, ignore and compare rules (default: %(default)s)")
+    parser.add_argument("--unused-rules", action="store_true", help="list rules that matched no file")
+
+def open_rules(args):
+    """ RuleSet named by add_rules_arguments() options, exits on malformed rules """
+    try:
+        return load_rules(args.rules)
+    except RuleError, e:
+        print FAIL_COLOR + "Bad rules: " + str(e) + END_COLOR
+        sys.exit(1)
+
+def print_unused_rules(args, rules):
+    if args.unused_rules:
+        for rule in rules.unused():
+            print 'unused rule %s: %s' % (rule.source, rule)
+
+def section_list(value):
+    return [section for section in value.split(',') if section]
+
+def add_elf_arguments(parser, diff=True):
+    parser.add_argument("--elf-sections", type=section_list, metavar="SECTIONS",
+                        help="comma separated ELF sections compared for shared objects (default: " + ','.join(ELF_SECTIONS) + ")")
+    if diff:
+        parser.add_argument("--elf-diff", action="store_true",
+                            help="print changed blocks and symbols of shared objects that differ")
+
+def add_chunk_arguments(parser):
+    parser.add_argument("--chunk-diff", action="store_true",
+                        help="print byte ranges that changed in files of %d KB or more that differ (dex content for archives)"
+                             % (chunking.MIN_FILE_SIZE // 1024))
+
+def add_output_arguments(parser):
+    parser.add_argument("--jsonl", metavar="FILE", help="write a JSON line per compared file to FILE")
+    parser.add_argument("--junit", metavar="FILE", help="write a JUnit XML report with a test case per compared file to FILE")
+
+def open_sinks(args, number=None):
+    """ ConsoleSink and the sinks add_output_arguments() options ask for.
+    With number, output files are numbered per batch candidate. """
+    sinks = [ConsoleSink()]
+    for path, sink in [(args.jsonl, JsonLinesSink), (args.junit, JUnitSink)]:
+        if path:
+            sinks.append(sink(path if number is None else numbered_path(path, number)))
+    return sinks
+
+def add_plugin_arguments(parser):
+    parser.add_argument("--plugin", action="append", default=[], metavar="MODULE",
+                        help="import MODULE, which registers more comparators (see comparators.py)")
+
+def load_plugins(args):
+    try:
+        comparators.load_plugins(args.plugin)
+    except ImportError, e:
+        print FAIL_COLOR + "Cannot load plugin: " + str(e) + END_COLOR
+        sys.exit(1)
+
+def add_tool_arguments(parser):
+    parser.add_argument("--max-tools", type=int, default=multiprocessing.cpu_count(),
+                        help="max number of external tools (readelf, ...) running at a time (default: %(default)s)")
+    parser.add_argument("--tool-timeout", type=float, metavar="SECONDS",
+                        help="kill an external tool running longer than this; mount and umount are not limited")
+
+def configure_tools(args):
+    """ Replace TOOLS by a runner configured by add_tool_arguments() options """
+    global TOOLS
+    TOOLS = ToolRunner(args.max_tools, timeout=args.tool_timeout)
+
+def add_profile_arguments(parser):
+    parser.add_argument("--profile", action="store_true", help="print time spent per phase and file type")
+    parser.add_argument("--profile-json", help="write per-phase timings as JSON to this file")
+    parser.add_argument("--cprofile", help="write cProfile stats of the whole run (main thread) to this file")
+
+def start_profiling(args):
+    """ Turn on what add_profile_arguments() options ask for, returns cProfile.Profile or None """
+    if args.profile or args.profile_json:
+        profiler.enable()
+    if not args.cprofile:
+        return None
+    wholeRun = cProfile.Profile()
+    wholeRun.enable()
+    return wholeRun
+
+def stop_profiling(args, wholeRun):
+    if wholeRun is not None:
+        wholeRun.disable()
+        wholeRun.dump_stats(args.cprofile)
+    if args.profile:
+        print profiler.report()
+    if args.profile_json:
+        profiler.save_json(args.profile_json)
+
+# reference index and rules shared with batch worker processes, see run_batch()
+_batchIndex = None
+_batchRules = None
+
+BATCH_MARKS = { AFSImageComparator.FILE_SAME: '.', AFSImageComparator.FILE_DIFF: 'D',
+                AFSImageComparator.FILE_MISS: 'M', AFSImageComparator.FILE_MISS_ALLOWED: 'm',
+                AFSImageComparator.FILE_EXTRA: 'L' }
+
+def compare_candidate(task):
+    """ Compare one batch candidate image against _batchIndex in a worker process.
+    Returns (number, OK, captured output, fileResults, checkedFiles, rule hits, profiler stats),
+    fileResults being {rel_path: result code} of files that are not FILE_SAME """
+    global tester
+    number, img, workRoot, jobs, readImages, elfDiff, chunkDiff, outputArgs = task
+    profiler.reset()
+    output = StringIO.StringIO()
+    stdout = sys.stdout
+    sys.stdout = output
+    OK = False
+    mismatches = MismatchSink()
+    try:
+        tester = AFSImageComparator(img, None, workRoot, jobs, None, _batchIndex, readImages, _batchRules,
+                                    elfDiff=elfDiff, chunkDiff=chunkDiff)
+        try:
+            OK = tester.run(open_sinks(outputArgs, number) + [mismatches])
+        finally:
+            del tester
+    except Exception:
+        traceback.print_exc(file=output)
+        OK = False
+    finally:
+        sys.stdout = stdout
+    return (number, OK, output.getvalue(), mismatches.mismatches, mismatches.checked,
+            [rule.hits for rule in _batchRules.ordered], profiler.snapshot())
+
+def print_batch_matrix(labels, outcomes):
+    """ Per-candidate counts, then a file x candidate matrix of every file that is not the same everywhere """
+    print 'batch summary:'
+    print '%3s %-6s %8s %8s %8s %8s %8s  %s' % ('#', 'result', 'checked', 'differ', 'missing', 'allowed', 'local',
+                                               'candidate')
+    for number, label in enumerate(labels):
+        OK, fileResults, checkedFiles = outcomes[number]
+        codes = fileResults.values()
+        print '%3d %-6s %8d %8d %8d %8d %8d  %s' % (number, 'OK' if OK else 'FAIL', checkedFiles,
+            codes.count(AFSImageComparator.FILE_DIFF), codes.count(AFSImageComparator.FILE_MISS),
+            codes.count(AFSImageComparator.FILE_MISS_ALLOWED), codes.count(AFSImageComparator.FILE_EXTRA), label)
+    paths = sorted(set(path for OK, fileResults, checkedFiles in outcomes for path in fileResults))
+    if not paths:
+        return
+    print '\nfiles not same in every candidate (%s):' % ', '.join(
+        "%s %s" % (BATCH_MARKS[code], name) for code, name in
+        [(AFSImageComparator.FILE_SAME, 'same'), (AFSImageComparator.FILE_DIFF, "doesn't match"),
+         (AFSImageComparator.FILE_MISS, 'missing'), (AFSImageComparator.FILE_MISS_ALLOWED, 'allowed missing'),
+         (AFSImageComparator.FILE_EXTRA, 'only in candidate')])
+    print ' '.join('%3d' % number for number in range(len(labels))) + '  file'
+    for path in paths:
+        marks = [BATCH_MARKS[fileResults.get(path, AFSImageComparator.FILE_SAME)] for OK, fileResults, checkedFiles in outcomes]
+        print ' '.join('%3s' % mark for mark in marks) + '  ' + path
+
+def run_batch(refImg, candidates, tmpRoot, jobs=1, parallel=1, hashCache=None, readImages=False, rules=None,
+              elfSections=None, elfDiff=False, chunkDiff=False, outputArgs=None):
+    """ Compare every (label, image) of candidates against refImg.
+    The reference is walked and fingerprinted once into an in-memory index,
+    candidates are compared against it in up to parallel worker processes.
+    outputArgs are add_output_arguments() options, files get the candidate number. """
+    global tester, _batchIndex, _batchRules
+    if rules is None:
+        rules = load_rules(ALLOWED_MISSING_FILE)
+    tester = AFSImageComparator(None, refImg, tmpRoot, jobs, hashCache, readImages=readImages, elfSections=elfSections)
+    try:
+        index = tester.build_index(chunkDiff)
+    finally:
+        del tester
+    if index is None:
+        return False
+    print 'reference %s: %d files indexed' % (refImg, len(index))
+    # forked workers inherit these instead of having them pickled per task
+    _batchIndex = index
+    _batchRules = rules
+    batchRoot = tempfile.mkdtemp(prefix='batch-', dir=tmpRoot or '/tmp/') + '/'
+    tasks = []
+    for number, (label, img) in enumerate(candidates):
+        # each comparator names its workdir after the current second, keep them apart
+        workRoot = batchRoot + str(number) + '/'
+        os.mkdir(workRoot)
+        tasks.append((number, img, workRoot, jobs, readImages, elfDiff, chunkDiff,
+                      outputArgs or argparse.Namespace(jsonl=None, junit=None)))
+    outcomes = []
+    # every worker mounts its candidate through its own copy of TOOLS
+    TOOLS.share_limits()
+    pool = multiprocessing.Pool(max(1, min(parallel, len(tasks))))
+    try:
+        for number, OK, output, fileResults, checkedFiles, ruleHits, stats in ordered_results(pool.imap(compare_candidate, tasks)):
+            label = candidates[number][0]
+            print '\n=== [%d] %s ===' % (number, label)
+            sys.stdout.write(output)
+            if OK:
+                print OK_COLOR + label + ": images are same" + END_COLOR
+            else:
+                print FAIL_COLOR + label + ": images differ" + END_COLOR
+            profiler.merge(stats)
+            for rule, hits in zip(rules.ordered, ruleHits):
+                rule.hits += hits
+            outcomes.append((OK, fileResults, checkedFiles))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    print
+    print_batch_matrix([label for label, img in candidates], outcomes)
+    return all(OK for OK, fileResults, checkedFiles in outcomes)
+
+def batch_main(argv):
+    """ check_files.py batch <ref.img> <candidate.img>... """
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]) + ' batch')
+    parser.add_argument("ref_img", help="path to reference system image")
+    parser.add_argument("candidates", nargs='+', help="paths to candidate system images")
+    parser.add_argument("--tmp-dir", help="path to tmp-dir")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="number of files compared in parallel per image")
+    parser.add_argument("--parallel", "-P", type=int, default=multiprocessing.cpu_count(),
+                        help="number of candidates compared at the same time")
+    parser.add_argument("--no-mount", action="store_true", help="read ext4 images in-process instead of sudo mount")
+    add_elf_arguments(parser)
+    add_chunk_arguments(parser)
+    add_output_arguments(parser)
+    add_hash_cache_arguments(parser)
+    add_plugin_arguments(parser)
+    add_rules_arguments(parser)
+    add_tool_arguments(parser)
+    add_profile_arguments(parser)
+    args = parser.parse_args(argv)
+    load_plugins(args)
+    configure_tools(args)
+    rules = open_rules(args)
+
+    for img in [args.ref_img] + args.candidates:
+        if not os.path.isfile(img):
+            print FAIL_COLOR + "Toubles while accessing system image." + END_COLOR
+            print img
+            parser.print_help()
+            sys.exit(1)
+
+    hashCache = open_hash_cache(args, args.tmp_dir)
+    wholeRun = start_profiling(args)
+    try:
+        OK = run_batch(realpath(args.ref_img), [(img, realpath(img)) for img in args.candidates], args.tmp_dir,
+                       args.jobs, args.parallel, hashCache, args.no_mount, rules, args.elf_sections, args.elf_diff,
+                       args.chunk_diff, args)
+    finally:
+        if hashCache:
+            hashCache.close()
+        stop_profiling(args, wholeRun)
+    print_unused_rules(args, rules)
+    if OK:
+        print OK_COLOR + "All images are same" + END_COLOR
+        sys.exit(0)
+    sys.exit(255)
+
+def index_main(argv):
+    """ check_files.py index <system.img> -o ref.idx """
+    global tester
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]) + ' index')
+    parser.add_argument("img", help="path to reference system image")
+    parser.add_argument("--output", "-o", help="where to write the index", required=True)
+    parser.add_argument("--tmp-dir", help="path to tmp-dir")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="number of files fingerprinted in parallel")
+    parser.add_argument("--no-mount", action="store_true", help="read the ext4 image in-process instead of sudo mount")
+    add_elf_arguments(parser, diff=False)
+    parser.add_argument("--chunks", action="store_true",
+                        help="store chunk lists needed for --chunk-diff against the index, for files of %d KB or more"
+                             % (chunking.MIN_FILE_SIZE // 1024))
+    add_hash_cache_arguments(parser)
+    add_plugin_arguments(parser)
+    add_tool_arguments(parser)
+    add_profile_arguments(parser)
+    args = parser.parse_args(argv)
+    load_plugins(args)
+    configure_tools(args)
+
+    if not os.path.isfile(args.img):
+        print FAIL_COLOR + "Toubles while accessing system image." + END_COLOR
+        print args.img
+        parser.print_help()
+        sys.exit(1)
+
+    hashCache = open_hash_cache(args, args.tmp_dir)
+    wholeRun = start_profiling(args)
+    try:
+        tester = AFSImageComparator(None, realpath(args.img), args.tmp_dir, args.jobs, hashCache,
+                                    readImages=args.no_mount, elfSections=args.elf_sections)
+        try:
+            index = tester.build_index(args.chunks)
+        finally:
+            del tester
+    finally:
+        if hashCache:
+            hashCache.close()
+        stop_profiling(args, wholeRun)
+    if index is None:
+        sys.exit(1)
+    index.save(args.output)
+    print 'indexed %d files of %s into %s' % (len(index), args.img, args.output)
+
 def main():
     global tester
     signal.signal(signal.SIGINT,  signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
-    parser = argparse.ArgumentParser()
+    if len(sys.argv) > 1 and sys.argv[1] == 'index':
+        index_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        batch_main(sys.argv[2:])
+        return
+    parser = argparse.ArgumentParser(epilog="To precompute the ext side once, run: %(prog)s index <ext_img> -o ref.idx\n"
+                                     "To compare many images against one reference, run: %(prog)s batch <ext_img> <local_img>...",
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument("local_img", help="path to local")
-    parser.add_argument("ext_img", help="path to ext")
+    parser.add_argument("ext_img", nargs='?', help="path to ext")
+    parser.add_argument("--ext-index", help="index of ext image built by the 'index' subcommand, instead of ext_img")
     parser.add_argument("--tmp-dir", help="path to tmp-dir")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="number of files compared in parallel")
+    parser.add_argument("--no-mount", action="store_true", help="read ext4 images in-process instead of sudo mount")
+    add_elf_arguments(parser)
+    add_chunk_arguments(parser)
+    add_output_arguments(parser)
+    add_hash_cache_arguments(parser)
+    add_plugin_arguments(parser)
+    add_rules_arguments(parser)
+    add_tool_arguments(parser)
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    load_plugins(args)
+    configure_tools(args)
+    rules = open_rules(args)
     local_img = args.local_img
     ext_img = args.ext_img
     tmp_root = args.tmp_dir
     print 'local_img = ' + args.local_img
-    print 'ext_img = ' + args.ext_img
+    if args.ext_index:
+        print 'ext_index = ' + args.ext_index
+    else:
+        print 'ext_img = ' + str(args.ext_img)
     #print 'tmp_dir = ' args.tmp_dir
 
+    if (not ext_img) == (not args.ext_index):
+        print FAIL_COLOR + "Either ext_img or --ext-index is required." + END_COLOR
+        parser.print_help()
+        sys.exit(1)
+
     if not (os.path.isfile(local_img) and
-        os.path.isfile(ext_img)):
+        (args.ext_index or os.path.isfile(ext_img))):
         print FAIL_COLOR + "Toubles while accessing system images." + END_COLOR
         print local_img
         print ext_img
         parser.print_help()
         sys.exit(1)
 
-    tester = AFSImageComparator(realpath(local_img), realpath(ext_img), tmp_root)
-    OK = tester.run()
-    del tester
+    extIndex = None
+    if args.ext_index:
+        try:
+            extIndex = ImageIndex.load(args.ext_index)
+        except (IOError, ValueError, ImageIndexError), e:
+            print FAIL_COLOR + "Cannot load ext index: " + str(e) + END_COLOR
+            sys.exit(1)
+        ext_img = None
+    else:
+        ext_img = realpath(ext_img)
+
+    hashCache = open_hash_cache(args, tmp_root)
+    wholeRun = start_profiling(args)
+    try:
+        tester = AFSImageComparator(realpath(local_img), ext_img, tmp_root, args.jobs, hashCache, extIndex,
+                                    args.no_mount, rules, args.elf_sections, args.elf_diff, args.chunk_diff)
+        try:
+            OK = tester.run(open_sinks(args))
+        finally:
+            del tester
+        print_unused_rules(args, rules)
+    finally:
+        if hashCache:
+            hashCache.close()
+        stop_profiling(args, wholeRun)
     if OK:
         print OK_COLOR + "Images are same" + END_COLOR
         result = 0
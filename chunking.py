@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""Content-defined chunking of large files.
+
+Chunk boundaries are placed where a gear rolling hash over the last 32
+bytes has its top MASK_BITS bits clear, so an insertion or deletion only
+changes the chunks around it and the rest of the file still matches. The
+input is read READ_SIZE bytes at a time; memory use does not depend on the
+file size apart from the resulting chunk list.
+
+A chunk list is [(length, digest)], stored as 'length:digest,...' text
+in the hash cache and image index."""
+
+import hashlib, struct
+
+MIN_CHUNK = 16 * 1024
+MAX_CHUNK = 256 * 1024
+# boundary probability 2**-MASK_BITS after MIN_CHUNK: about 48 KB chunks on average
+MASK_BITS = 15
+READ_SIZE = 1024 * 1024
+# the gear hash only depends on this many trailing bytes
+WINDOW = 32
+# hex digits of sha1 kept per chunk
+DIGEST_CHARS = 16
+# smaller files are not chunked: the gear hash runs at about 10 MB/s in pure
+# Python, and the byte ranges of a small file tell little more than that it differs
+MIN_FILE_SIZE = 1024 * 1024
+
+# identifies chunking parameters in cache keys, change it with any of the above
+CHUNK_KIND = 'cdc:%d:%d:%d' % (MIN_CHUNK, MASK_BITS, MAX_CHUNK)
+# hash cache 'image' under which chunk lists are kept by content digest
+CHUNK_STORE = 'content'
+
+GEAR = [struct.unpack('<I', hashlib.md5(chr(i)).digest()[:4])[0] for i in xrange(256)]
+
+def chunk_stream(fileobj, min_size=MIN_CHUNK, max_size=MAX_CHUNK, mask_bits=MASK_BITS):
+    """ Yield (length, digest) of each content-defined chunk of fileobj """
+    mask = ((1 << mask_bits) - 1) << (32 - mask_bits)
+    gear = GEAR
+    digest = hashlib.sha1()
+    length = 0
+    h = 0
+    while True:
+        buf = fileobj.read(READ_SIZE)
+        if not buf:
+            break
+        data = bytearray(buf)
+        start = 0   # first byte of the current chunk within buf
+        pos = 0
+        n = len(data)
+        while pos < n:
+            # nothing can cut before min_size: skip all but the bytes the hash needs
+            skip = min_size - WINDOW - length
+            if skip > 0:
+                step = min(skip, n - pos)
+                pos += step
+                length += step
+                continue
+            limit = min(n, pos + max_size - length)
+            warm = min(limit, pos + max(0, min_size - length))
+            for j in xrange(pos, warm):
+                h = ((h << 1) + gear[data[j]]) & 0xffffffff
+            cut = None
+            j = warm
+            for j in xrange(warm, limit):
+                h = ((h << 1) + gear[data[j]]) & 0xffffffff
+                if not h & mask:
+                    cut = j + 1
+                    break
+            end = cut if cut is not None else limit
+            length += end - pos
+            pos = end
+            if cut is not None or length >= max_size:
+                digest.update(buf[start:pos])
+                yield length, digest.hexdigest()[:DIGEST_CHARS]
+                digest = hashlib.sha1()
+                length = 0
+                h = 0
+                start = pos
+        digest.update(buf[start:])
+    if length:
+        yield length, digest.hexdigest()[:DIGEST_CHARS]
+
+def encode_chunks(chunks):
+    return ','.join('%d:%s' % chunk for chunk in chunks)
+
+def decode_chunks(text):
+    if not text:
+        return []
+    chunks = []
+    for item in text.split(','):
+        length, digest = item.split(':')
+        chunks.append((int(length), digest))
+    return chunks
+
+def changed_ranges(chunks, other):
+    """ (offset, length) ranges of chunks whose content is nowhere in other, adjacent ones merged """
+    known = set(digest for length, digest in other)
+    ranges = []
+    offset = 0
+    for length, digest in chunks:
+        if digest not in known:
+            if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+            else:
+                ranges.append((offset, length))
+        offset += length
+    return ranges
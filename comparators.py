@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""Comparator plugins.
+
+A comparator decides whether two files that are not byte-identical are
+still equivalent. It declares the basename globs it handles, a name that
+'compare' rules can refer to, and a cost model used to schedule the
+longest comparisons first. Comparators read files through the
+AFSImageComparator passed to them (openFile, cachedValue, ...), so they
+work the same on mounted images, in-process images and image indexes.
+
+Other modules add comparators with register(); check_files.py --plugin
+imports such modules, e.g. android_comparators for kernel modules, oat
+and odex files and build.prop."""
+
+import importlib
+
+class Comparator(object):
+    name = None
+    # basename globs of files compared with this comparator
+    patterns = ()
+    # estimated seconds per file, and per byte as throughput; 0 for size independent
+    startupCost = 0.0
+    bytesPerSecond = 0
+
+    def cost(self, size):
+        """ Estimated seconds to compare a file of size bytes """
+        if not self.bytesPerSecond:
+            return self.startupCost
+        return self.startupCost + float(size) / self.bytesPerSecond
+
+    def compare(self, tester, path1, path2):
+        """ True when the files are equivalent. By default they must be byte-identical """
+        return tester.identicalFiles(path1, path2)
+
+    def fingerprint(self, tester, path):
+        """ {kind: value} stored in an image index for the file at path """
+        return {}
+
+    # content --chunk-diff splits into chunks, named after the value identifying it
+    chunkKind = 'sha1'
+
+    def content_key(self, tester, path):
+        """ Digest of the content open_chunked() returns """
+        return tester.cachedValue(path, 'sha1', lambda: tester.hashOfFile(path))
+
+    def open_chunked(self, tester, path):
+        return tester.openFile(path)
+
+    def __call__(self, tester, path1, path2):
+        return self.compare(tester, path1, path2)
+
+    def __repr__(self):
+        return '<comparator %s>' % self.name
+
+_registry = []
+
+def register(comparator):
+    """ Register a Comparator subclass or instance, replacing one of the same
+    name. Patterns of later registrations take precedence. Usable as class decorator. """
+    instance = comparator() if isinstance(comparator, type) else comparator
+    _registry[:] = [c for c in _registry if c.name != instance.name]
+    _registry.append(instance)
+    return comparator
+
+def registered():
+    return list(_registry)
+
+def by_name(name):
+    for comparator in _registry:
+        if comparator.name == name:
+            return comparator
+    return None
+
+def pattern_dict():
+    """ {basename glob: comparator} of every registered comparator """
+    patterns = {}
+    for comparator in _registry:
+        for pattern in comparator.patterns:
+            patterns[pattern] = comparator
+    return patterns
+
+def load_plugins(modules):
+    """ Import plugin modules, which register() their comparators """
+    for module in modules:
+        importlib.import_module(module)
+
+@register
+class ExactComparator(Comparator):
+    """ Files that must be byte-identical: reached only when the tier 0 check failed """
+    name = 'exact'
+
+    def compare(self, tester, path1, path2):
+        return False
+
+@register
+class SharedObjectComparator(Comparator):
+    """ .text of shared objects, sections configurable with the index """
+    name = 'elf'
+    patterns = ('*.so',)
+    startupCost = 0.0005
+    bytesPerSecond = 2e9
+
+    def compare(self, tester, path1, path2):
+        return tester.compare_shared_object(path1, path2)
+
+    def fingerprint(self, tester, path):
+        return tester.fingerprint_shared_object(path)
+
+@register
+class ArchiveComparator(Comparator):
+    """ APK and JAR: central directory CRCs, then manifest digests, then dex """
+    name = 'archive'
+    patterns = ('*.apk', '*.jar')
+    startupCost = 0.002
+    bytesPerSecond = 200e6
+
+    def compare(self, tester, path1, path2):
+        return tester.are_apk_same(path1, path2)
+
+    def fingerprint(self, tester, path):
+        return tester.fingerprint_java(path)
+
+    # chunk the dex files, not the compressed archive
+    chunkKind = 'dex'
+
+    def content_key(self, tester, path):
+        return tester.cachedValue(path, 'dex', lambda: tester.archiveDexHashOf(path))
+
+    def open_chunked(self, tester, path):
+        return tester.openDexStream(path)
+
+class ElfSectionsComparator(Comparator):
+    """ Equal raw bytes of a fixed list of ELF sections """
+    sections = ('.text',)
+    startupCost = 0.0005
+    bytesPerSecond = 2e9
+
+    def kind(self):
+        return 'elf:' + ','.join(self.sections)
+
+    def digest(self, tester, path):
+        return tester.cachedValue(path, self.kind(), lambda: tester.hashOfElfSections(path, self.sections))
+
+    def compare(self, tester, path1, path2):
+        sum1 = self.digest(tester, path1)
+        return (sum1 is not None) and (sum1 == self.digest(tester, path2))
+
+    def fingerprint(self, tester, path):
+        return { self.kind(): self.digest(tester, path) }
@@ -1,61 +1,141 @@
 #!/usr/bin/env python
 
-import subprocess, os, argparse, sys, tarfile, zipfile, re, datetime
-from check_files import AFSImageComparator, FAIL_COLOR, WARNING_COLOR, OK_COLOR, END_COLOR, linux_like_find
-from operator import itemgetter
+import subprocess, os, argparse, sys, tarfile, zipfile, re, datetime, hashlib, multiprocessing, signal
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
+from check_files import AFSImageComparator, FAIL_COLOR, WARNING_COLOR, OK_COLOR, END_COLOR, add_hash_cache_arguments, open_hash_cache, \
+    add_profile_arguments, start_profiling, stop_profiling, run_batch, add_rules_arguments, open_rules, print_unused_rules, \
+    add_plugin_arguments, load_plugins, add_elf_arguments, add_chunk_arguments, add_output_arguments, open_sinks, add_tool_arguments, configure_tools, \
+    ordered_results, signal_handler
+from profiler import profiled
+from tool_runner import terminate
+import check_files
+from build_finder import find_newest_builds, BuildsIndex, ORDERS
 
-def extractSystemImage(archive, folder):
+EXTRACT_BLOCKSIZE = 1024 * 1024
+
+def openPackageStream(archive, usePigz=True):
+    """ Open archive as a forward-only tar stream: (TarFile, pigz process or None).
+    gzip packages are decompressed by a parallel pigz when it is installed,
+    started through check_files.TOOLS: finish() it there. """
+    if usePigz and re.search('\.(tar\.gz|tgz|gz)$', archive) and find_executable('pigz'):
+        pigz = check_files.TOOLS.start(['pigz', '-dc', archive], stdout=subprocess.PIPE)
+        try:
+            return tarfile.open(fileobj=pigz.stdout, mode='r|'), pigz
+        except:
+            # e.g. pigz was killed before the first header, the caller never sees it
+            terminate(pigz)
+            check_files.TOOLS.finish(pigz)
+            raise
+    return tarfile.open(archive, mode='r|*'), None
+
+@profiled('extract', 0, size=lambda archive, *rest: os.path.getsize(archive))
+def extractSystemImage(archive, folder, digests=None, usePigz=True):
+    """ Stream system.img out of archive in a single decompression pass.
+    The sha1 of the image is computed while it is written and stored in
+    digests[extracted path] when digests is given. """
+    pigz = None
     try:
         ImageFilename = 'system.img'
         if not os.access(folder, os.W_OK):
             print "No access to destination folder"
             return None
-        Package = tarfile.open(archive)
-        
-        buildName = re.sub(".tar.*$", '', re.sub('^fastboot-','', os.path.basename(Package.name))) #cut-off 'fastboot' world an extension to obtain package name
+        Package, pigz = openPackageStream(archive, usePigz)
+
+        buildName = re.sub(".tar.*$", '', re.sub('^fastboot-','', os.path.basename(archive))) #cut-off 'fastboot' world an extension to obtain package name
         systemRegexp = re.compile(".*" + ImageFilename + "$") 
-        systemImageArchivePathList = filter(systemRegexp.match, Package.getnames())
-        if len(systemImageArchivePathList)!=1:
-            print "Too much system.img in " + Package.name
+        for member in Package:
+            if member.isfile() and systemRegexp.match(member.name):
+                break
+        else:
+            print "No " + ImageFilename + " in " + archive
             return None
 
         if not buildName:
             buildName = dummy
         extractTo = folder + buildName + '/'
         os.mkdir(extractTo)
-        print 'extracting ' + systemImageArchivePathList[0] + '\nfrom ' + archive
-        Package.extract(systemImageArchivePathList[0], extractTo)
-        return linux_like_find(extractTo, ImageFilename)
+        print 'extracting ' + member.name + '\nfrom ' + archive
+        imagePath = extractTo + ImageFilename
+        source = Package.extractfile(member)
+        sha1 = hashlib.sha1()
+        with open(imagePath, 'wb') as image:
+            buf = source.read(EXTRACT_BLOCKSIZE)
+            while buf:
+                image.write(buf)
+                sha1.update(buf)
+                buf = source.read(EXTRACT_BLOCKSIZE)
+        if digests is not None:
+            digests[imagePath] = sha1.hexdigest()
+        return [imagePath]
     except:
         print "Exception when were extracting"
         return None 
+    finally:
+        if pigz:
+            # the image may be found before the end of the archive
+            terminate(pigz)
+            check_files.TOOLS.finish(pigz)
 
-
-def addCTimeKey(x):
-    return [x, os.path.getctime(x)]
-
-def findNewestBuild(folder, template):
-#the addCTimeKey function in the next line is expected to return list of it's argument and hash-key (i.g. ctime) [x, hash(x)]
-   FindedList =  sorted([addCTimeKey(x) for x in linux_like_find (folder, template)], key=itemgetter(1), reverse=True)
-#   print FindedList
-   return FindedList[0][0] 
+@profiled('find-build')
+def findNewestBuild(folder, template, order='version', indexPath=None, prune=False):
+    """ Newest package matching template below folder, None if there is none.
+    See build_finder.py for order, the builds index at indexPath and pruning. """
+    index = BuildsIndex(template, indexPath)
+    found = find_newest_builds(folder, template, order, 1, prune, index)
+    try:
+        index.save()
+    except (IOError, OSError), e:
+        print WARNING_COLOR + "Cannot save builds index: " + str(e) + END_COLOR
+    print 'builds dirs listed: %d, from index: %d' % (index.listed, index.reused)
+    return found[0] if found else None
 
 def main():
+    # pigz, readelf, ... lead sessions of their own: reap them on SIGINT/SIGTERM
+    signal.signal(signal.SIGINT,  signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
     parser = argparse.ArgumentParser()
-    parser.add_argument("--internal_package", "-i", help="path to fresh build", required=True)
+    parser.add_argument("--internal_package", "-i", action="append", required=True,
+                        help="path to fresh build, repeat to compare several builds against one external build")
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--external_package", "-e", help="path to latest daily build")
     group.add_argument("--external_dir", "-d", help="path to daily builds folder")
     parser.add_argument("--tmp-dir", help="path to tmp-dir", required=False)
     parser.add_argument("--pattern", "-p", help="archive package name pattern, used with -d option", required=False, default = "*.gz")
+    parser.add_argument("--order", choices=ORDERS, default='version',
+                        help="which package of -d is the newest: highest version in its name, or latest ctime/mtime (default: %(default)s)")
+    parser.add_argument("--builds-index", metavar="FILE", help="cache of -d directory listings, updated on each run")
+    parser.add_argument("--prune", action="store_true",
+                        help="with --order mtime, skip directories of -d older than the newest package found; "
+                             "only for trees filled in time order, see build_finder.py")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="number of files compared in parallel")
+    parser.add_argument("--parallel", "-P", type=int, default=multiprocessing.cpu_count(),
+                        help="number of packages decompressed, and of internal builds compared, at the same time")
+    parser.add_argument("--no-mount", action="store_true", help="read ext4 images in-process instead of sudo mount")
+    parser.add_argument("--no-pigz", action="store_true", help="do not decompress packages with pigz even if it is installed")
+    add_elf_arguments(parser)
+    add_chunk_arguments(parser)
+    add_output_arguments(parser)
+    add_hash_cache_arguments(parser)
+    add_plugin_arguments(parser)
+    add_rules_arguments(parser)
+    add_tool_arguments(parser)
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    if args.prune and args.order != 'mtime':
+        parser.error("--prune needs --order mtime")
+    load_plugins(args)
+    configure_tools(args)
+    rules = open_rules(args)
+    wholeRun = start_profiling(args)
 
     nowString = re.sub('\..*$','',datetime.datetime.now().isoformat('-'))
    
-    if not (os.path.isfile(args.internal_package) and os.access(args.internal_package, os.R_OK)):
-        print FAIL_COLOR + "Problems with reading internal package" + END_COLOR + '\n'
-        parser.print_help()
-        sys.exit(1)
+    for internalPackage in args.internal_package:
+        if not (os.path.isfile(internalPackage) and os.access(internalPackage, os.R_OK)):
+            print FAIL_COLOR + "Problems with reading internal package " + internalPackage + END_COLOR + '\n'
+            parser.print_help()
+            sys.exit(1)
 
     if args.external_package:
         if not (os.path.isfile(args.external_package) and os.access(args.external_package, os.R_OK)):
@@ -65,7 +145,10 @@ def main():
         externalPackage = args.external_package
     else:
         print "Ext dir is " + args.external_dir
-        externalPackage = findNewestBuild(args.external_dir, args.pattern)
+        externalPackage = findNewestBuild(args.external_dir, args.pattern, args.order, args.builds_index, args.prune)
+        if externalPackage is None:
+            print FAIL_COLOR + "No " + args.pattern + " package in " + args.external_dir + END_COLOR
+            sys.exit(1)
     
     print "Comparing to " + externalPackage 
     if args.tmp_dir:
@@ -74,20 +157,50 @@ def main():
         tmpDir = '/tmp/'
     workPath =  tmpDir + nowString + '/'
     os.mkdir(workPath)
-    internalSysImageRetlist = extractSystemImage(args.internal_package, workPath)
-    if internalSysImageRetlist is None:
-        print FAIL_COLOR + 'Failed to extract internal sysImage' + END_COLOR + "\nfrom " + args.internal_package
-        sys.exit(1)
-    externalSysImageRetlist = extractSystemImage(externalPackage, workPath)
+    # up to --parallel packages are decompressed at the same time, each writes a whole image
+    imageDigests = {}
+    packages = args.internal_package + [externalPackage]
+    extractPool = ThreadPool(max(1, min(args.parallel, len(packages))))
+    try:
+        extracted = list(ordered_results(extractPool.imap(
+            lambda package: extractSystemImage(package, workPath, imageDigests, not args.no_pigz), packages)))
+        extractPool.close()
+    finally:
+        extractPool.terminate()
+        extractPool.join()
+    externalSysImageRetlist = extracted.pop()
+    for internalPackage, internalSysImageRetlist in zip(args.internal_package, extracted):
+        if internalSysImageRetlist is None:
+            print FAIL_COLOR + 'Failed to extract internal sysImage' + END_COLOR + "\nfrom " + internalPackage
+            sys.exit(1)
     if externalSysImageRetlist is None:
         print FAIL_COLOR + 'Failed to extract external sysImage' + END_COLOR + "\nfrom " + externalPackage
         sys.exit(1)
     
-    systemComparator = AFSImageComparator(internalSysImageRetlist[0], externalSysImageRetlist[0], workPath)
-    
-    systemComparator.run()
-    OK = systemComparator.run()
-    del systemComparator
+    hashCache = open_hash_cache(args, tmpDir)
+    if hashCache:
+        # reference image checksum was computed while extracting it
+        hashCache.remember_image(externalSysImageRetlist[0], imageDigests[externalSysImageRetlist[0]])
+    try:
+        if len(extracted) > 1:
+            # external image is fingerprinted once for all internal builds
+            OK = run_batch(externalSysImageRetlist[0], [(package, retlist[0]) for package, retlist in zip(args.internal_package, extracted)],
+                           workPath, args.jobs, args.parallel, hashCache, args.no_mount, rules,
+                           args.elf_sections, args.elf_diff, args.chunk_diff, args)
+        else:
+            systemComparator = AFSImageComparator(extracted[0][0], externalSysImageRetlist[0], workPath, args.jobs, hashCache,
+                                                  readImages=args.no_mount, rules=rules, elfSections=args.elf_sections,
+                                                  elfDiff=args.elf_diff, chunkDiff=args.chunk_diff)
+            try:
+                OK = systemComparator.run(open_sinks(args))
+            finally:
+                # unmounts the images, also when a signal unwinds run()
+                del systemComparator
+        print_unused_rules(args, rules)
+    finally:
+        if hashCache:
+            hashCache.close()
+        stop_profiling(args, wholeRun)
     if OK:
         print OK_COLOR + "SysImages are same" + END_COLOR
         result = 0
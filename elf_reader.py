@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+"""Minimal in-process ELF reader: parses ELF32/ELF64 headers and section
+header table of either endianness and hashes raw section bytes straight from
+an mmap, without running readelf. diff_elf() tells which blocks and
+symbols of two ELF files differ."""
+
+import mmap, struct, hashlib
+
+ELF_MAGIC = '\x7fELF'
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+SHT_DYNSYM = 11
+STT_OBJECT = 1
+STT_FUNC = 2
+EM_ARM = 40
+SHN_UNDEF = 0
+SHN_LORESERVE = 0xff00
+SHN_XINDEX = 0xffff
+
+# header fields following e_ident, and section header layout, per ELF class
+EHDR_FORMAT = { ELFCLASS32: 'HHIIIIIHHHHHH', ELFCLASS64: 'HHIQQQIHHHHHH' }
+SHDR_FORMAT = { ELFCLASS32: 'IIIIIIIIII', ELFCLASS64: 'IIQQQQIIQQ' }
+# symbol table entry, fields reordered by ElfFile.symbols() to (name, value, size, info, other, shndx)
+SYM_FORMAT = { ELFCLASS32: 'IIIBBH', ELFCLASS64: 'IBBHQQ' }
+
+# block size of diff_elf() block hashes
+DIFF_BLOCK_SIZE = 4096
+# changed blocks and symbols listed per line by diff_elf()
+DIFF_LIST_LIMIT = 10
+ENDIAN = { ELFDATA2LSB: '<', ELFDATA2MSB: '>' }
+
+class ElfError(Exception):
+    pass
+
+class ElfSection(object):
+    __slots__ = ('name', 'type', 'flags', 'addr', 'offset', 'size', 'link', 'info', 'entsize')
+
+    def __init__(self, name, type, flags, addr, offset, size, link, info, entsize):
+        self.name = name
+        self.type = type
+        self.flags = flags
+        self.addr = addr
+        self.offset = offset
+        self.size = size
+        self.link = link
+        self.info = info
+        self.entsize = entsize
+
+class ElfFile(object):
+    """ELF image backed by an mmap of an open file (or any buffer-like object).
+    File objects without a file descriptor are read into memory instead."""
+
+    def __init__(self, fileobj=None, data=None):
+        self.map = None
+        if data is None and not hasattr(fileobj, 'fileno'):
+            data = fileobj.read()
+        if data is None:
+            try:
+                self.map = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error), e: # empty file or not mmapable
+                raise ElfError('cannot map file: ' + str(e))
+            data = self.map
+        self.data = data
+        self.sections = []
+        try:
+            self._parse()
+        except ElfError:
+            self.close()
+            raise
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _unpack(self, fmt, offset):
+        fmt = self.endian + fmt
+        end = offset + struct.calcsize(fmt)
+        if offset < 0 or end > len(self.data):
+            raise ElfError('truncated ELF structure at offset %d' % offset)
+        return struct.unpack(fmt, self.data[offset:end])
+
+    def _parse(self):
+        if len(self.data) < 16 or self.data[:4] != ELF_MAGIC:
+            raise ElfError('not an ELF file')
+        self.elfclass = ord(self.data[4])
+        if self.elfclass not in EHDR_FORMAT or ord(self.data[5]) not in ENDIAN:
+            raise ElfError('unsupported ELF class or data encoding')
+        self.endian = ENDIAN[ord(self.data[5])]
+
+        (self.e_type, self.e_machine, _, _, _, shoff, _, _, _, _,
+         shentsize, shnum, shstrndx) = self._unpack(EHDR_FORMAT[self.elfclass], 16)
+        if shoff == 0:
+            return
+        shdr_format = SHDR_FORMAT[self.elfclass]
+        if shentsize < struct.calcsize(shdr_format):
+            raise ElfError('bad section header entry size %d' % shentsize)
+
+        # extended numbering: real counts live in section header 0
+        first = self._unpack(shdr_format, shoff)
+        if shnum == 0:
+            shnum = first[5]
+        if shstrndx == SHN_XINDEX:
+            shstrndx = first[6]
+
+        headers = [self._unpack(shdr_format, shoff + i * shentsize) for i in xrange(shnum)]
+        if shstrndx == SHN_UNDEF or shstrndx >= len(headers):
+            strtab_offset, strtab_size = 0, 0
+        else:
+            strtab_offset, strtab_size = headers[shstrndx][4], headers[shstrndx][5]
+
+        for (name, type, flags, addr, offset, size, link, info, _, entsize) in headers:
+            self.sections.append(ElfSection(self._string(strtab_offset, strtab_size, name),
+                                            type, flags, addr, offset, size, link, info, entsize))
+
+    def _string(self, table_offset, table_size, index):
+        if index >= table_size:
+            return ''
+        start = table_offset + index
+        end = self.data.find('\0', start, table_offset + table_size)
+        if end < 0:
+            end = table_offset + table_size
+        return self.data[start:end]
+
+    def section(self, name):
+        for section in self.sections:
+            if section.name == name:
+                return section
+        return None
+
+    def section_data(self, section):
+        """Zero-copy view of section bytes"""
+        if section.type == SHT_NOBITS or section.size == 0:
+            return ''
+        if section.offset + section.size > len(self.data):
+            raise ElfError('section %s runs past end of file' % section.name)
+        return buffer(self.data, section.offset, section.size)
+
+    def hash_sections(self, names, hashfunc):
+        """Feed each named section into hashfunc and return hexdigest.
+        Section names are hashed too, so a missing section differs from an empty one."""
+        for name in names:
+            section = self.section(name)
+            if section is None:
+                hashfunc.update(name + '\0missing\0')
+                continue
+            hashfunc.update(name + '\0')
+            hashfunc.update(self.section_data(section))
+        return hashfunc.hexdigest()
+
+    def symbols(self):
+        """ (name, value, size, type, shndx) of sized functions and objects, from
+        .symtab if present, .dynsym otherwise """
+        tables = [s for s in self.sections if s.type == SHT_SYMTAB] or [s for s in self.sections if s.type == SHT_DYNSYM]
+        if not tables or tables[0].link >= len(self.sections):
+            return []
+        table, strtab = tables[0], self.sections[tables[0].link]
+        fmt = SYM_FORMAT[self.elfclass]
+        entsize = table.entsize or struct.calcsize(self.endian + fmt)
+        result = []
+        for offset in xrange(table.offset, table.offset + table.size - entsize + 1, entsize):
+            fields = self._unpack(fmt, offset)
+            if self.elfclass == ELFCLASS32:
+                name, value, size, info, _, shndx = fields
+            else:
+                name, info, _, shndx, value, size = fields
+            type = info & 0xf
+            if type not in (STT_FUNC, STT_OBJECT) or size == 0 or shndx in (SHN_UNDEF, SHN_XINDEX) or shndx >= len(self.sections):
+                continue
+            if type == STT_FUNC and self.e_machine == EM_ARM:
+                value &= ~1 # thumb bit
+            result.append((self._string(strtab.offset, strtab.size, name), value, size, type, shndx))
+        return result
+
+    def symbol_hashes(self, names):
+        """ {symbol name: sha1 of its bytes} for symbols within sections called names """
+        wanted = set(i for i, section in enumerate(self.sections) if section.name in names)
+        hashes = {}
+        for name, value, size, type, shndx in self.symbols():
+            if shndx not in wanted:
+                continue
+            section = self.sections[shndx]
+            start = value - section.addr
+            if start < 0 or start + size > section.size:
+                continue
+            data = self.section_data(section)
+            hashes[name] = hashlib.sha1(data[start:start + size]).hexdigest()
+        return hashes
+
+    def block_hashes(self, name, block_size=DIFF_BLOCK_SIZE):
+        """ sha1 of each block_size bytes of section name, None if there is no such section """
+        section = self.section(name)
+        if section is None:
+            return None
+        data = self.section_data(section)
+        return [hashlib.sha1(data[i:i + block_size]).digest() for i in xrange(0, len(data), block_size)]
+
+def short_list(items, limit=DIFF_LIST_LIMIT):
+    items = list(items)
+    more = ' (+%d more)' % (len(items) - limit) if len(items) > limit else ''
+    return ', '.join(items[:limit]) + more
+
+def diff_elf(elf1, elf2, names, block_size=DIFF_BLOCK_SIZE):
+    """ Lines describing how sections called names of two ElfFiles differ:
+    changed block offsets per section, then changed, added and removed symbols """
+    lines = []
+    for name in names:
+        blocks1, blocks2 = elf1.block_hashes(name, block_size), elf2.block_hashes(name, block_size)
+        if blocks1 is None or blocks2 is None:
+            if blocks1 is not blocks2:
+                lines.append('%s: only in %s file' % (name, 'first' if blocks2 is None else 'second'))
+            continue
+        changed = [i for i in xrange(max(len(blocks1), len(blocks2)))
+                   if i >= len(blocks1) or i >= len(blocks2) or blocks1[i] != blocks2[i]]
+        if not changed:
+            continue
+        line = '%s: %d of %d blocks differ at %s' % (name, len(changed), max(len(blocks1), len(blocks2)),
+                                                    short_list('0x%x' % (i * block_size) for i in changed))
+        size1, size2 = elf1.section(name).size, elf2.section(name).size
+        if size1 != size2:
+            line += ', size %d -> %d' % (size1, size2)
+        lines.append(line)
+    symbols1, symbols2 = elf1.symbol_hashes(names), elf2.symbol_hashes(names)
+    changed = sorted(name for name in set(symbols1) & set(symbols2) if symbols1[name] != symbols2[name])
+    for label, symbols in [('symbols changed', changed),
+                           ('symbols removed', sorted(set(symbols1) - set(symbols2))),
+                           ('symbols added', sorted(set(symbols2) - set(symbols1)))]:
+        if symbols:
+            lines.append('%s: %s' % (label, short_list(symbols)))
+    return lines
+
+def hash_elf_sections(path, names, hashfunc):
+    """Hash sections of ELF file at path; raises ElfError for non-ELF input"""
+    with open(path, 'rb') as elf_file:
+        return hash_elf_file(elf_file, names, hashfunc)
+
+def hash_elf_file(fileobj, names, hashfunc):
+    """Same as hash_elf_sections() for an open file object"""
+    with ElfFile(fileobj) as elf:
+        return elf.hash_sections(names, hashfunc)
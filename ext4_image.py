@@ -0,0 +1,487 @@
+#!/usr/bin/env python
+
+"""Read-only access to ext2/3/4 filesystem images without mounting them.
+
+Ext4Image walks directories and streams file data straight from the image
+file through an mmap. Android sparse images (simg) are detected by their
+magic and expanded lazily: only chunk headers are read up front, data is
+fetched from the chunk covering each requested range.
+
+Symlinks are followed within the image, absolute targets starting from
+the image root, as they resolve on the device. Like a walk of a mounted
+image, list_entries() reports a symlink to a file as a file and a symlink
+to a directory as neither, so that the walk does not follow it."""
+
+import os, mmap, struct, stat
+
+SPARSE_MAGIC = 0xed26ff3a
+SPARSE_HEADER = '<IHHHHIIII'
+SPARSE_CHUNK_HEADER = '<HHII'
+CHUNK_TYPE_RAW = 0xcac1
+CHUNK_TYPE_FILL = 0xcac2
+CHUNK_TYPE_DONT_CARE = 0xcac3
+CHUNK_TYPE_CRC32 = 0xcac4
+
+EXT4_SUPERBLOCK_OFFSET = 1024
+EXT4_MAGIC = 0xef53
+EXT4_ROOT_INO = 2
+EXT4_FEATURE_INCOMPAT_FILETYPE = 0x2
+EXT4_FEATURE_INCOMPAT_64BIT = 0x80
+EXT4_EXTENTS_FL = 0x80000
+EXT4_INLINE_DATA_FL = 0x10000000
+EXT4_EXTENT_MAGIC = 0xf30a
+EXT4_EXTENT_INIT_MAX_LEN = 32768
+EXT4_NDIR_BLOCKS = 12
+EXT4_GOOD_OLD_INODE_SIZE = 128
+EXT4_XATTR_MAGIC = 0xea020000
+EXT4_XATTR_INDEX_SYSTEM = 7
+
+# directory entry file_type values
+FT_REG_FILE = 1
+FT_DIR = 2
+FT_SYMLINK = 7
+
+# symlinks followed in one lookup before giving up, as Linux does
+MAX_SYMLINK_HOPS = 40
+
+class Ext4Error(Exception):
+    pass
+
+class RawImage(object):
+    """Plain image file, read through an mmap"""
+
+    def __init__(self, fileobj):
+        self.map = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.map)
+
+    def read_at(self, offset, size):
+        if offset + size > self.size:
+            raise Ext4Error('read past end of image at offset %d' % offset)
+        return self.map[offset:offset + size]
+
+    def close(self):
+        self.map.close()
+
+class SparseImage(RawImage):
+    """Android sparse image, expanded on demand"""
+
+    def __init__(self, fileobj):
+        RawImage.__init__(self, fileobj)
+        (magic, major, _, file_hdr_sz, chunk_hdr_sz, self.block_size, total_blocks,
+         total_chunks, _) = struct.unpack(SPARSE_HEADER, self.map[:struct.calcsize(SPARSE_HEADER)])
+        if magic != SPARSE_MAGIC or major != 1:
+            raise Ext4Error('unsupported sparse image')
+        # (output offset, output length, chunk type, input offset or fill pattern)
+        self.chunks = []
+        in_offset = file_hdr_sz
+        out_offset = 0
+        for _ in xrange(total_chunks):
+            chunk_type, _, chunk_blocks, total_sz = struct.unpack(
+                SPARSE_CHUNK_HEADER, self.map[in_offset:in_offset + struct.calcsize(SPARSE_CHUNK_HEADER)])
+            data_offset = in_offset + chunk_hdr_sz
+            length = chunk_blocks * self.block_size
+            if chunk_type == CHUNK_TYPE_RAW:
+                self.chunks.append((out_offset, length, chunk_type, data_offset))
+            elif chunk_type == CHUNK_TYPE_FILL:
+                self.chunks.append((out_offset, length, chunk_type, self.map[data_offset:data_offset + 4]))
+            elif chunk_type == CHUNK_TYPE_DONT_CARE:
+                self.chunks.append((out_offset, length, chunk_type, None))
+            elif chunk_type != CHUNK_TYPE_CRC32:
+                raise Ext4Error('unknown sparse chunk type 0x%x' % chunk_type)
+            out_offset += length
+            in_offset += total_sz
+        self.size = total_blocks * self.block_size
+        self.starts = [chunk[0] for chunk in self.chunks]
+
+    def read_at(self, offset, size):
+        if offset + size > self.size:
+            raise Ext4Error('read past end of image at offset %d' % offset)
+        parts = []
+        index = self._chunk_index(offset)
+        while size > 0:
+            out_offset, length, chunk_type, source = self.chunks[index]
+            skip = offset - out_offset
+            take = min(size, length - skip)
+            if chunk_type == CHUNK_TYPE_RAW:
+                parts.append(self.map[source + skip:source + skip + take])
+            elif chunk_type == CHUNK_TYPE_FILL:
+                pattern = source * ((skip % 4 + take) // 4 + 2)
+                parts.append(pattern[skip % 4:skip % 4 + take])
+            else:
+                parts.append('\0' * take)
+            offset += take
+            size -= take
+            index += 1
+        return ''.join(parts)
+
+    def _chunk_index(self, offset):
+        lo, hi = 0, len(self.starts) - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.starts[mid] <= offset:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+def open_image(path):
+    """RawImage or SparseImage depending on the file magic"""
+    with open(path, 'rb') as fileobj:
+        magic = fileobj.read(4)
+        if len(magic) == 4 and struct.unpack('<I', magic)[0] == SPARSE_MAGIC:
+            return SparseImage(fileobj)
+        return RawImage(fileobj)
+
+class Inode(object):
+    __slots__ = ('number', 'mode', 'size', 'flags', 'block', 'raw')
+
+    def __init__(self, number, mode, size, flags, block, raw):
+        self.number = number
+        self.mode = mode
+        self.size = size
+        self.flags = flags
+        self.block = block
+        self.raw = raw
+
+    def inline_xattr_data(self):
+        """Value of the in-inode system.data xattr holding inline data beyond i_block"""
+        if len(self.raw) <= EXT4_GOOD_OLD_INODE_SIZE + 4:
+            return ''
+        (extra_isize,) = struct.unpack_from('<H', self.raw, EXT4_GOOD_OLD_INODE_SIZE)
+        start = EXT4_GOOD_OLD_INODE_SIZE + extra_isize
+        if start + 4 > len(self.raw) or struct.unpack_from('<I', self.raw, start)[0] != EXT4_XATTR_MAGIC:
+            return ''
+        first = start + 4
+        offset = first
+        while offset + 16 <= len(self.raw):
+            name_len, name_index, value_offs, _, value_size = struct.unpack_from('<BBHII', self.raw, offset)
+            if name_len == 0 and name_index == 0:
+                break
+            name = self.raw[offset + 16:offset + 16 + name_len]
+            if name_index == EXT4_XATTR_INDEX_SYSTEM and name == 'data':
+                return self.raw[first + value_offs:first + value_offs + value_size]
+            offset += (16 + name_len + 3) & ~3
+        return ''
+
+class Ext4File(object):
+    """Read-only file object for an inode, mapping reads through its extents"""
+
+    def __init__(self, image, inode):
+        self.image = image
+        self.inode = inode
+        self.size = inode.size
+        self.pos = 0
+        self.inline = None
+        if inode.flags & EXT4_INLINE_DATA_FL:
+            self.inline = (inode.block + inode.inline_xattr_data())[:inode.size]
+            if len(self.inline) < inode.size:
+                raise Ext4Error('inline data of inode %d is truncated' % inode.number)
+            self.extents = []
+        else:
+            # sorted (logical block, block count, physical block or None for zeros)
+            self.extents = image.file_extents(inode)
+            self.starts = [extent[0] for extent in self.extents]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        pass
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise IOError('negative seek offset')
+        self.pos = offset
+
+    def read(self, size=-1):
+        if size is None or size < 0 or self.pos + size > self.size:
+            size = max(0, self.size - self.pos)
+        if self.inline is not None:
+            data = self.inline[self.pos:self.pos + size]
+        else:
+            data = self._read_blocks(self.pos, size)
+        self.pos += len(data)
+        return data
+
+    def _read_blocks(self, offset, size):
+        block_size = self.image.block_size
+        parts = []
+        while size > 0:
+            logical = offset // block_size
+            skip = offset - logical * block_size
+            extent = self._extent(logical)
+            if extent is None:
+                # hole up to the next extent
+                following = [start for start in self.starts if start > logical]
+                run = (following[0] if following else logical + 1) - logical
+                physical = None
+            else:
+                start, count, physical = extent
+                run = start + count - logical
+                if physical is not None:
+                    physical += logical - start
+            take = min(size, run * block_size - skip)
+            if physical is None:
+                parts.append('\0' * take)
+            else:
+                parts.append(self.image.backing.read_at(physical * block_size + skip, take))
+            offset += take
+            size -= take
+        return ''.join(parts)
+
+    def _extent(self, logical):
+        lo, hi = 0, len(self.starts) - 1
+        found = None
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            if self.starts[mid] <= logical:
+                found = mid
+                lo = mid + 1
+            else:
+                hi = mid - 1
+        if found is None:
+            return None
+        extent = self.extents[found]
+        if logical >= extent[0] + extent[1]:
+            return None
+        return extent
+
+class Ext4Image(object):
+    """Filesystem tree of an ext2/3/4 image; paths are absolute within the image"""
+
+    def __init__(self, path):
+        self.path = path
+        self.backing = open_image(path)
+        try:
+            self._read_superblock()
+        except (Ext4Error, struct.error):
+            self.backing.close()
+            raise
+
+    def close(self):
+        self.backing.close()
+
+    def _read_superblock(self):
+        sb = self.backing.read_at(EXT4_SUPERBLOCK_OFFSET, 1024)
+        (magic,) = struct.unpack_from('<H', sb, 56)
+        if magic != EXT4_MAGIC:
+            raise Ext4Error(self.path + ': not an ext2/3/4 image')
+        (self.first_data_block, log_block_size) = struct.unpack_from('<II', sb, 20)
+        (self.inodes_per_group,) = struct.unpack_from('<I', sb, 40)
+        (rev_level,) = struct.unpack_from('<I', sb, 76)
+        (inode_size,) = struct.unpack_from('<H', sb, 88)
+        (self.feature_incompat,) = struct.unpack_from('<I', sb, 96)
+        (desc_size,) = struct.unpack_from('<H', sb, 254)
+        self.block_size = 1024 << log_block_size
+        self.inode_size = inode_size if rev_level >= 1 else 128
+        self.is_64bit = bool(self.feature_incompat & EXT4_FEATURE_INCOMPAT_64BIT)
+        self.desc_size = desc_size if (self.is_64bit and desc_size) else 32
+        self.has_filetype = bool(self.feature_incompat & EXT4_FEATURE_INCOMPAT_FILETYPE)
+        self.gdt_offset = (self.first_data_block + 1) * self.block_size
+        self.inode_tables = {}
+        self.dir_cache = {}
+
+    def _inode_table(self, group):
+        if group not in self.inode_tables:
+            desc = self.backing.read_at(self.gdt_offset + group * self.desc_size, self.desc_size)
+            (table,) = struct.unpack_from('<I', desc, 8)
+            if self.is_64bit and self.desc_size >= 64:
+                (table_hi,) = struct.unpack_from('<I', desc, 0x28)
+                table |= table_hi << 32
+            self.inode_tables[group] = table
+        return self.inode_tables[group]
+
+    def inode(self, number):
+        group, index = divmod(number - 1, self.inodes_per_group)
+        offset = self._inode_table(group) * self.block_size + index * self.inode_size
+        raw = self.backing.read_at(offset, self.inode_size)
+        mode, size_lo = struct.unpack_from('<HxxI', raw, 0)
+        (flags,) = struct.unpack_from('<I', raw, 0x20)
+        (size_hi,) = struct.unpack_from('<I', raw, 0x6c)
+        return Inode(number, mode, size_lo | (size_hi << 32), flags, raw[0x28:0x28 + 60], raw)
+
+    def file_extents(self, inode):
+        if inode.flags & EXT4_EXTENTS_FL:
+            extents = []
+            self._walk_extent_node(inode.block, extents)
+            extents.sort()
+            return extents
+        return self._block_map(inode)
+
+    def _walk_extent_node(self, node, extents):
+        magic, entries, _, depth = struct.unpack_from('<HHHH', node, 0)
+        if magic != EXT4_EXTENT_MAGIC:
+            raise Ext4Error('bad extent header')
+        for i in xrange(entries):
+            offset = 12 + i * 12
+            if depth == 0:
+                logical, length, start_hi, start_lo = struct.unpack_from('<IHHI', node, offset)
+                physical = start_lo | (start_hi << 32)
+                if length > EXT4_EXTENT_INIT_MAX_LEN:
+                    # uninitialized extent reads back as zeros
+                    extents.append((logical, length - EXT4_EXTENT_INIT_MAX_LEN, None))
+                else:
+                    extents.append((logical, length, physical))
+            else:
+                _, leaf_lo, leaf_hi = struct.unpack_from('<IIH', node, offset)
+                leaf = leaf_lo | (leaf_hi << 32)
+                self._walk_extent_node(self.backing.read_at(leaf * self.block_size, self.block_size), extents)
+
+    def _block_map(self, inode):
+        """ext2/3 direct and indirect blocks as single-block extents (merged when contiguous)"""
+        count = (inode.size + self.block_size - 1) // self.block_size
+        pointers = list(struct.unpack('<15I', inode.block))
+        blocks = pointers[:EXT4_NDIR_BLOCKS]
+        for level, pointer in enumerate(pointers[EXT4_NDIR_BLOCKS:]):
+            if len(blocks) >= count:
+                break
+            blocks.extend(self._indirect(pointer, level, count - len(blocks)))
+        extents = []
+        for logical, physical in enumerate(blocks[:count]):
+            if physical == 0:
+                continue
+            if extents and extents[-1][0] + extents[-1][1] == logical and extents[-1][2] + extents[-1][1] == physical:
+                extents[-1] = (extents[-1][0], extents[-1][1] + 1, extents[-1][2])
+            else:
+                extents.append((logical, 1, physical))
+        return extents
+
+    def _indirect(self, pointer, level, wanted):
+        per_block = self.block_size // 4
+        span = per_block ** level
+        if pointer == 0:
+            return [0] * min(wanted, per_block * span)
+        table = struct.unpack('<%dI' % per_block, self.backing.read_at(pointer * self.block_size, self.block_size))
+        if level == 0:
+            return list(table[:wanted])
+        blocks = []
+        for child in table:
+            if len(blocks) >= wanted:
+                break
+            blocks.extend(self._indirect(child, level - 1, wanted - len(blocks)))
+        return blocks
+
+    def _dir_entries(self, inode):
+        """(name, inode number, file_type or None) of a directory inode"""
+        if inode.flags & EXT4_INLINE_DATA_FL:
+            # parent inode number, then entries in i_block and in the system.data xattr
+            return self._parse_dirents(inode.block[4:]) + self._parse_dirents(inode.inline_xattr_data())
+        return self._parse_dirents(Ext4File(self, inode).read())
+
+    def _parse_dirents(self, data):
+        entries = []
+        offset = 0
+        while offset + 8 <= len(data):
+            number, rec_len, name_len, file_type = struct.unpack_from('<IHBB', data, offset)
+            if rec_len < 8:
+                break
+            if number != 0:
+                name = data[offset + 8:offset + 8 + name_len]
+                if name not in ('.', '..'):
+                    entries.append((name, number, file_type if self.has_filetype else None))
+            offset += rec_len
+        return entries
+
+    def _children(self, inode):
+        """{name: (inode number, file_type)} of a directory, parsed once per directory"""
+        children = self.dir_cache.get(inode.number)
+        if children is None:
+            children = dict((name, (number, file_type)) for name, number, file_type in self._dir_entries(inode))
+            self.dir_cache[inode.number] = children
+        return children
+
+    def readlink(self, inode):
+        """Target of a symlink inode: in i_block for short (fast) symlinks, else in its data"""
+        if inode.size < len(inode.block) and not inode.flags & (EXT4_EXTENTS_FL | EXT4_INLINE_DATA_FL):
+            return inode.block[:inode.size]
+        return Ext4File(self, inode).read()
+
+    def lookup(self, path, follow=True):
+        """Inode of an absolute path within the image, None if there is no such entry.
+        Symlinks are followed, the last component only when follow is set."""
+        root = self.inode(EXT4_ROOT_INO)
+        inode = root
+        # inodes of the directories above inode, for '..'
+        parents = []
+        parts = path.split('/')
+        parts.reverse()
+        hops = 0
+        while parts:
+            part = parts.pop()
+            if part in ('', '.'):
+                continue
+            if part == '..':
+                if parents:
+                    inode = parents.pop()
+                continue
+            if not stat.S_ISDIR(inode.mode):
+                return None
+            child = self._children(inode).get(part)
+            if child is None:
+                return None
+            node = self.inode(child[0])
+            if stat.S_ISLNK(node.mode) and (follow or any(parts)):
+                hops += 1
+                if hops > MAX_SYMLINK_HOPS:
+                    return None
+                target = self.readlink(node)
+                if target.startswith('/'):
+                    inode = root
+                    parents = []
+                target = target.split('/')
+                target.reverse()
+                parts.extend(target)
+                continue
+            parents.append(inode)
+            inode = node
+        return inode
+
+    def list_entries(self, path):
+        """(name, is_dir, is_file) for entries of directory path, in the order
+        check_files.scan_tree() expects. Symlinks are never dirs, and files
+        when they resolve to a regular file."""
+        inode = self.lookup(path)
+        if inode is None or not stat.S_ISDIR(inode.mode):
+            return []
+        entries = []
+        for name, (number, file_type) in self._children(inode).iteritems():
+            if file_type is None:
+                mode = self.inode(number).mode
+                is_dir, is_file, is_link = stat.S_ISDIR(mode), stat.S_ISREG(mode), stat.S_ISLNK(mode)
+            else:
+                is_dir, is_file, is_link = file_type == FT_DIR, file_type == FT_REG_FILE, file_type == FT_SYMLINK
+            if is_link:
+                is_file = self.isfile(path.rstrip('/') + '/' + name)
+            entries.append((name, is_dir, is_file))
+        entries.sort(key=lambda e: e[0] + '/' if e[1] else e[0])
+        return entries
+
+    def isfile(self, path):
+        inode = self.lookup(path)
+        return inode is not None and stat.S_ISREG(inode.mode)
+
+    def getsize(self, path):
+        inode = self.lookup(path)
+        if inode is None:
+            raise IOError('no such file in image: ' + path)
+        return inode.size
+
+    def realpath(self, path):
+        """Files inside an image have no path on the host filesystem"""
+        return None
+
+    def open(self, path):
+        inode = self.lookup(path)
+        if inode is None or not stat.S_ISREG(inode.mode):
+            raise IOError('no such file in image: ' + path)
+        return Ext4File(self, inode)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""Persistent content-hash cache shared between comparator runs.
+
+Values are keyed by the checksum of the image they were computed from plus
+the file's rel_path inside that image, so they stay valid for as long as the
+same reference image is compared against. Image checksums themselves are
+memoized by the image file's (path, size, mtime, inode)."""
+
+import os, time, sqlite3, hashlib, threading
+
+DEFAULT_CACHE_NAME = 'imgcmp-hash-cache.sqlite'
+DEFAULT_MAX_ENTRIES = 500000
+# writes are committed after this many changes or seconds, whichever comes
+# first, so that an interrupted run keeps most of what it computed
+COMMIT_EVERY = 1000
+COMMIT_SECONDS = 5.0
+
+def file_digest(path, hashfunc=None, blocksize=1024 * 1024):
+    """Streaming hexdigest of the whole file"""
+    if hashfunc is None:
+        hashfunc = hashlib.sha1()
+    with open(path, 'rb') as inp:
+        buf = inp.read(blocksize)
+        while buf:
+            hashfunc.update(buf)
+            buf = inp.read(blocksize)
+    return hashfunc.hexdigest()
+
+class HashCache(object):
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES, commit_every=COMMIT_EVERY, commit_seconds=COMMIT_SECONDS):
+        self.path = path
+        self.max_entries = max_entries
+        self.commit_every = commit_every
+        self.commit_seconds = commit_seconds
+        self.hits = 0
+        self.misses = 0
+        self.pending = 0
+        self.last_commit = time.time()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS images ('
+                        'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, inode INTEGER, digest TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                        'image TEXT, rel_path TEXT, kind TEXT, value TEXT, last_used REAL, '
+                        'PRIMARY KEY (image, rel_path, kind))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS hashes_lru ON hashes (last_used)')
+        self.db.commit()
+
+    def image_digest(self, image_path):
+        """Checksum of image contents, recomputed only when the image file changes"""
+        st = os.stat(image_path)
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime, inode, digest FROM images WHERE path = ?',
+                                  (image_path,)).fetchone()
+        if row and row[:3] == (st.st_size, st.st_mtime, st.st_ino):
+            return row[3]
+        digest = file_digest(image_path)
+        self.remember_image(image_path, digest)
+        return digest
+
+    def remember_image(self, image_path, digest):
+        """Record a checksum computed elsewhere (e.g. while the image was extracted)"""
+        st = os.stat(image_path)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)',
+                            (image_path, st.st_size, st.st_mtime, st.st_ino, digest))
+            self.db.commit()
+
+    def get(self, image, rel_path, kind):
+        with self.lock:
+            row = self.db.execute('SELECT value FROM hashes WHERE image = ? AND rel_path = ? AND kind = ?',
+                                  (image, rel_path, kind)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute('UPDATE hashes SET last_used = ? WHERE image = ? AND rel_path = ? AND kind = ?',
+                            (time.time(), image, rel_path, kind))
+            self._changed()
+            return row[0]
+
+    def put(self, image, rel_path, kind, value):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)',
+                            (image, rel_path, kind, value, time.time()))
+            self._changed()
+
+    def _changed(self):
+        """Count a change, committing when enough of them or enough time piled up; self.lock is held"""
+        self.pending += 1
+        now = time.time()
+        if self.pending >= self.commit_every or now - self.last_commit >= self.commit_seconds:
+            self.db.commit()
+            self.pending = 0
+            self.last_commit = now
+
+    def evict(self):
+        """Drop least recently used entries above max_entries"""
+        with self.lock:
+            count = self.db.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+            if count > self.max_entries:
+                self.db.execute('DELETE FROM hashes WHERE rowid IN '
+                                '(SELECT rowid FROM hashes ORDER BY last_used LIMIT ?)',
+                                (count - self.max_entries,))
+            self.db.commit()
+
+    def stats(self):
+        return 'hash cache: %d hits, %d misses' % (self.hits, self.misses)
+
+    def close(self):
+        if self.db is not None:
+            self.evict()
+            self.db.close()
+            self.db = None
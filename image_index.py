@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""Precomputed fingerprints of a reference system image.
+
+An index maps rel_path -> (pattern, size, values), values being the same
+{kind: value} hashes AFSImageComparator computes for a file of that
+pattern ('sha1', 'elf:.text', 'manifest-digests', 'dex'). The file is a JSON header
+line followed by one JSON line per file, sorted by rel_path."""
+
+import json
+
+INDEX_FORMAT = 'imgcmp-index'
+INDEX_VERSION = 3
+
+class ImageIndexError(Exception):
+    pass
+
+def to_bytes(obj):
+    """json.loads() returns unicode; comparators work with utf-8 byte strings"""
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    if isinstance(obj, dict):
+        return dict((to_bytes(k), to_bytes(v)) for k, v in obj.iteritems())
+    if isinstance(obj, list):
+        return [to_bytes(v) for v in obj]
+    return obj
+
+class ImageIndex(object):
+
+    def __init__(self, image=None, sections=None):
+        self.image = image
+        self.sections = sections or []
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, rel_path, pattern, size, values):
+        self.entries[rel_path] = (pattern, size, values)
+
+    def get(self, rel_path):
+        return self.entries.get(rel_path)
+
+    def value(self, rel_path, kind):
+        entry = self.entries.get(rel_path)
+        if entry is None:
+            return None
+        return entry[2].get(kind)
+
+    def items(self):
+        """(rel_path, pattern) in sorted rel_path order"""
+        for rel_path in sorted(self.entries):
+            yield rel_path, self.entries[rel_path][0]
+
+    def save(self, path):
+        with open(path, 'w') as out:
+            out.write(json.dumps({'format': INDEX_FORMAT, 'version': INDEX_VERSION,
+                                  'image': self.image, 'sections': self.sections}) + '\n')
+            for rel_path in sorted(self.entries):
+                pattern, size, values = self.entries[rel_path]
+                out.write(json.dumps([rel_path, pattern, size, values], sort_keys=True, separators=(',', ':')) + '\n')
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as inp:
+            try:
+                header = json.loads(inp.readline())
+            except ValueError:
+                raise ImageIndexError(path + ': not an image index')
+            if header.get('format') != INDEX_FORMAT or header.get('version') != INDEX_VERSION:
+                raise ImageIndexError(path + ': unsupported index format')
+            index = cls(to_bytes(header['image']), to_bytes(header['sections']))
+            for line in inp:
+                rel_path, pattern, size, values = to_bytes(json.loads(line))
+                index.entries[rel_path] = (pattern, size, values)
+        return index
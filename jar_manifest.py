@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+"""Per-entry digests of JAR/APK META-INF/MANIFEST.MF.
+
+A manifest is sections separated by blank lines, each made of 'Key: value'
+headers. Lines end with CRLF, LF or CR and are wrapped at 72 bytes, a line
+starting with a single space continues the previous one. Entry sections
+start with 'Name:' and carry '<algorithm>-Digest' headers, e.g. SHA1-Digest
+or SHA-256-Digest (v2 signing). parse_manifest() returns
+
+    {entry name: {algorithm: base64 digest}}
+
+algorithm names normalized (SHA-1 and SHA1 are both 'SHA1')."""
+
+DIGEST_SUFFIX = '-Digest'
+# binary AndroidManifest.xml differs between builds of the same sources
+SKIPPED_ENTRY = 'AndroidManifest.xml'
+
+# header name: normalized algorithm, e.g. 'SHA-256-Digest': 'SHA256'
+_algorithms = {}
+
+def digest_algorithm(header):
+    algorithm = _algorithms.get(header)
+    if algorithm is None:
+        algorithm = _algorithms[header] = header[:-len(DIGEST_SUFFIX)].replace('-', '').upper()
+    return algorithm
+
+def parse_manifest(data):
+    """ {entry name: {algorithm: digest}} of entries of MANIFEST.MF data with a digest """
+    text = '\n\n' + data.replace('\r\n', '\n').replace('\r', '\n').replace('\n ', '')
+    entries = {}
+    # Name is the first header of an entry section
+    for section in text.split('\n\nName: ')[1:]:
+        lines = section.split('\n')
+        name = lines[0]
+        digests = {}
+        for line in lines[1:]:
+            key, sep, value = line.partition(': ')
+            if key.endswith(DIGEST_SUFFIX):
+                digests[digest_algorithm(key)] = value
+        if digests and not name.endswith(SKIPPED_ENTRY):
+            entries[name] = digests
+    return entries
+
+def same_digests(digests1, digests2):
+    """ Equal digests for every algorithm both have; no common algorithm is a difference """
+    common = [algorithm for algorithm in digests1 if algorithm in digests2]
+    if not common:
+        return False
+    for algorithm in common:
+        if digests1[algorithm] != digests2[algorithm]:
+            return False
+    return True
+
+def diff_manifests(manifest1, manifest2):
+    """ Sorted lists (added, removed, changed) of entry names: only in manifest2,
+    only in manifest1 and in both with different digests """
+    if manifest1 == manifest2:
+        return [], [], []
+    names1 = manifest1.viewkeys()
+    names2 = manifest2.viewkeys()
+    changed = [name for name in names1 & names2
+               if manifest1[name] != manifest2[name] and not same_digests(manifest1[name], manifest2[name])]
+    return sorted(names2 - names1), sorted(names1 - names2), sorted(changed)
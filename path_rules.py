@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+"""Path rules for image comparison, loaded from a rules file such as
+allowed-missing-files.
+
+One rule per line, '#' starts a comment:
+
+    /lib/libfoo.so                    allowed to be missing (legacy form)
+    allow-missing /lib/libfoo*.so     same, explicitly
+    ignore /app/Debug*.apk            not compared at all
+    compare /etc/*.xml exact          compared with the named method
+
+A pattern is an exact rel_path, a prefix ending with '/' that matches
+everything below it, or a glob where '*' and '?' stay within one path
+component and '**' matches across components. Exact paths are looked up
+in a set, all other patterns of an action are merged into one regex.
+Every rule counts its hits so that unused rules can be pruned."""
+
+import re, threading
+
+ALLOW_MISSING = 'allow-missing'
+IGNORE = 'ignore'
+COMPARE = 'compare'
+ACTIONS = (ALLOW_MISSING, IGNORE, COMPARE)
+
+class RuleError(Exception):
+    pass
+
+def glob_to_regex(pattern):
+    """ Regex source for a path glob: '*' and '?' do not match '/', '**' does """
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith('**', i):
+            out.append('.*')
+            i += 2
+            continue
+        i += 1
+        if c == '*':
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            end = pattern.find(']', i + 1 if pattern[i:i + 1] in ('!', ']') else i)
+            if end < 0:
+                out.append('\\[')
+                continue
+            body = pattern[i:end].replace('\\', '\\\\')
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            out.append('[' + body + ']')
+            i = end + 1
+        else:
+            out.append(re.escape(c))
+    return ''.join(out)
+
+def is_glob(pattern):
+    return any(c in pattern for c in '*?[')
+
+class Rule(object):
+    __slots__ = ('action', 'pattern', 'argument', 'source', 'hits', 'compiled')
+
+    def __init__(self, action, pattern, argument=None, source=''):
+        self.action = action
+        self.pattern = pattern
+        self.argument = argument
+        self.source = source
+        self.hits = 0
+        self.compiled = None
+
+    def regex(self):
+        """ Regex source matching the same paths as the rule, None for exact paths """
+        if is_glob(self.pattern):
+            return glob_to_regex(self.pattern)
+        if self.pattern.endswith('/'):
+            return re.escape(self.pattern) + '.*'
+        return None
+
+    def walk_pattern(self):
+        """ Basename glob of files the rule can match, for scan_tree() """
+        if self.pattern.endswith('/') or '**' in self.pattern:
+            return '*'
+        return self.pattern.rsplit('/', 1)[-1]
+
+    def __str__(self):
+        return ' '.join([self.action, self.pattern] + ([self.argument] if self.argument else []))
+
+class PathRules(object):
+    """ Rules of one action. 'rel_path in rules' tells whether any rule matches. """
+
+    def __init__(self):
+        self.exact = {}
+        self.patterns = []
+        self.matcher = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.exact) + len(self.patterns)
+
+    def rules(self):
+        return self.exact.values() + self.patterns
+
+    def add(self, rule):
+        if rule.regex() is None:
+            # first rule for a path wins, like the first matching pattern does
+            self.exact.setdefault(rule.pattern, rule)
+            return
+        rule.compiled = re.compile(rule.regex() + r'\Z')
+        self.patterns.append(rule)
+        # merged on the next match(), recompiling per rule would make loading quadratic
+        self.matcher = None
+
+    def compiled_matcher(self):
+        """ The regex of all patterns, None when there are none """
+        matcher = self.matcher
+        if matcher is None and self.patterns:
+            with self.lock:
+                if self.matcher is None:
+                    # \Z applies to every alternative, not only to the last one
+                    self.matcher = re.compile('(?:(?:' + ')|(?:'.join(p.regex() for p in self.patterns) + r'))\Z')
+                matcher = self.matcher
+        return matcher
+
+    def match(self, rel_path):
+        """ First rule matching rel_path (exact paths before patterns), or None """
+        rule = self.exact.get(rel_path)
+        if rule is None:
+            matcher = self.compiled_matcher()
+            if matcher is None or not matcher.match(rel_path):
+                return None
+            # a hit: find out which pattern it was, in rules file order
+            for candidate in self.patterns:
+                if candidate.compiled.match(rel_path):
+                    rule = candidate
+                    break
+            else:
+                return None
+        with self.lock:
+            rule.hits += 1
+        return rule
+
+    def __contains__(self, rel_path):
+        return self.match(rel_path) is not None
+
+class RuleSet(object):
+
+    def __init__(self):
+        self.byAction = dict((action, PathRules()) for action in ACTIONS)
+        self.allowedMissing = self.byAction[ALLOW_MISSING]
+        self.ordered = []
+
+    def __len__(self):
+        return len(self.ordered)
+
+    def add(self, action, pattern, argument=None, source=''):
+        if action not in self.byAction:
+            raise RuleError(source + ': unknown action ' + action)
+        if not pattern.startswith('/'):
+            raise RuleError(source + ': path must start with /: ' + pattern)
+        if (action == COMPARE) != (argument is not None):
+            raise RuleError(source + ': only compare rules take a method name')
+        rule = Rule(action, pattern, argument, source)
+        self.byAction[action].add(rule)
+        self.ordered.append(rule)
+
+    def parse(self, lines, name='<rules>'):
+        for number, line in enumerate(lines, 1):
+            words = line.split('#', 1)[0].split()
+            source = '%s:%d' % (name, number)
+            if not words:
+                continue
+            if len(words) == 1:
+                self.add(ALLOW_MISSING, words[0], source=source)
+            elif len(words) == 2:
+                self.add(words[0], words[1], source=source)
+            elif len(words) == 3:
+                self.add(words[0], words[1], words[2], source)
+            else:
+                raise RuleError(source + ': too many fields')
+        return self
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as rules_file:
+            return cls().parse(rules_file.read().splitlines(), path)
+
+    def ignored(self, rel_path):
+        return self.byAction[IGNORE].match(rel_path) is not None
+
+    def compare_method(self, rel_path):
+        """ Method name of the compare rule matching rel_path, or None """
+        rule = self.byAction[COMPARE].match(rel_path)
+        return rule.argument if rule is not None else None
+
+    def compare_methods(self):
+        return set(rule.argument for rule in self.byAction[COMPARE].rules())
+
+    def walk_patterns(self):
+        """ Basename globs of every file a compare rule may apply to """
+        return set(rule.walk_pattern() for rule in self.byAction[COMPARE].rules())
+
+    def unused(self):
+        """ Rules that matched nothing, in rules file order """
+        return [rule for rule in self.ordered if rule.hits == 0]
+
+    def stats(self):
+        return 'rules: %d of %d matched' % (len(self) - len(self.unused()), len(self))
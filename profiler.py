@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+"""Per-phase timing of comparator hot paths.
+
+Instrumented functions record call count, latency percentiles and bytes
+processed per (phase, file type). Recording is off by default; a disabled
+@profiled wrapper costs one flag test per call."""
+
+import os, time, json, random, threading
+
+# latency samples kept per (phase, file type) for percentiles
+MAX_SAMPLES = 10000
+PERCENTILES = (50, 90, 99)
+
+enabled = False
+_stats = {}
+_lock = threading.Lock()
+_started = None
+
+class PhaseStats(object):
+    __slots__ = ('count', 'total', 'max', 'bytes', 'samples', 'rng')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bytes = 0
+        self.samples = []
+        self.rng = random.Random(0)
+
+    def add(self, seconds, nbytes):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.bytes += nbytes
+        if len(self.samples) < MAX_SAMPLES:
+            self.samples.append(seconds)
+        else:
+            # reservoir sampling keeps percentiles unbiased on long runs
+            slot = self.rng.randint(0, self.count - 1)
+            if slot < MAX_SAMPLES:
+                self.samples[slot] = seconds
+
+    def percentile(self, pct):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+def enable():
+    global enabled, _started
+    enabled = True
+    if _started is None:
+        _started = time.time()
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    global _started
+    with _lock:
+        _stats.clear()
+    _started = time.time() if enabled else None
+
+def file_type(path):
+    """ Extension used to group stats, '' for paths without one """
+    return os.path.splitext(path)[1].lower()
+
+def record(phase, seconds, nbytes=0, filetype=''):
+    key = (phase, filetype)
+    with _lock:
+        stats = _stats.get(key)
+        if stats is None:
+            stats = _stats[key] = PhaseStats()
+        stats.add(seconds, nbytes)
+
+def profiled(phase, path_arg=None, size=None):
+    """ Decorator recording each call under phase. The file type is taken from
+    positional argument path_arg, bytes from size(*args) after the call """
+    def decorate(func):
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                filetype = file_type(args[path_arg]) if path_arg is not None else ''
+                nbytes = 0
+                if size is not None:
+                    try:
+                        nbytes = size(*args)
+                    except Exception:
+                        pass
+                record(phase, elapsed, nbytes, filetype)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.__wrapped__ = func
+        return wrapper
+    return decorate
+
+class phase(object):
+    """ with phase('mount'): ... records the block as one call """
+
+    def __init__(self, name, filetype='', nbytes=0):
+        self.name = name
+        self.filetype = filetype
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        if enabled:
+            record(self.name, time.time() - self.start, self.nbytes, self.filetype)
+
+def profiled_iter(name, iterable):
+    """ Yield from iterable, recording the time spent producing items as one
+    call to phase name. Useful for lazy walkers consumed by a work loop """
+    if not enabled:
+        for item in iterable:
+            yield item
+        return
+    iterator = iter(iterable)
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.time()
+            try:
+                item = iterator.next()
+            except StopIteration:
+                elapsed += time.time() - start
+                break
+            elapsed += time.time() - start
+            yield item
+    finally:
+        record(name, elapsed)
+
+def snapshot():
+    """ Picklable copy of the recorded stats, for merge() in another process """
+    with _lock:
+        return dict((key, (stats.count, stats.total, stats.max, stats.bytes, list(stats.samples)))
+                    for key, stats in _stats.iteritems())
+
+def merge(recorded):
+    """ Add stats recorded by snapshot() elsewhere """
+    with _lock:
+        for key, (count, total, longest, nbytes, samples) in recorded.iteritems():
+            stats = _stats.get(key)
+            if stats is None:
+                stats = _stats[key] = PhaseStats()
+            stats.samples = merge_samples(stats.rng, stats.samples, stats.count, samples, count)
+            stats.count += count
+            stats.total += total
+            stats.max = max(stats.max, longest)
+            stats.bytes += nbytes
+
+def merge_samples(rng, samples1, count1, samples2, count2):
+    """ At most MAX_SAMPLES of two sample lists taken from count1 and count2 calls,
+    each list contributing in proportion to its number of calls """
+    if len(samples1) + len(samples2) <= MAX_SAMPLES and len(samples1) == count1 and len(samples2) == count2:
+        return samples1 + samples2
+    keep1 = min(len(samples1), int(round(MAX_SAMPLES * float(count1) / max(count1 + count2, 1))))
+    keep2 = min(len(samples2), MAX_SAMPLES - keep1)
+    return rng.sample(samples1, keep1) + rng.sample(samples2, keep2)
+
+def summary():
+    """ List of per (phase, file type) dicts, times in seconds """
+    with _lock:
+        items = sorted(_stats.items())
+    rows = []
+    for (name, filetype), stats in items:
+        row = { 'phase': name, 'type': filetype, 'count': stats.count, 'total': stats.total,
+                'mean': stats.total / stats.count, 'max': stats.max, 'bytes': stats.bytes }
+        for pct in PERCENTILES:
+            row['p%d' % pct] = stats.percentile(pct)
+        rows.append(row)
+    return rows
+
+def report():
+    """ Summary table, phases with the largest total first """
+    rows = sorted(summary(), key=lambda row: -row['total'])
+    header = '%-12s %-6s %8s %10s %9s %9s %9s %9s %10s' % (
+        'phase', 'type', 'count', 'total s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'MB')
+    lines = [header, '-' * len(header)]
+    for row in rows:
+        lines.append('%-12s %-6s %8d %10.3f %9.2f %9.2f %9.2f %9.2f %10.1f' % (
+            row['phase'], row['type'], row['count'], row['total'], row['p50'] * 1000, row['p90'] * 1000,
+            row['p99'] * 1000, row['max'] * 1000, row['bytes'] / (1024.0 * 1024.0)))
+    if _started is not None:
+        lines.append('wall time: %.3f s' % (time.time() - _started))
+    return '\n'.join(lines)
+
+def save_json(path):
+    with open(path, 'w') as out:
+        json.dump({ 'wall': (time.time() - _started) if _started is not None else None,
+                    'phases': summary() }, out, indent=1, sort_keys=True)
+        out.write('\n')
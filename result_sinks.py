@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""Per-file comparison results and the sinks they are streamed to.
+
+AFSImageComparator.run() hands every FileResult to each sink as soon as it
+is known and keeps none of them, so sinks decide what to retain."""
+
+import os, json, tempfile, shutil
+from xml.sax.saxutils import quoteattr
+
+# file_check() result codes, also AFSImageComparator.FILE_*
+FILE_SAME = 0
+FILE_DIFF = 1
+FILE_MISS = 2
+FILE_MISS_ALLOWED = 3
+# only in the local image
+FILE_EXTRA = 4
+
+VERDICTS = { FILE_SAME: 'same', FILE_DIFF: 'differ', FILE_MISS: 'missing', FILE_MISS_ALLOWED: 'allowed-missing',
+             FILE_EXTRA: 'local-only' }
+
+class FileResult(object):
+    # as_dict() fields
+    FIELDS = ('rel_path', 'kind', 'verdict', 'tier', 'local_size', 'ext_size', 'local_sha1', 'ext_sha1', 'seconds')
+    # output: what comparators printed for the file, run() prints it with the result
+    __slots__ = FIELDS + ('output',)
+
+    def __init__(self, rel_path, kind=None):
+        self.rel_path = rel_path
+        self.kind = kind
+        self.verdict = None
+        self.tier = None
+        self.local_size = None
+        self.ext_size = None
+        self.local_sha1 = None
+        self.ext_sha1 = None
+        self.seconds = 0.0
+        self.output = ''
+
+    def failed(self):
+        return self.verdict in (FILE_DIFF, FILE_MISS, FILE_EXTRA)
+
+    def as_dict(self):
+        values = dict((name, getattr(self, name)) for name in self.FIELDS)
+        values['verdict'] = VERDICTS.get(self.verdict)
+        return values
+
+class ResultSink(object):
+    """ Receives FileResults in rel_path order; finish() is called once after the last one """
+
+    def record(self, result):
+        pass
+
+    def finish(self, same):
+        pass
+
+class MismatchSink(ResultSink):
+    """ Keeps only what is not FILE_SAME: {rel_path: verdict}, plus the number of files """
+
+    def __init__(self):
+        self.mismatches = {}
+        self.checked = 0
+
+    def record(self, result):
+        self.checked += 1
+        if result.verdict != FILE_SAME:
+            self.mismatches[result.rel_path] = result.verdict
+
+class JsonLinesSink(ResultSink):
+    """ One JSON object per file, then {"summary": ...} """
+
+    def __init__(self, path):
+        self.out = open(path, 'w')
+        self.counts = dict((name, 0) for name in VERDICTS.values())
+
+    def record(self, result):
+        values = result.as_dict()
+        self.counts[values['verdict']] += 1
+        self.out.write(json.dumps(values, sort_keys=True) + '\n')
+
+    def finish(self, same):
+        self.out.write(json.dumps({ 'summary': { 'same': same, 'files': self.counts } }, sort_keys=True) + '\n')
+        self.out.close()
+
+class JUnitSink(ResultSink):
+    """ JUnit XML, one testcase per file. Test cases are spooled to a temporary
+    file because the testsuite element needs the totals first. """
+
+    def __init__(self, path, suite='image comparison'):
+        self.path = path
+        self.suite = suite
+        self.spool = tempfile.TemporaryFile()
+        self.tests = 0
+        self.failures = 0
+        self.skipped = 0
+        self.seconds = 0.0
+
+    def record(self, result):
+        self.tests += 1
+        self.seconds += result.seconds
+        self.spool.write('  <testcase classname=%s name=%s time="%.6f"' % (
+            quoteattr(result.kind or 'file'), quoteattr(result.rel_path), result.seconds))
+        if result.verdict == FILE_DIFF:
+            self.failures += 1
+            self.spool.write('>\n    <failure message="doesn\'t match"/>\n  </testcase>\n')
+        elif result.verdict == FILE_MISS:
+            self.failures += 1
+            self.spool.write('>\n    <failure message="missing"/>\n  </testcase>\n')
+        elif result.verdict == FILE_EXTRA:
+            self.failures += 1
+            self.spool.write('>\n    <failure message="only in local image"/>\n  </testcase>\n')
+        elif result.verdict == FILE_MISS_ALLOWED:
+            self.skipped += 1
+            self.spool.write('>\n    <skipped message="allowed missing"/>\n  </testcase>\n')
+        else:
+            self.spool.write('/>\n')
+
+    def finish(self, same):
+        with open(self.path, 'w') as out:
+            out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            out.write('<testsuite name=%s tests="%d" failures="%d" errors="0" skipped="%d" time="%.6f">\n' % (
+                quoteattr(self.suite), self.tests, self.failures, self.skipped, self.seconds))
+            self.spool.seek(0)
+            shutil.copyfileobj(self.spool, out)
+            out.write('</testsuite>\n')
+        self.spool.close()
+
+def numbered_path(path, number):
+    """ out.jsonl -> out.3.jsonl, for one output file per batch candidate """
+    root, ext = os.path.splitext(path)
+    return '%s.%d%s' % (root, number, ext)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""External tools (readelf, sudo mount, lsof, ...) run under concurrency limits.
+
+Every child goes through a ToolRunner: at most max_procs of them run at a
+time, and at most limits[tool] of one tool, tool being the basename of the
+command. stdout is handed to the caller as a pipe to stream from, stderr is
+spooled to a temporary file so that neither pipe can fill up and block the
+tool. Each child leads its own session and process group, so that a timeout
+or terminate_all() (e.g. on SIGINT before images are unmounted) stops
+anything the tool started as well. Foreground tools (sudo) are the
+exception: they stay in the caller's process group, which keeps the
+controlling terminal sudo asks for a password on, and only they are signalled.
+After stop() (on SIGINT/SIGTERM) only foreground tools start any more, so
+that a thread waiting for a slot cannot start a child nobody reaps while
+sudo umount still runs.
+
+Comparisons already run on a thread pool, so a tool runs in the calling
+thread and limits are semaphores (asyncio does not exist in Python 2).
+share_limits() turns the per-tool ones into process-shared semaphores
+before worker processes are forked."""
+
+import os, sys, signal, subprocess, tempfile, threading, time, multiprocessing
+
+# mount and umount allocate loop devices, do not race them
+DEFAULT_LIMITS = { 'sudo': 1 }
+# tools that may prompt on the terminal, not moved to a session of their own
+FOREGROUND_TOOLS = ('sudo',)
+# seconds terminate_all() waits for SIGTERM before SIGKILL
+TERMINATE_GRACE = 2.0
+# run() timeout argument meaning the runner's default
+DEFAULT = object()
+
+class ToolError(Exception):
+    pass
+
+class ToolTimeout(ToolError):
+    pass
+
+class ToolRunner(object):
+
+    def __init__(self, max_procs=None, limits=None, timeout=None, grace=TERMINATE_GRACE, foreground=FOREGROUND_TOOLS):
+        self.slots = threading.BoundedSemaphore(max_procs or multiprocessing.cpu_count())
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits.update(limits or {})
+        self.toolSlots = {}
+        self.timeout = timeout
+        self.grace = grace
+        self.foreground = set(foreground)
+        # reentrant: terminate_all() runs from signal handlers, which may interrupt
+        # the main thread while it holds the lock in start() or finish()
+        self.lock = threading.RLock()
+        # running Popen: semaphores it holds
+        self.children = {}
+        self.expired = set()
+        self.stopped = False
+
+    def tool_slots(self, tool):
+        """ Semaphore of tool, None if only the global limit applies """
+        with self.lock:
+            if tool not in self.toolSlots:
+                limit = self.limits.get(tool)
+                self.toolSlots[tool] = threading.BoundedSemaphore(limit) if limit else None
+            return self.toolSlots[tool]
+
+    def share_limits(self):
+        """ Make the per-tool limits hold across processes forked from now on, e.g.
+        multiprocessing.Pool workers: each has its own runner, sudo must still run alone """
+        with self.lock:
+            for tool, limit in self.limits.items():
+                self.toolSlots[tool] = multiprocessing.BoundedSemaphore(limit) if limit else None
+
+    def start(self, cmd, **kwargs):
+        """ Popen(cmd) once the limits allow it; finish() it """
+        tool = os.path.basename(cmd[0])
+        held = [semaphore for semaphore in (self.tool_slots(tool), self.slots) if semaphore]
+        for semaphore in held:
+            semaphore.acquire()
+        try:
+            # under the lock, stop() must either see the child or keep it from starting
+            with self.lock:
+                if self.stopped and tool not in self.foreground:
+                    raise ToolError('%s: not started, stopping' % ' '.join(cmd))
+                proc = subprocess.Popen(cmd, preexec_fn=None if tool in self.foreground else os.setsid, **kwargs)
+                self.children[proc] = held
+        except:
+            for semaphore in held:
+                semaphore.release()
+            raise
+        return proc
+
+    def finish(self, proc):
+        """ Reap proc and free its slots; True unless it was killed for its timeout """
+        try:
+            proc.wait()
+        except OSError:
+            # reaped by terminate_all() in another thread
+            pass
+        with self.lock:
+            held = self.children.pop(proc, [])
+            timedOut = proc in self.expired
+            self.expired.discard(proc)
+        for semaphore in held:
+            semaphore.release()
+        return not timedOut
+
+    def expire(self, proc):
+        with self.lock:
+            if proc not in self.children:
+                return
+            self.expired.add(proc)
+        kill(proc)
+
+    def run(self, cmd, consume=None, timeout=DEFAULT):
+        """ Run cmd, returns (consume(stdout pipe), stderr output, exit code).
+        Without consume stdout is not redirected. Raises ToolTimeout when cmd
+        ran longer than timeout seconds (default: the runner's timeout). """
+        if timeout is DEFAULT:
+            timeout = self.timeout
+        err = tempfile.TemporaryFile()
+        try:
+            proc = self.start(cmd, stdout=subprocess.PIPE if consume else None, stderr=err)
+            timer = None
+            if timeout:
+                timer = threading.Timer(timeout, self.expire, [proc])
+                timer.daemon = True
+                timer.start()
+            try:
+                result = consume(proc.stdout) if consume else None
+            finally:
+                if proc.stdout:
+                    proc.stdout.close()
+                if timer:
+                    timer.cancel()
+                completed = self.finish(proc)
+            if not completed:
+                raise ToolTimeout('%s: no result after %s seconds' % (' '.join(cmd), timeout))
+            err.seek(0)
+            return result, err.read(), proc.returncode
+        finally:
+            err.close()
+
+    def check_call(self, cmd, timeout=DEFAULT):
+        """ subprocess.check_call() under the limits """
+        result, err, code = self.run(cmd, timeout=timeout)
+        if err:
+            sys.stderr.write(err)
+        if code:
+            raise subprocess.CalledProcessError(code, cmd)
+        return code
+
+    def running(self):
+        with self.lock:
+            return len(self.children)
+
+    def stop(self):
+        """ Start no more tools but foreground ones and terminate_all() running ones """
+        with self.lock:
+            self.stopped = True
+        return self.terminate_all()
+
+    def terminate_all(self):
+        """ SIGTERM every running child, SIGKILL what is left after the grace period, reap them all """
+        with self.lock:
+            procs = list(self.children)
+        for proc in procs:
+            terminate(proc)
+        deadline = time.time() + self.grace
+        while time.time() < deadline and any(proc.poll() is None for proc in procs):
+            time.sleep(0.01)
+        for proc in procs:
+            if proc.poll() is None:
+                kill(proc)
+            try:
+                proc.wait()
+            except OSError:
+                pass
+        return len(procs)
+
+def signal_group(proc, signum):
+    """ Send signum to the process group proc leads, or to proc only when it
+    stayed in the caller's group (a foreground tool, see ToolRunner.start()) """
+    try:
+        if proc.poll() is None:
+            if os.getpgid(proc.pid) == proc.pid:
+                os.killpg(proc.pid, signum)
+            else:
+                os.kill(proc.pid, signum)
+    except OSError:
+        pass
+
+def terminate(proc):
+    signal_group(proc, signal.SIGTERM)
+
+def kill(proc):
+    signal_group(proc, signal.SIGKILL)
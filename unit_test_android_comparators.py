@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+import os, struct, shutil, tempfile, unittest
+import comparators
+import android_comparators
+from check_files import AFSImageComparator
+from elf_reader import ELFCLASS32, ELFDATA2LSB
+from unit_test_elf_reader import build_elf
+
+def build_odex(dex, deps='deps'):
+    """Dalvik odex: header, embedded dex, then dependencies that may differ"""
+    header_size = struct.calcsize(android_comparators.ODEX_HEADER)
+    return struct.pack(android_comparators.ODEX_HEADER, android_comparators.ODEX_MAGIC, '036\0', header_size, len(dex)) + dex + deps
+
+class UnitTest_android_comparators(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.tester = AFSImageComparator("", "", "")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as out:
+            out.write(data)
+        return path
+
+    def compare(self, name, data1, data2):
+        comparator = comparators.pattern_dict()[name]
+        return comparator(self.tester, self.write('1_' + name.lstrip('*'), data1), self.write('2_' + name.lstrip('*'), data2))
+
+    def test_registered(self):
+        patterns = comparators.pattern_dict()
+        self.assertEqual(sorted(set(c.name for c in patterns.values())), ['archive', 'elf', 'ko', 'oat', 'prop'])
+
+    def test_oat_and_odex(self):
+        self.assertTrue(self.compare('*.oat', build_elf(ELFCLASS32, ELFDATA2LSB, 'code'), build_elf(ELFCLASS32, ELFDATA2LSB, 'code')))
+        self.assertFalse(self.compare('*.oat', build_elf(ELFCLASS32, ELFDATA2LSB, 'code'), build_elf(ELFCLASS32, ELFDATA2LSB, 'edoc')))
+        self.assertTrue(self.compare('*.odex', build_odex('dex\n035'), build_odex('dex\n035', 'other deps')))
+        self.assertFalse(self.compare('*.odex', build_odex('dex\n035'), build_odex('dex\n036')))
+        self.assertFalse(self.compare('*.odex', 'garbage', 'garbage'))
+
+    def test_kernel_module(self):
+        self.assertTrue(self.compare('*.ko', build_elf(ELFCLASS32, ELFDATA2LSB, 'code') + '~Module signature appended~\n',
+                                     build_elf(ELFCLASS32, ELFDATA2LSB, 'code')))
+
+    def test_build_prop(self):
+        prop = '# begin build properties\nro.build.date=%s\nro.product.model=%s\n'
+        self.assertTrue(self.compare('build.prop', prop % ('Mon', 'A'), prop % ('Tue', 'A') + '\n# comment\n'))
+        self.assertFalse(self.compare('build.prop', prop % ('Mon', 'A'), prop % ('Mon', 'B')))
+        self.assertFalse(self.compare('build.prop', prop % ('Mon', 'A'), prop % ('Mon', 'A') + 'ro.extra=1\n'))
+
+if __name__ == '__main__':
+    unittest.main()
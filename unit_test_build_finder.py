@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import os, shutil, tempfile, unittest
+from build_finder import version_key, find_newest_builds, BuildsIndex
+
+class UnitTest_build_finder(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        # (path, mtime): the 2015 directory is old and holds an old package only
+        self.add('2015/01/fastboot-x-1.2.tar.gz', 1000)
+        self.add('2016/01/fastboot-x-1.9.tar.gz', 2000)
+        self.add('2016/02/fastboot-x-1.10.tar.gz', 3000)
+        self.add('2016/02/notes.txt', 3500)
+        for path, mtime in [('2015/01', 1000), ('2015', 1000), ('2016/01', 2000), ('2016/02', 3500), ('2016', 3000)]:
+            os.utime(os.path.join(self.root, path), (mtime, mtime))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def add(self, rel_path, mtime):
+        path = os.path.join(self.root, rel_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_version_key(self):
+        names = ['fastboot-x-1.10.tar.gz', 'fastboot-x-1.9.tar.gz', 'fastboot-x-1.2.tar.gz', 'fastboot-x-2.tar.gz']
+        self.assertEqual(sorted(names, key=version_key),
+                         ['fastboot-x-1.2.tar.gz', 'fastboot-x-1.9.tar.gz', 'fastboot-x-1.10.tar.gz', 'fastboot-x-2.tar.gz'])
+
+    def test_find_newest(self):
+        newest = os.path.join(self.root, '2016/02/fastboot-x-1.10.tar.gz')
+        self.assertEqual(find_newest_builds(self.root, '*.gz'), [newest])
+        self.assertEqual(find_newest_builds(self.root, '*.gz', 'mtime', 2),
+                         [newest, os.path.join(self.root, '2016/01/fastboot-x-1.9.tar.gz')])
+        self.assertEqual(find_newest_builds(self.root, '*.zip'), [])
+        self.assertEqual(find_newest_builds(os.path.join(self.root, 'none'), '*.gz'), [])
+        self.assertRaises(ValueError, find_newest_builds, self.root, '*.gz', 'size')
+        self.assertRaises(ValueError, find_newest_builds, self.root, '*.gz', 'version', prune=True)
+
+    def test_not_in_time_order(self):
+        # builds added to old directories: only their own directory mtime changes
+        older = self.add('A/m/pkg-15.gz', 6000)
+        self.add('B/m/pkg-14.gz', 5000)
+        highest = self.add('old/pkg-2.0.gz', 4000)
+        self.add('new/pkg-1.9.gz', 5500)
+        for path, mtime in [('A', 4100), ('A/m', 6000), ('B', 4500), ('B/m', 5000), ('old', 4000), ('new', 5500)]:
+            os.utime(os.path.join(self.root, path), (mtime, mtime))
+        self.assertEqual(find_newest_builds(self.root, 'pkg-*.gz', 'mtime'), [older])
+        self.assertEqual(find_newest_builds(self.root, 'pkg-*.gz'), [older])
+        self.assertEqual(find_newest_builds(self.root, 'pkg-[12].*.gz'), [highest])
+
+    def test_pruning(self):
+        index = BuildsIndex('*.gz')
+        find_newest_builds(self.root, '*.gz', 'mtime', prune=True, index=index)
+        # root, 2016, 2016/02; 2016/01 and 2015 are older than the package found
+        self.assertEqual(sorted(index.dirs), [self.root, os.path.join(self.root, '2016'), os.path.join(self.root, '2016/02')])
+        index = BuildsIndex('*.gz')
+        find_newest_builds(self.root, '*.gz', 'mtime', index=index)
+        self.assertEqual(index.listed, 6)
+
+    def test_index(self):
+        path = os.path.join(self.root, 'builds.idx')
+        index = BuildsIndex('*.gz', path)
+        find_newest_builds(self.root, '*.gz', index=index)
+        index.save()
+        # the index file itself changed the root directory
+        index = BuildsIndex('*.gz', path)
+        find_newest_builds(self.root, '*.gz', index=index)
+        self.assertEqual((index.listed, index.reused), (1, 5))
+        newer = self.add('2016/03/fastboot-x-1.11.tar.gz', 4000)
+        os.utime(os.path.join(self.root, '2016'), (4000, 4000))
+        os.utime(os.path.join(self.root, '2016/03'), (4000, 4000))
+        self.assertEqual(find_newest_builds(self.root, '*.gz', index=index), [newer])
+        # other pattern: the index is not used
+        self.assertEqual(BuildsIndex('*.zip', path).dirs, {})
+
+if __name__ == '__main__':
+    unittest.main()
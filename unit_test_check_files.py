@@ -1,7 +1,28 @@
 #!/usr/bin/env python
 
-import sys, unittest
-from check_files import AFSImageComparator, FAIL_COLOR, WARNING_COLOR, OK_COLOR, END_COLOR
+import os, sys, time, shutil, tempfile, zipfile, subprocess, unittest, StringIO, threading
+from multiprocessing.pool import ThreadPool
+from check_files import AFSImageComparator, MountedTree, scan_tree, merge_trees, print_batch_matrix, lpt_imap, \
+    IN_BOTH, EXT_ONLY, LOCAL_ONLY, FAIL_COLOR, WARNING_COLOR, OK_COLOR, END_COLOR
+from path_rules import RuleSet
+from result_sinks import MismatchSink
+from hash_cache import HashCache
+from ext4_image import Ext4Image
+from unit_test_ext4_image import have_mke2fs
+from chunking import MIN_FILE_SIZE
+import profiler
+import comparators
+
+MANIFEST = 'Manifest-Version: 1.0\r\n\r\nName: classes.dex\r\nSHA1-Digest: %s\r\n\r\n'
+
+def make_archive(path, manifest, dex, extra=''):
+    archive = zipfile.ZipFile(path, 'w')
+    if manifest is not None:
+        archive.writestr('META-INF/MANIFEST.MF', manifest)
+    archive.writestr('classes.dex', dex)
+    archive.writestr('res/raw.txt', extra)
+    archive.close()
+    return path
 
 class UnitTest_check_files(unittest.TestCase):
 
@@ -14,5 +35,327 @@ class UnitTest_check_files(unittest.TestCase):
         res = tester.compare_shared_object('unit_test_files/so_.text_differ/local_libbcc.so', 'unit_test_files/so_.text_differ/remote_libbcc.so')
         self.assertFalse(res)
 
+    def test_scan_tree(self):
+        root = tempfile.mkdtemp()
+        try:
+            for d in ['a', 'a/b', 'a0', '.hidden']:
+                os.mkdir(os.path.join(root, d))
+            for f in ['a.so', 'a/x.jar', 'a/b/y.so', 'a0/z.apk', 'a/.dot.so', '.hidden/h.so', 'a/readme.txt']:
+                open(os.path.join(root, f), 'w').close()
+            os.symlink(os.path.join(root, 'a'), os.path.join(root, 'link'))
+            found = list(scan_tree(root, {'*.so': 'so', '*.jar': 'java', '*.apk': 'java'}))
+            self.assertEqual(found, [('/.hidden/h.so', 'so'), ('/a.so', 'so'), ('/a/b/y.so', 'so'),
+                                     ('/a/x.jar', 'java'), ('/a0/z.apk', 'java')])
+            self.assertEqual([p for p, _ in found], sorted(p for p, _ in found))
+        finally:
+            shutil.rmtree(root)
+
+    def test_merge_trees(self):
+        merged = list(merge_trees([('/a', 1), ('/b', 2), ('/d', 4)], iter([('/a', 0), ('/c', 3), ('/d', 0), ('/e', 5)])))
+        self.assertEqual(merged, [('/a', 1, IN_BOTH), ('/b', 2, EXT_ONLY), ('/c', 3, LOCAL_ONLY), ('/d', 4, IN_BOTH),
+                                  ('/e', 5, LOCAL_ONLY)])
+        self.assertEqual(list(merge_trees([], [('/a', 0)])), [('/a', 0, LOCAL_ONLY)])
+
+    def test_run_both_trees(self):
+        root = tempfile.mkdtemp()
+        try:
+            trees = []
+            for side, files in [('local', {'build.prop': 'a=1\n', 'lib/new.so': '', 'lib/debug.so': '', 'lib/allowed.so': ''}),
+                                ('ext', {'build.prop': 'a=1\n', 'lib/gone.so': '', 'lib/allowed.so': '', 'lib/kept.so': ''})]:
+                os.makedirs(os.path.join(root, side, 'lib'))
+                for name, data in files.items():
+                    with open(os.path.join(root, side, name), 'w') as out:
+                        out.write(data)
+                trees.append((os.path.join(root, side) + '/', MountedTree(os.path.join(root, side))))
+            rules = RuleSet()
+            rules.add('allow-missing', '/lib/kept.so')
+            rules.add('ignore', '/lib/debug.so')
+            tester = AFSImageComparator("", "", root, rules=rules)
+            (tester.localMountpointPath, tester.localTree), (tester.extMountpointPath, tester.extTree) = trees
+            tester.trees = trees
+            mismatches = MismatchSink()
+            stdout = sys.stdout
+            sys.stdout = StringIO.StringIO()
+            try:
+                self.assertFalse(tester.run([mismatches]))
+            finally:
+                sys.stdout = stdout
+            self.assertEqual(mismatches.mismatches, {'/lib/new.so': AFSImageComparator.FILE_EXTRA,
+                                                     '/lib/gone.so': AFSImageComparator.FILE_MISS,
+                                                     '/lib/kept.so': AFSImageComparator.FILE_MISS_ALLOWED})
+            # build.prop has no comparator without the android_comparators plugin
+            self.assertEqual((mismatches.checked, tester.ignoredFiles), (4, 1))
+        finally:
+            shutil.rmtree(root)
+
+    def test_run_against_index_and_hash_cache(self):
+        root = tempfile.mkdtemp()
+        try:
+            trees = []
+            for side, files, digest in [('local', {'lib/same.so': 'x', 'lib/new.so': ''}, 'abc='),
+                                        ('ext', {'lib/same.so': 'x', 'lib/gone.so': ''}, 'def=')]:
+                os.makedirs(os.path.join(root, side, 'lib'))
+                os.makedirs(os.path.join(root, side, 'app'))
+                for name, data in files.items():
+                    with open(os.path.join(root, side, name), 'w') as out:
+                        out.write(data)
+                make_archive(os.path.join(root, side, 'app', 'Same.apk'), MANIFEST % 'abc=', 'dex')
+                make_archive(os.path.join(root, side, 'app', 'Diff.apk'), MANIFEST % digest, 'dex ' + side)
+                trees.append((os.path.join(root, side) + '/', MountedTree(os.path.join(root, side))))
+            def run(hashCache=None, extIndex=None):
+                # a work dir each, they are named after the current second
+                tester = AFSImageComparator("", "", tempfile.mkdtemp(dir=root), hashCache=hashCache, extIndex=extIndex,
+                                            rules=RuleSet())
+                tester.localMountpointPath, tester.localTree = trees[0]
+                tester.trees = trees[:1]
+                if extIndex is None:
+                    tester.extMountpointPath, tester.extTree = trees[1]
+                    tester.extImageKey = 'ext'
+                    tester.trees = trees
+                mismatches = MismatchSink()
+                stdout = sys.stdout
+                sys.stdout = StringIO.StringIO()
+                try:
+                    self.assertFalse(tester.run([mismatches]))
+                finally:
+                    sys.stdout = stdout
+                return tester, mismatches
+            expected = {'/app/Diff.apk': AFSImageComparator.FILE_DIFF, '/lib/gone.so': AFSImageComparator.FILE_MISS,
+                        '/lib/new.so': AFSImageComparator.FILE_EXTRA}
+            hashCache = HashCache(os.path.join(root, 'cache.db'))
+            try:
+                tester, mismatches = run(hashCache)
+                self.assertEqual((mismatches.mismatches, mismatches.checked), (expected, 5))
+                self.assertEqual(hashCache.hits, 0)
+                misses = hashCache.misses
+                self.assertTrue(misses > 0)
+                # ext hashes come from the cache the second time
+                tester, mismatches = run(hashCache)
+                self.assertEqual((mismatches.mismatches, mismatches.checked), (expected, 5))
+                self.assertEqual((hashCache.hits, hashCache.misses), (misses, misses))
+                stdout = sys.stdout
+                sys.stdout = StringIO.StringIO()
+                try:
+                    index = tester.build_index()
+                finally:
+                    sys.stdout = stdout
+            finally:
+                hashCache.close()
+            self.assertEqual(sorted(rel_path for rel_path, pattern in index.items()),
+                             ['/app/Diff.apk', '/app/Same.apk', '/lib/gone.so', '/lib/same.so'])
+            # nothing is read from the ext tree any more
+            shutil.rmtree(os.path.join(root, 'ext'))
+            tester, mismatches = run(extIndex=index)
+            self.assertEqual((mismatches.mismatches, mismatches.checked), (expected, 5))
+        finally:
+            shutil.rmtree(root)
+
+    def test_mounted_tree_listed_links(self):
+        root = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(root, 'lib'))
+            with open(os.path.join(root, 'lib', 'libfoo.so'), 'w') as out:
+                out.write('foo')
+            os.symlink('/lib/libfoo.so', os.path.join(root, 'lib', 'abs.so'))
+            tree = MountedTree(root)
+            self.assertEqual(tree.list_entries('/lib'), [('abs.so', False, True), ('libfoo.so', False, True)])
+            lstat = os.lstat
+            calls = []
+            os.lstat = lambda path: calls.append(path) or lstat(path)
+            try:
+                # the listing told which names are links, nothing is looked up again
+                self.assertEqual(tree.hostPath('/lib/libfoo.so'), os.path.join(root, 'lib', 'libfoo.so'))
+                self.assertEqual(calls, [])
+                self.assertEqual(tree.hostPath('/lib/abs.so'), os.path.join(root, 'lib', 'libfoo.so'))
+            finally:
+                os.lstat = lstat
+            tester = AFSImageComparator("", "", root)
+            self.assertEqual(tester.hashOfFile(os.path.join(root, 'lib', 'gone.so')), None)
+            self.assertEqual(tester.hashOfFile(os.path.join(root, 'lib')), None)
+        finally:
+            shutil.rmtree(root)
+
+    @unittest.skipUnless(have_mke2fs(), 'mke2fs is not available')
+    def test_run_symlinks_mounted_and_image(self):
+        root = tempfile.mkdtemp()
+        try:
+            # a symlink on each side, where the other side has a regular file
+            sides = {'local': {'/lib/libfoo.so': 'foo', '/lib/link.so': ('libfoo.so',), '/lib/abs.so': 'foo'},
+                     'ext': {'/lib/libfoo.so': 'foo', '/lib/link.so': 'foo', '/lib/abs.so': ('/lib/libfoo.so',)}}
+            for side, files in sides.items():
+                os.makedirs(os.path.join(root, side, 'lib'))
+                for rel_path, data in files.items():
+                    if isinstance(data, tuple):
+                        os.symlink(data[0], os.path.join(root, side) + rel_path)
+                    else:
+                        with open(os.path.join(root, side) + rel_path, 'w') as out:
+                            out.write(data)
+            image = os.path.join(root, 'ext.img')
+            with open(os.devnull, 'w') as dev_null:
+                subprocess.check_call(['mke2fs', '-q', '-F', '-t', 'ext4', '-d', os.path.join(root, 'ext'), image, '4M'],
+                                      stdout=dev_null, stderr=dev_null)
+            patterns = {'*.so': 'so'}
+            for side in sides:
+                self.assertEqual(list(scan_tree('/', patterns, MountedTree(os.path.join(root, side)).list_entries)),
+                                 [('/lib/abs.so', 'so'), ('/lib/libfoo.so', 'so'), ('/lib/link.so', 'so')])
+            self.assertEqual(list(scan_tree('/', patterns, Ext4Image(image).list_entries)),
+                             list(scan_tree('/', patterns, MountedTree(os.path.join(root, 'ext')).list_entries)))
+            tester = AFSImageComparator("", "", root, rules=RuleSet())
+            trees = [(os.path.join(root, 'local') + '/', MountedTree(os.path.join(root, 'local'))),
+                     (os.path.join(root, 'ext_img') + '/', Ext4Image(image))]
+            (tester.localMountpointPath, tester.localTree), (tester.extMountpointPath, tester.extTree) = trees
+            tester.trees = trees
+            mismatches = MismatchSink()
+            stdout = sys.stdout
+            sys.stdout = StringIO.StringIO()
+            try:
+                self.assertTrue(tester.run([mismatches]))
+            finally:
+                sys.stdout = stdout
+            self.assertEqual((mismatches.mismatches, mismatches.checked), ({}, 3))
+        finally:
+            shutil.rmtree(root)
+
+    def test_run_jobs_output_order(self):
+        class Noisy(comparators.Comparator):
+            name = 'noisy'
+            patterns = ('*.txt',)
+            def compare(self, tester, path1, path2):
+                time.sleep(0.001 * (len(path1) % 5))
+                print '\nno match in ' + os.path.basename(path1)
+                return False
+        saved = comparators.registered()
+        root = tempfile.mkdtemp()
+        try:
+            comparators.register(Noisy)
+            names = ['f%02d.txt' % i for i in range(20)]
+            for side in ('local', 'ext'):
+                os.makedirs(os.path.join(root, side))
+                for name in names:
+                    with open(os.path.join(root, side, name), 'w') as out:
+                        out.write(side + name)
+            tester = AFSImageComparator("", "", root, jobs=4, rules=RuleSet())
+            trees = [(os.path.join(root, side) + '/', MountedTree(os.path.join(root, side))) for side in ('local', 'ext')]
+            (tester.localMountpointPath, tester.localTree), (tester.extMountpointPath, tester.extTree) = trees
+            tester.trees = trees
+            stdout = sys.stdout
+            sys.stdout = StringIO.StringIO()
+            try:
+                self.assertFalse(tester.run())
+                lines = [line for line in sys.stdout.getvalue().splitlines() if line]
+            finally:
+                sys.stdout = stdout
+            # each diagnostic right before the verdict of its file
+            expected = []
+            for name in names:
+                expected += ['no match in ' + name, '/' + name + FAIL_COLOR + " doesn't match!" + END_COLOR]
+            self.assertEqual(lines[:len(expected)], expected)
+        finally:
+            comparators._registry[:] = saved
+            shutil.rmtree(root)
+
+    def test_are_apk_same(self):
+        tester = AFSImageComparator("","","")
+        root = tempfile.mkdtemp()
+        try:
+            apk = lambda name, *args: make_archive(os.path.join(root, name), *args)
+            same = apk('same.apk', MANIFEST % 'abc=', 'dex')
+            # identical central directory
+            self.assertTrue(tester.are_apk_same(same, apk('same_copy.apk', MANIFEST % 'abc=', 'dex')))
+            # other bytes but same manifest digests
+            self.assertTrue(tester.are_apk_same(same, apk('resigned.apk', MANIFEST % 'abc=', 'dex', 'x')))
+            self.assertFalse(tester.are_apk_same(same, apk('diff.apk', MANIFEST % 'xyz=', 'dex2')))
+            # an entry only in the local manifest differs too
+            extra = MANIFEST % 'abc=' + 'Name: classes2.dex\r\nSHA1-Digest: def=\r\n\r\n'
+            self.assertFalse(tester.are_apk_same(same, apk('extra.apk', extra, 'dex', 'x')))
+            self.assertEqual(tester.compare_manifest_dicts({'classes.dex': {'SHA1': 'abc='}}, {}), AFSImageComparator.MF_DIFF)
+            # no manifest digests: classes.dex decides
+            null = apk('null.apk', None, 'dex')
+            self.assertTrue(tester.are_apk_same(null, apk('null_same.apk', '', 'dex', 'x')))
+            self.assertFalse(tester.are_apk_same(null, apk('null_diff.apk', None, 'dex2', 'x')))
+        finally:
+            shutil.rmtree(root)
+
+    def test_are_apk_same_profiled(self):
+        tester = AFSImageComparator("","","")
+        root = tempfile.mkdtemp()
+        profiler.reset()
+        profiler.enable()
+        try:
+            same = make_archive(os.path.join(root, 'same.apk'), MANIFEST % 'abc=', 'dex')
+            self.assertTrue(tester.are_apk_same(same, same))
+            rows = dict(((row['phase'], row['type']), row) for row in profiler.summary())
+            self.assertEqual(rows[('unzip', '.apk')]['count'], 1)
+            self.assertEqual(rows[('unzip', '.apk')]['bytes'], 2 * os.path.getsize(same))
+        finally:
+            profiler.disable()
+            profiler.reset()
+            shutil.rmtree(root)
+
+    def test_chunk_diff_min_size(self):
+        tester = AFSImageComparator("","","")
+        root = tempfile.mkdtemp()
+        try:
+            for name, size in [('small1', 1000), ('small2', 1000), ('large1', MIN_FILE_SIZE), ('large2', MIN_FILE_SIZE)]:
+                with open(os.path.join(root, name), 'wb') as out:
+                    out.write(os.urandom(size))
+            comparator = comparators.Comparator()
+            output = StringIO.StringIO()
+            stdout = sys.stdout
+            sys.stdout = output
+            try:
+                tester.print_chunk_diff(os.path.join(root, 'small1'), os.path.join(root, 'small2'), comparator)
+                self.assertEqual(output.getvalue(), '')
+                tester.print_chunk_diff(os.path.join(root, 'large1'), os.path.join(root, 'large2'), comparator)
+            finally:
+                sys.stdout = stdout
+            self.assertTrue(output.getvalue().startswith('\nchanged file bytes: %d of %d' % (MIN_FILE_SIZE, MIN_FILE_SIZE)))
+        finally:
+            shutil.rmtree(root)
+
+    def test_print_batch_matrix(self):
+        outcomes = [(False, {'/lib/a.so': AFSImageComparator.FILE_DIFF, '/lib/b.so': AFSImageComparator.FILE_MISS}, 5),
+                    (True, {}, 5),
+                    (True, {'/lib/b.so': AFSImageComparator.FILE_MISS_ALLOWED}, 5)]
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            print_batch_matrix(['v1', 'v2', 'v3'], outcomes)
+            lines = sys.stdout.getvalue().splitlines()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(lines[2].split(), ['0', 'FAIL', '5', '1', '1', '0', '0', 'v1'])
+        self.assertEqual(lines[4].split(), ['2', 'OK', '5', '0', '0', '1', '0', 'v3'])
+        self.assertEqual([line.split() for line in lines[-2:]], [['D', '.', '.', '/lib/a.so'], ['M', '.', 'm', '/lib/b.so']])
+
+    def test_lpt_imap(self):
+        started = []
+        lock = threading.Lock()
+        def work(item):
+            with lock:
+                started.append(item)
+            time.sleep(0.001 * item)
+            return item * 10
+        pool = ThreadPool(1)
+        try:
+            self.assertEqual(list(lpt_imap(pool, work, [1, 5, 2, 4, 3], lambda item: item, 1)), [10, 50, 20, 40, 30])
+            self.assertEqual(started, [5, 4, 3, 2, 1])
+            # only the next window items are looked at, and read from items
+            del started[:]
+            taken = []
+            def items():
+                for item in [1, 5, 2, 4, 3]:
+                    taken.append(item)
+                    yield item
+            results = lpt_imap(pool, work, items(), lambda item: item, 1, window=2)
+            self.assertEqual(results.next(), 10)
+            self.assertTrue(len(taken) <= 3)
+            self.assertEqual(list(results), [50, 20, 40, 30])
+            self.assertEqual(started, [5, 1, 4, 2, 3])
+            self.assertRaises(ZeroDivisionError, list, lpt_imap(pool, lambda item: 1 / item, [1, 0], lambda item: 0, 1))
+        finally:
+            pool.terminate()
+            pool.join()
+
 if __name__ == '__main__':
     unittest.main()
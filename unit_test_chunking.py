@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+import random, unittest, StringIO
+from chunking import chunk_stream, encode_chunks, decode_chunks, changed_ranges, MIN_CHUNK, MAX_CHUNK
+
+class ShortReads(object):
+    """File that returns at most size bytes per read, whatever is asked for"""
+
+    def __init__(self, data, size):
+        self.data = StringIO.StringIO(data)
+        self.size = size
+
+    def read(self, n):
+        return self.data.read(self.size)
+
+def random_bytes(n, seed=1):
+    rng = random.Random(seed)
+    return ''.join(chr(rng.randint(0, 255)) for _ in xrange(n))
+
+class UnitTest_chunking(unittest.TestCase):
+
+    def setUp(self):
+        self.data = random_bytes(600 * 1024)
+        self.chunks = list(chunk_stream(StringIO.StringIO(self.data)))
+
+    def test_bounds_and_read_size(self):
+        self.assertEqual(sum(length for length, digest in self.chunks), len(self.data))
+        self.assertTrue(len(self.chunks) > 3)
+        for length, digest in self.chunks[:-1]:
+            self.assertTrue(MIN_CHUNK <= length <= MAX_CHUNK)
+        self.assertEqual(list(chunk_stream(ShortReads(self.data, 1000))), self.chunks)
+        self.assertEqual(len(list(chunk_stream(StringIO.StringIO('\0' * 3 * MAX_CHUNK)))), 3)
+        self.assertEqual(list(chunk_stream(StringIO.StringIO(''))), [])
+
+    def test_insertion_is_localized(self):
+        middle = len(self.data) / 2
+        edited = self.data[:middle] + 'inserted' + self.data[middle:]
+        ranges = changed_ranges(list(chunk_stream(StringIO.StringIO(edited))), self.chunks)
+        self.assertEqual(len(ranges), 1)
+        offset, length = ranges[0]
+        self.assertTrue(offset <= middle < offset + length)
+        self.assertTrue(length <= 2 * MAX_CHUNK)
+        self.assertEqual(changed_ranges(self.chunks, self.chunks), [])
+
+    def test_encoding(self):
+        self.assertEqual(decode_chunks(encode_chunks(self.chunks)), self.chunks)
+        self.assertEqual(decode_chunks(''), [])
+
+if __name__ == '__main__':
+    unittest.main()
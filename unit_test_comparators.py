@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+import os, shutil, tempfile, unittest
+import comparators
+from check_files import AFSImageComparator
+
+class UnitTest_comparators(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.tester = AFSImageComparator("", "", "")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as out:
+            out.write(data)
+        return path
+
+    def test_registry(self):
+        patterns = comparators.pattern_dict()
+        self.assertEqual(sorted(set(c.name for c in patterns.values())), ['archive', 'elf'])
+        self.assertTrue(comparators.by_name('exact') is not None)
+
+        class OdexOnly(comparators.Comparator):
+            name = 'odex-only'
+            patterns = ('*.odex',)
+            startupCost = 1.0
+            bytesPerSecond = 100
+        saved = comparators.registered()
+        try:
+            comparators.register(OdexOnly)
+            self.assertEqual(comparators.pattern_dict()['*.odex'].name, 'odex-only')
+            self.assertEqual(comparators.pattern_dict()['*.so'].name, 'elf')
+            self.assertEqual(comparators.by_name('odex-only').cost(300), 4.0)
+            comparators.register(OdexOnly())
+            self.assertEqual(len(comparators.registered()), len(saved) + 1)
+        finally:
+            comparators._registry[:] = saved
+
+    def test_default_compare(self):
+        # without a compare() of its own a comparator wants byte-identical files
+        comparator = comparators.Comparator()
+        same = self.write('a', 'content')
+        self.assertTrue(comparator(self.tester, same, self.write('b', 'content')))
+        self.assertFalse(comparator(self.tester, same, self.write('c', 'other!!')))
+
+if __name__ == '__main__':
+    unittest.main()
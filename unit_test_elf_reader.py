@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import struct, hashlib, unittest
+from elf_reader import ElfFile, ElfError, diff_elf, ELFCLASS32, ELFCLASS64, ELFDATA2LSB, ELFDATA2MSB, EHDR_FORMAT, SHDR_FORMAT, ENDIAN
+
+def build_elf(elfclass, data, text):
+    """Minimal ELF with null, .text and .shstrtab sections"""
+    endian = ENDIAN[data]
+    ehdr_size = 16 + struct.calcsize(endian + EHDR_FORMAT[elfclass])
+    shdr_size = struct.calcsize(endian + SHDR_FORMAT[elfclass])
+    shstrtab = '\0.text\0.shstrtab\0'
+    text_offset = ehdr_size
+    strtab_offset = text_offset + len(text)
+    shoff = strtab_offset + len(shstrtab)
+    ident = '\x7fELF' + chr(elfclass) + chr(data) + '\x01' + '\0' * 9
+    ehdr = ident + struct.pack(endian + EHDR_FORMAT[elfclass], 3, 40, 1, 0, 0, shoff, 0, ehdr_size, 0, 0, shdr_size, 3, 2)
+    shdrs = struct.pack(endian + SHDR_FORMAT[elfclass], 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+    shdrs += struct.pack(endian + SHDR_FORMAT[elfclass], 1, 1, 6, 0, text_offset, len(text), 0, 0, 4, 0)
+    shdrs += struct.pack(endian + SHDR_FORMAT[elfclass], 7, 3, 0, 0, strtab_offset, len(shstrtab), 0, 0, 1, 0)
+    return ehdr + text + shstrtab + shdrs
+
+class UnitTest_elf_reader(unittest.TestCase):
+
+    def test_classes_and_endianness(self):
+        for elfclass in (ELFCLASS32, ELFCLASS64):
+            for data in (ELFDATA2LSB, ELFDATA2MSB):
+                elf = ElfFile(data=build_elf(elfclass, data, 'CODE' * 3))
+                self.assertEqual([s.name for s in elf.sections], ['', '.text', '.shstrtab'])
+                self.assertEqual(str(elf.section_data(elf.section('.text'))), 'CODE' * 3)
+
+    def test_hash_sections(self):
+        same1 = ElfFile(data=build_elf(ELFCLASS32, ELFDATA2LSB, 'abcd'))
+        same2 = ElfFile(data=build_elf(ELFCLASS64, ELFDATA2MSB, 'abcd'))
+        other = ElfFile(data=build_elf(ELFCLASS32, ELFDATA2LSB, 'abce'))
+        digest = same1.hash_sections(['.text'], hashlib.sha1())
+        self.assertEqual(digest, same2.hash_sections(['.text'], hashlib.sha1()))
+        self.assertNotEqual(digest, other.hash_sections(['.text'], hashlib.sha1()))
+        self.assertNotEqual(same1.hash_sections(['.text', '.rodata'], hashlib.sha1()), digest)
+
+    def test_not_elf(self):
+        self.assertRaises(ElfError, ElfFile, data='PK\x03\x04' + '\0' * 60)
+        self.assertRaises(ElfError, ElfFile, data=build_elf(ELFCLASS32, ELFDATA2LSB, 'x')[:60])
+    def test_diff_blocks(self):
+        elf1 = ElfFile(data=build_elf(ELFCLASS32, ELFDATA2LSB, 'a' * 40))
+        elf2 = ElfFile(data=build_elf(ELFCLASS32, ELFDATA2LSB, 'a' * 20 + 'b' + 'a' * 23))
+        self.assertEqual(diff_elf(elf1, elf1, ['.text', '.rodata']), [])
+        self.assertEqual(diff_elf(elf1, elf2, ['.text', '.rodata'], 16),
+                         ['.text: 2 of 3 blocks differ at 0x10, 0x20, size 40 -> 44'])
+
+    def test_diff_symbols(self):
+        with open('unit_test_files/so_.text_same/local_camera.omap4.so', 'rb') as so:
+            data = so.read()
+        elf = ElfFile(data=data)
+        name, value, size, type, shndx = sorted(elf.symbols(), key=lambda sym: -sym[2])[0]
+        offset = elf.sections[shndx].offset + value - elf.sections[shndx].addr
+        changed = ElfFile(data=data[:offset] + chr(ord(data[offset]) ^ 1) + data[offset + 1:])
+        lines = diff_elf(elf, changed, ['.text'])
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('.text: 1 of '))
+        self.assertEqual(lines[1], 'symbols changed: ' + name)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+import os, struct, shutil, tempfile, subprocess, unittest
+from ext4_image import Ext4Image, Ext4Error, SPARSE_MAGIC, SPARSE_HEADER, SPARSE_CHUNK_HEADER, \
+    CHUNK_TYPE_RAW, CHUNK_TYPE_FILL, CHUNK_TYPE_DONT_CARE
+from check_files import scan_fs_tree
+
+def have_mke2fs():
+    try:
+        with open(os.devnull, 'w') as dev_null:
+            subprocess.call(['mke2fs', '-V'], stdout=dev_null, stderr=dev_null)
+        return True
+    except OSError:
+        return False
+
+def to_sparse(raw_path, sparse_path, block_size=4096):
+    """Android sparse image of raw_path: zero blocks as DONT_CARE, 0xff blocks as FILL"""
+    with open(raw_path, 'rb') as raw:
+        data = raw.read()
+    chunks = []
+    for offset in xrange(0, len(data), block_size):
+        block = data[offset:offset + block_size]
+        if block == '\0' * block_size:
+            chunks.append(struct.pack(SPARSE_CHUNK_HEADER, CHUNK_TYPE_DONT_CARE, 0, 1, 12))
+        elif block == '\xff' * block_size:
+            chunks.append(struct.pack(SPARSE_CHUNK_HEADER, CHUNK_TYPE_FILL, 0, 1, 16) + '\xff' * 4)
+        else:
+            chunks.append(struct.pack(SPARSE_CHUNK_HEADER, CHUNK_TYPE_RAW, 0, 1, 12 + block_size) + block)
+    with open(sparse_path, 'wb') as out:
+        out.write(struct.pack(SPARSE_HEADER, SPARSE_MAGIC, 1, 0, 28, 12, block_size,
+                              len(data) // block_size, len(chunks), 0))
+        out.write(''.join(chunks))
+
+@unittest.skipUnless(have_mke2fs(), 'mke2fs is not available')
+class UnitTest_ext4_image(unittest.TestCase):
+
+    FILES = {
+        '/lib/libfoo.so': 'ELF' * 1000,
+        '/lib/big.bin': os.urandom(3 * 1024 * 1024 + 17),
+        '/app/Small.apk': 'x' * 100,
+        '/app/deep/dir/tiny.jar': 'tiny',
+        '/ones.bin': '\xff' * 8192 + 'tail',
+    }
+
+    LINKS = {
+        '/link.so': 'lib/libfoo.so',
+        '/app/deep/up.jar': '../Small.apk',
+        # absolute targets start from the image root
+        '/lib/abs.so': '/lib/libfoo.so',
+        # longer than the 60 bytes of a fast symlink
+        '/long.so': './lib/../lib/../lib/../lib/../lib/../lib/../lib/../lib/libfoo.so',
+        # symlinked directories are not walked
+        '/libdir': 'lib',
+        '/dangling.so': 'lib/none.so',
+        '/loop.so': 'loop.so',
+    }
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.dir, 'src')
+        for path, content in self.FILES.items():
+            full = self.src + path
+            if not os.path.isdir(os.path.dirname(full)):
+                os.makedirs(os.path.dirname(full))
+            with open(full, 'wb') as out:
+                out.write(content)
+        # file with a hole
+        with open(self.src + '/holes.bin', 'wb') as out:
+            out.seek(2 * 1024 * 1024)
+            out.write('after the hole')
+        for link, target in self.LINKS.items():
+            os.symlink(target, self.src + link)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_image(self, name, *options):
+        image = os.path.join(self.dir, name)
+        with open(os.devnull, 'w') as dev_null:
+            subprocess.check_call(['mke2fs', '-q', '-F'] + list(options) + ['-d', self.src, image, '16M'],
+                                  stdout=dev_null, stderr=dev_null)
+        return image
+
+    def check_image(self, image):
+        fs = Ext4Image(image)
+        try:
+            self.assertEqual(list(scan_fs_tree(fs, {'*.so': 'so', '*.apk': 'java', '*.jar': 'java'})),
+                             [('/app/Small.apk', 'java'), ('/app/deep/dir/tiny.jar', 'java'), ('/app/deep/up.jar', 'java'),
+                              ('/lib/abs.so', 'so'), ('/lib/libfoo.so', 'so'), ('/link.so', 'so'), ('/long.so', 'so')])
+            for path, content in self.FILES.items():
+                self.assertTrue(fs.isfile(path))
+                self.assertEqual(fs.getsize(path), len(content))
+                self.assertEqual(fs.open(path).read(), content)
+            holes = fs.open('/holes.bin')
+            self.assertEqual(holes.read(2 * 1024 * 1024), '\0' * 2 * 1024 * 1024)
+            self.assertEqual(holes.read(), 'after the hole')
+            big = fs.open('/lib/big.bin')
+            big.seek(-20, os.SEEK_END)
+            self.assertEqual(big.read(), self.FILES['/lib/big.bin'][-20:])
+            for link in ('/link.so', '/lib/abs.so', '/long.so', '/libdir/libfoo.so', '/libdir/../link.so'):
+                self.assertTrue(fs.isfile(link))
+                self.assertEqual(fs.open(link).read(), self.FILES['/lib/libfoo.so'])
+            self.assertEqual(fs.getsize('/app/deep/up.jar'), len(self.FILES['/app/Small.apk']))
+            self.assertFalse(fs.isfile('/libdir'))
+            self.assertFalse(fs.isfile('/dangling.so'))
+            self.assertFalse(fs.isfile('/loop.so'))
+            self.assertFalse(fs.isfile('/lib/missing.so'))
+            self.assertRaises(IOError, fs.open, '/lib')
+        finally:
+            fs.close()
+
+    def test_ext4(self):
+        self.check_image(self.make_image('ext4.img', '-t', 'ext4'))
+
+    def test_ext4_4k_64bit(self):
+        self.check_image(self.make_image('ext4_4k.img', '-t', 'ext4', '-b', '4096', '-O', '64bit,metadata_csum'))
+
+    def test_ext4_inline_data(self):
+        self.check_image(self.make_image('inline.img', '-t', 'ext4', '-I', '256', '-O', 'inline_data'))
+
+    def test_ext2_block_map(self):
+        self.check_image(self.make_image('ext2.img', '-t', 'ext2'))
+
+    def test_sparse_image(self):
+        raw = self.make_image('raw.img', '-t', 'ext4', '-b', '4096')
+        sparse = os.path.join(self.dir, 'sparse.img')
+        to_sparse(raw, sparse)
+        self.check_image(sparse)
+
+    def test_not_ext4(self):
+        bogus = os.path.join(self.dir, 'bogus.img')
+        with open(bogus, 'wb') as out:
+            out.write('\0' * 4096)
+        self.assertRaises(Ext4Error, Ext4Image, bogus)
+
+if __name__ == '__main__':
+    unittest.main()
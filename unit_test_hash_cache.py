@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+import os, time, shutil, tempfile, unittest
+from hash_cache import HashCache
+
+class UnitTest_hash_cache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_persistence_and_counters(self):
+        cache = HashCache(self.path)
+        self.assertEqual(cache.get('img', '/lib/a.so', 'elf:.text'), None)
+        cache.put('img', '/lib/a.so', 'elf:.text', 'abc')
+        cache.close()
+        cache = HashCache(self.path)
+        self.assertEqual(cache.get('img', '/lib/a.so', 'elf:.text'), 'abc')
+        self.assertEqual(cache.get('other', '/lib/a.so', 'elf:.text'), None)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        cache.close()
+
+    def test_periodic_commit(self):
+        cache = HashCache(self.path, commit_every=2, commit_seconds=3600)
+        reader = HashCache(self.path)
+        cache.put('img', 'a', 'sha1', 'a')
+        self.assertEqual(reader.get('img', 'a', 'sha1'), None)
+        cache.put('img', 'b', 'sha1', 'b')
+        # committed without close(), as an interrupted run would leave it
+        self.assertEqual([reader.get('img', name, 'sha1') for name in ['a', 'b']], ['a', 'b'])
+        reader.close()
+        cache.close()
+
+    def test_lru_eviction(self):
+        cache = HashCache(self.path, max_entries=2)
+        for name in ['a', 'b', 'c']:
+            cache.put('img', name, 'md5', name)
+            time.sleep(0.01)
+        cache.get('img', 'a', 'md5')
+        cache.close()
+        cache = HashCache(self.path, max_entries=2)
+        self.assertEqual([cache.get('img', name, 'md5') for name in ['a', 'b', 'c']], ['a', None, 'c'])
+        cache.close()
+
+    def test_image_digest(self):
+        image = os.path.join(self.dir, 'system.img')
+        with open(image, 'wb') as img:
+            img.write('content')
+        cache = HashCache(self.path)
+        self.assertEqual(cache.image_digest(image), '040f06fd774092478d450774f5ba30c5da78acc8')
+        cache.remember_image(image, 'precomputed')
+        self.assertEqual(cache.image_digest(image), 'precomputed')
+        cache.close()
+
+if __name__ == '__main__':
+    unittest.main()
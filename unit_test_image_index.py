@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+import os, shutil, tempfile, unittest
+from image_index import ImageIndex, ImageIndexError
+
+class UnitTest_image_index(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'ref.idx')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_roundtrip(self):
+        index = ImageIndex('imagesum', ['.text'])
+        index.add('/lib/b.so', '*.so', 10, {'elf:.text': 'abc'})
+        index.add('/app/a.apk', '*.apk', 20, {'sha1': 'def', 'manifest': {'classes.dex\r\n': 'xyz=\r\n'}, 'dex': None})
+        index.save(self.path)
+        loaded = ImageIndex.load(self.path)
+        self.assertEqual((loaded.image, loaded.sections), ('imagesum', ['.text']))
+        self.assertEqual(list(loaded.items()), [('/app/a.apk', '*.apk'), ('/lib/b.so', '*.so')])
+        manifest = loaded.value('/app/a.apk', 'manifest')
+        self.assertEqual(manifest, {'classes.dex\r\n': 'xyz=\r\n'})
+        self.assertTrue(isinstance(manifest.keys()[0], str))
+        self.assertEqual(loaded.value('/lib/b.so', 'elf:.text'), 'abc')
+        self.assertEqual(loaded.value('/lib/missing.so', 'elf:.text'), None)
+
+    def test_bad_format(self):
+        with open(self.path, 'w') as out:
+            out.write('not an index\n')
+        self.assertRaises(ImageIndexError, ImageIndex.load, self.path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+import unittest
+from jar_manifest import parse_manifest, diff_manifests, same_digests
+
+LONG_NAME = 'res/drawable-xxhdpi-v4/' + 'a' * 60 + '.png'
+
+MANIFEST = ('Manifest-Version: 1.0\r\nCreated-By: 1.0 (Android)\r\n\r\n'
+            'Name: classes.dex\r\nSHA1-Digest: abc=\r\n\r\n'
+            # wrapped at 72 bytes
+            'Name: ' + LONG_NAME[:66] + '\r\n ' + LONG_NAME[66:] + '\r\nSHA-256-Digest: 0123456789abcdef0123456789abcdef0123\r\n'
+            ' 456789abcdef=\r\nSHA-1-Digest: def=\r\n\r\n'
+            'Name: AndroidManifest.xml\r\nSHA1-Digest: xml=\r\n\r\n'
+            'Name: res/raw/nodigest.txt\r\n\r\n')
+
+class UnitTest_jar_manifest(unittest.TestCase):
+
+    def test_parse(self):
+        manifest = parse_manifest(MANIFEST)
+        self.assertEqual(manifest, {
+            'classes.dex': {'SHA1': 'abc='},
+            LONG_NAME: {'SHA256': '0123456789abcdef0123456789abcdef0123456789abcdef=', 'SHA1': 'def='}})
+        self.assertEqual(parse_manifest(MANIFEST.replace('\r\n', '\n')), manifest)
+        self.assertEqual(parse_manifest(MANIFEST.replace('\r\n', '\r')), manifest)
+        self.assertEqual(parse_manifest(''), {})
+        self.assertEqual(parse_manifest('Manifest-Version: 1.0\r\n\r\n'), {})
+
+    def test_diff(self):
+        manifest = parse_manifest(MANIFEST)
+        self.assertEqual(diff_manifests(manifest, dict(manifest)), ([], [], []))
+        other = dict(manifest)
+        del other['classes.dex']
+        other['classes2.dex'] = {'SHA1': 'new='}
+        other[LONG_NAME] = {'SHA256': 'changed='}
+        self.assertEqual(diff_manifests(manifest, other), (['classes2.dex'], ['classes.dex'], [LONG_NAME]))
+        # v1 and v2 signed builds of the same content agree on the common algorithm
+        other[LONG_NAME] = {'SHA1': 'def='}
+        self.assertEqual(diff_manifests(manifest, other)[2], [])
+
+    def test_same_digests(self):
+        self.assertTrue(same_digests({'SHA1': 'a', 'SHA256': 'b'}, {'SHA256': 'b'}))
+        self.assertFalse(same_digests({'SHA1': 'a', 'SHA256': 'b'}, {'SHA1': 'a', 'SHA256': 'c'}))
+        self.assertFalse(same_digests({'SHA1': 'a'}, {'SHA256': 'a'}))
+
+if __name__ == '__main__':
+    unittest.main()
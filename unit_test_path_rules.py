@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+import unittest, time
+from path_rules import RuleSet, RuleError, glob_to_regex
+
+RULES = '''
+# legacy allowed-missing-files lines
+/lib/libfoo.so
+/lib/libfoo.so
+allow-missing /lib/libbar*.so
+allow-missing /vendor/
+ignore /app/Debug?.apk
+ignore /priv-app/**.apk   # any depth
+compare /etc/*.xml exact
+compare /lib/hw/[!x]*.so elf
+'''
+
+class UnitTest_path_rules(unittest.TestCase):
+
+    def test_matching(self):
+        rules = RuleSet().parse(RULES.splitlines())
+        missing = rules.allowedMissing
+        self.assertTrue('/lib/libfoo.so' in missing)
+        self.assertTrue('/lib/libbar_jni.so' in missing)
+        self.assertFalse('/lib/sub/libbar.so' in missing)
+        self.assertTrue('/vendor/lib/x.so' in missing)
+        self.assertFalse('/vendorx.so' in missing)
+        self.assertTrue(rules.ignored('/app/Debug1.apk'))
+        self.assertFalse(rules.ignored('/app/Debug12.apk'))
+        self.assertTrue(rules.ignored('/priv-app/a/b/c.apk'))
+        self.assertEqual(rules.compare_method('/etc/permissions.xml'), 'exact')
+        self.assertEqual(rules.compare_method('/etc/a/permissions.xml'), None)
+        self.assertEqual(rules.compare_method('/lib/hw/gps.so'), 'elf')
+        self.assertEqual(rules.compare_method('/lib/hw/xgps.so'), None)
+        self.assertEqual(rules.walk_patterns(), set(['*.xml', '[!x]*.so']))
+        self.assertEqual(rules.compare_methods(), set(['exact', 'elf']))
+
+    def test_hit_counts(self):
+        rules = RuleSet().parse(RULES.splitlines(), 'rules')
+        for path in ['/lib/libfoo.so', '/lib/libfoo.so', '/lib/libbar1.so', '/etc/a.xml']:
+            path in rules.allowedMissing
+        rules.compare_method('/etc/a.xml')
+        self.assertEqual([(rule.source, rule.hits) for rule in rules.ordered if rule.hits],
+                         [('rules:3', 2), ('rules:5', 1), ('rules:9', 1)])
+        # the duplicate line never matches
+        self.assertEqual([rule.source for rule in rules.unused()][:2], ['rules:4', 'rules:6'])
+        self.assertEqual(rules.stats(), 'rules: 3 of 8 matched')
+
+    def test_prefix_glob_anchored(self):
+        rules = RuleSet()
+        rules.add('allow-missing', '/lib/libbar*.so')
+        rules.add('allow-missing', '/vendor/')
+        self.assertFalse('/lib/libbar.so.orig' in rules.allowedMissing)
+        self.assertTrue('/lib/libbar.so' in rules.allowedMissing)
+        rules.add('ignore', '/priv-app/Gms*')
+        rules.add('ignore', '/app/')
+        self.assertFalse(rules.ignored('/priv-app/GmsCore/GmsCore.apk'))
+        self.assertTrue(rules.ignored('/priv-app/GmsCore.apk'))
+
+    def test_many_rules(self):
+        lines = []
+        for i in xrange(2000):
+            lines.append('allow-missing /lib/lib%04d*.so' % i)
+            lines.append('allow-missing /vendor/v%04d/' % i)
+        start = time.time()
+        rules = RuleSet().parse(lines)
+        self.assertTrue('/lib/lib1999_jni.so' in rules.allowedMissing)
+        self.assertTrue('/vendor/v0000/lib/a.so' in rules.allowedMissing)
+        self.assertFalse('/lib/lib2000.so' in rules.allowedMissing)
+        # loading and the first match compile the merged regex once, not once per rule
+        self.assertLess(time.time() - start, 10)
+        # a rule added after a match is in the next one
+        rules.add('allow-missing', '/lib/lib2000*.so')
+        self.assertTrue('/lib/lib2000.so' in rules.allowedMissing)
+
+    def test_errors(self):
+        for line in ['lib/a.so', 'remove /lib/a.so', 'compare /lib/a.so', 'ignore /lib/a.so elf', 'a b c d']:
+            self.assertRaises(RuleError, RuleSet().parse, [line])
+
+    def test_glob_to_regex(self):
+        self.assertEqual(glob_to_regex('/a.b'), '\\/a\\.b')
+        self.assertEqual(glob_to_regex('*?**[!a-c]['), '[^/]*[^/].*[^a-c]\\[')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import os, json, shutil, tempfile, unittest
+import profiler
+from profiler import profiled
+
+@profiled('read', 0, size=lambda path, data: len(data))
+def read_data(path, data):
+    return data
+
+class UnitTest_profiler(unittest.TestCase):
+
+    def setUp(self):
+        profiler.reset()
+
+    def tearDown(self):
+        profiler.disable()
+        profiler.reset()
+
+    def test_disabled_records_nothing(self):
+        self.assertEqual(read_data('/lib/a.so', 'abc'), 'abc')
+        for _ in profiler.profiled_iter('walk', [1, 2]):
+            pass
+        with profiler.phase('mount'):
+            pass
+        self.assertEqual(profiler.summary(), [])
+
+    def test_phases_by_file_type(self):
+        profiler.enable()
+        read_data('/lib/a.so', 'abc')
+        read_data('/lib/b.so', 'de')
+        read_data('/app/c.apk', 'f')
+        self.assertEqual(list(profiler.profiled_iter('walk', [1, 2, 3])), [1, 2, 3])
+        with profiler.phase('mount'):
+            pass
+        rows = dict(((row['phase'], row['type']), row) for row in profiler.summary())
+        self.assertEqual(sorted(rows), [('mount', ''), ('read', '.apk'), ('read', '.so'), ('walk', '')])
+        self.assertEqual((rows[('read', '.so')]['count'], rows[('read', '.so')]['bytes']), (2, 5))
+        self.assertEqual(rows[('walk', '')]['count'], 1)
+        self.assertTrue(rows[('read', '.so')]['p50'] <= rows[('read', '.so')]['max'])
+        self.assertTrue('read' in profiler.report())
+
+    def test_percentiles_and_json(self):
+        stats = profiler.PhaseStats()
+        for ms in xrange(1, 101):
+            stats.add(ms / 1000.0, 0)
+        self.assertEqual([stats.percentile(pct) for pct in profiler.PERCENTILES], [0.051, 0.091, 0.1])
+
+        profiler.enable()
+        read_data('x.jar', 'abc')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'profile.json')
+            profiler.save_json(path)
+            with open(path) as inp:
+                saved = json.load(inp)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual([(row['phase'], row['type'], row['bytes']) for row in saved['phases']], [('read', '.jar', 3)])
+        self.assertTrue(saved['wall'] >= 0)
+
+    def test_merge_weighted(self):
+        saved = profiler.MAX_SAMPLES
+        profiler.MAX_SAMPLES = 100
+        try:
+            # two workers over the sample limit, the second one three times as slow
+            for ms in (1, 3):
+                profiler.reset()
+                profiler.enable()
+                for _ in xrange(300):
+                    profiler.record('sha1', ms / 1000.0)
+                snapshot = profiler.snapshot()
+                if ms == 1:
+                    first = snapshot
+            profiler.reset()
+            profiler.merge(first)
+            profiler.merge(snapshot)
+            row = profiler.summary()[0]
+            self.assertEqual(row['count'], 600)
+            self.assertEqual((row['p50'] * 1000, row['p90'] * 1000), (3, 3))
+            self.assertEqual(len(profiler._stats[('sha1', '')].samples), 100)
+        finally:
+            profiler.MAX_SAMPLES = saved
+
+if __name__ == '__main__':
+    unittest.main()
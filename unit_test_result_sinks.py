@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import os, json, shutil, tempfile, unittest
+from xml.dom import minidom
+from result_sinks import FileResult, MismatchSink, JsonLinesSink, JUnitSink, numbered_path, \
+    FILE_SAME, FILE_DIFF, FILE_MISS, FILE_MISS_ALLOWED, FILE_EXTRA
+
+def make_results():
+    results = []
+    for rel_path, verdict in [('/app/A.apk', FILE_SAME), ('/lib/<b>.so', FILE_DIFF), ('/lib/c.so', FILE_MISS),
+                              ('/lib/d.so', FILE_MISS_ALLOWED), ('/lib/e.so', FILE_EXTRA)]:
+        result = FileResult(rel_path, 'elf')
+        result.verdict = verdict
+        result.seconds = 0.5
+        results.append(result)
+    results[0].tier = 0
+    results[0].local_size = results[0].ext_size = 3
+    results[0].local_sha1 = results[0].ext_sha1 = 'a9993e364706816aba3e25717850c26c9cd0d89d'
+    return results
+
+class UnitTest_result_sinks(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def feed(self, sink, same=False):
+        for result in make_results():
+            sink.record(result)
+        sink.finish(same)
+        return sink
+
+    def test_result(self):
+        result = make_results()[0]
+        self.assertRaises(AttributeError, setattr, result, 'other', 1)
+        self.assertEqual(result.as_dict()['verdict'], 'same')
+        self.assertFalse(result.failed())
+        self.assertEqual([r.failed() for r in make_results()], [False, True, True, False, True])
+
+    def test_mismatch_sink(self):
+        sink = self.feed(MismatchSink())
+        self.assertEqual(sink.checked, 5)
+        self.assertEqual(sink.mismatches, { '/lib/<b>.so': FILE_DIFF, '/lib/c.so': FILE_MISS, '/lib/d.so': FILE_MISS_ALLOWED,
+                                            '/lib/e.so': FILE_EXTRA })
+
+    def test_jsonl_sink(self):
+        path = os.path.join(self.dir, 'out.jsonl')
+        self.feed(JsonLinesSink(path))
+        lines = [json.loads(line) for line in open(path)]
+        self.assertEqual(len(lines), 6)
+        self.assertEqual((lines[0]['rel_path'], lines[0]['kind'], lines[0]['tier'], lines[0]['local_size']), ('/app/A.apk', 'elf', 0, 3))
+        self.assertEqual([line['verdict'] for line in lines[:5]], ['same', 'differ', 'missing', 'allowed-missing', 'local-only'])
+        self.assertEqual(lines[5]['summary'], { 'same': False, 'files': { 'same': 1, 'differ': 1, 'missing': 1, 'allowed-missing': 1,
+                                                                          'local-only': 1 } })
+
+    def test_junit_sink(self):
+        path = os.path.join(self.dir, 'out.xml')
+        self.feed(JUnitSink(path))
+        suite = minidom.parse(path).documentElement
+        self.assertEqual(suite.tagName, 'testsuite')
+        self.assertEqual((suite.getAttribute('tests'), suite.getAttribute('failures'), suite.getAttribute('skipped')), ('5', '3', '1'))
+        cases = suite.getElementsByTagName('testcase')
+        self.assertEqual([case.getAttribute('name') for case in cases], ['/app/A.apk', '/lib/<b>.so', '/lib/c.so', '/lib/d.so', '/lib/e.so'])
+        self.assertEqual([len(case.getElementsByTagName('failure')) for case in cases], [0, 1, 1, 0, 1])
+        self.assertEqual(cases[3].getElementsByTagName('skipped')[0].getAttribute('message'), 'allowed missing')
+
+    def test_numbered_path(self):
+        self.assertEqual(numbered_path('/tmp/out.jsonl', 3), '/tmp/out.3.jsonl')
+        self.assertEqual(numbered_path('report', 0), 'report.0')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+import os, hashlib, subprocess, threading, time, unittest, tempfile, shutil, multiprocessing
+from tool_runner import ToolRunner, ToolTimeout, ToolError
+
+# runner of test_share_limits(), inherited by the forked workers
+_shared = None
+
+def _run_alone(directory):
+    # mkdir fails when another worker's sh holds the directory
+    return _shared.run(['sh', '-c', 'mkdir "$0" && sleep 0.05 && rmdir "$0"', directory])[2]
+
+class UnitTest_tool_runner(unittest.TestCase):
+
+    def test_run(self):
+        runner = ToolRunner(2)
+        digest, err, code = runner.run(['sh', '-c', 'dd if=/dev/zero bs=1000 count=1000 2>/dev/null; echo oops >&2'],
+                                       lambda out: hashlib.sha1(out.read()).hexdigest())
+        self.assertEqual(digest, hashlib.sha1('\0' * 1000000).hexdigest())
+        self.assertEqual((err, code), ('oops\n', 0))
+        self.assertEqual(runner.run(['false'])[2], 1)
+        self.assertRaises(subprocess.CalledProcessError, runner.check_call, ['false'])
+        self.assertEqual(runner.running(), 0)
+
+    def test_limits(self):
+        runner = ToolRunner(4, {'sleep': 1})
+        started = []
+        def watch(out):
+            started.append(runner.running())
+            return out.read()
+        threads = [threading.Thread(target=runner.run, args=(['sleep', '0.05'], watch)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(started, [1, 1, 1])
+
+    def test_timeout(self):
+        runner = ToolRunner(timeout=0.1)
+        start = time.time()
+        self.assertRaises(ToolTimeout, runner.run, ['sleep', '10'], lambda out: out.read())
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(runner.run(['sleep', '0.2'], timeout=None)[2], 0)
+        self.assertEqual(runner.running(), 0)
+
+    def test_terminate_all(self):
+        runner = ToolRunner(grace=0.5)
+        results = []
+        thread = threading.Thread(target=lambda: results.append(runner.run(['sleep', '10'], lambda out: out.read())))
+        thread.start()
+        while not runner.running():
+            time.sleep(0.01)
+        procs = list(runner.children)
+        self.assertEqual(runner.terminate_all(), 1)
+        self.assertTrue(procs[0].returncode is not None)
+        thread.join()
+        self.assertEqual(runner.running(), 0)
+        self.assertTrue(results[0][2] < 0)
+
+    def test_stop(self):
+        runner = ToolRunner(foreground=('true',))
+        self.assertEqual(runner.stop(), 0)
+        self.assertRaises(ToolError, runner.run, ['sleep', '0'])
+        self.assertEqual(runner.running(), 0)
+        # sudo umount still has to run after a signal
+        self.assertEqual(runner.run(['true'])[2], 0)
+
+    def test_share_limits(self):
+        global _shared
+        _shared = ToolRunner(limits={'sh': 1})
+        _shared.share_limits()
+        root = tempfile.mkdtemp()
+        pool = multiprocessing.Pool(4)
+        try:
+            self.assertEqual(pool.map(_run_alone, [os.path.join(root, 'held')] * 12), [0] * 12)
+        finally:
+            pool.terminate()
+            pool.join()
+            shutil.rmtree(root)
+
+    def test_process_groups(self):
+        runner = ToolRunner(foreground=('sh',))
+        ids = lambda cmd: runner.run(cmd, lambda out: out.read().split())[0]
+        # a foreground tool keeps the session and process group, and so the terminal, of the caller
+        self.assertEqual(ids(['sh', '-c', 'ps -o pgid= -o sid= -p $$']), [str(os.getpgrp()), str(os.getsid(0))])
+        self.assertNotEqual(ids(['env', 'sh', '-c', 'ps -o sid= -p $$']), [str(os.getsid(0))])
+
+    def test_terminate_all_holding_lock(self):
+        # what a signal handler does when it interrupts start() or finish()
+        runner = ToolRunner()
+        def interrupted():
+            with runner.lock:
+                runner.terminate_all()
+        thread = threading.Thread(target=interrupted)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+if __name__ == '__main__':
+    unittest.main()